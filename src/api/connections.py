@@ -0,0 +1,78 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Connections kept open to the server, one for every dispatcher thread.
+POOL_SIZE = 8
+KEEP_ALIVE = True
+# Seconds to wait for a connection and then for the response, per request.
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 30.0
+
+
+class PooledAdapter(HTTPAdapter):
+    """Adapter every session shares, fills in the timeout of requests that don't set one."""
+
+    def __init__(self, pool_size, timeout):
+        self.timeout = timeout
+        super().__init__(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive connections to the server shared by all api calls.
+
+    requests.Session isn't safe to share between threads, so every dispatcher thread
+    gets its own session, but all of them send through one adapter, whose urllib3
+    pool is thread safe. A request only opens a connection (and does the TCP and TLS
+    handshakes) when every pooled connection is busy or the server closed it.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, keep_alive=KEEP_ALIVE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.adapter = PooledAdapter(pool_size, timeout)
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def session(self):
+        """Session of the calling thread."""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def stats(self):
+        """Requests sent and connections opened, every connection opened is a handshake."""
+        requests_sent = connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        return {
+            'requests': requests_sent,
+            'handshakes': connections,
+            'reused': requests_sent - connections,
+            'sessions': len(self._sessions),
+        }
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+        self.adapter.close()
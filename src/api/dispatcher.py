@@ -1,81 +1,163 @@
 from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import QObject, QEventLoop, Qt, pyqtSignal
 from api.methods import *
+from api.merkle import reconcile_with_server
+from api.sync import SyncExecutor
+from api.connections import ConnectionPool, POOL_SIZE
+
+
+class JobSignals(QObject):
+    # Emitted from the executor thread, receivers get it on the thread the dispatcher was made on.
+    finished = pyqtSignal(int, object)
 
 
 class ApiCallDispatcher(object):
+    """
+    Runs api calls on a thread pool, every call returns a job id.
 
-    def __init__(self, output_queue, token=None):
-        self.output_queue = output_queue
+    Finished futures reach the GUI thread through a queued signal, so callers either
+    register a callback with on_done(), or block in wait(), which runs a local event
+    loop until the job is done instead of polling for it.
+    """
+
+    def __init__(self, token=None, pool_size=POOL_SIZE, **connection_options):
         self.token = token
-        self.executor = ThreadPoolExecutor()
+        # One kept alive connection for every thread, so calls never wait for a connection.
+        self.connections = ConnectionPool(pool_size, **connection_options)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
         self._job_id_counter = 0
+        # Job id -> future until somebody takes it, callbacks and event loops waiting for jobs.
+        self._futures = {}
+        self._callbacks = {}
+        self._loops = {}
+        self._signals = JobSignals()
+        self._signals.finished.connect(self._job_finished, Qt.QueuedConnection)
+
+    def _watch(self, jid, future):
+        self._futures[jid] = future
+        future.add_done_callback(lambda done: self._signals.finished.emit(jid, done))
+
+    def _job_finished(self, jid, future):
+        loop = self._loops.pop(jid, None)
+        if loop is not None:
+            loop.quit()
+        callbacks = self._callbacks.pop(jid, None)
+        if callbacks:
+            self._futures.pop(jid, None)
+            for callback in callbacks:
+                callback(future)
+
+    def on_done(self, jid, callback):
+        """Calls callback(future) on the GUI thread once the job is done."""
+        self._callbacks.setdefault(jid, []).append(callback)
+        future = self._futures[jid]
+        if future.done() and jid not in self._loops:
+            # Signal might have been delivered already, the callback must not wait for it.
+            self._signals.finished.emit(jid, future)
+
+    def wait(self, jid):
+        """
+        Returns the future of the job once it's done and its on_done() callbacks ran,
+        events are processed meanwhile.
+        """
+        future = self._futures[jid]
+        if not future.done() or jid in self._callbacks:
+            loop = QEventLoop()
+            self._loops[jid] = loop
+            if not future.done() or jid in self._callbacks:
+                loop.exec_()
+            self._loops.pop(jid, None)
+        self._futures.pop(jid, None)
+        return future
+
+    def _submit(self, func, *args):
+        return self.executor.submit(self._call, func, *args)
+
+    def _call(self, func, *args):
+        # Runs on the executor thread, sessions belong to the thread that uses them.
+        return func(self.connections.session(), *args)
+
+    def connection_stats(self):
+        return self.connections.stats()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.connections.close()
 
     def authenticate(self, username, password):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(authenticate, username, password)
-        self.output_queue.put((jid, future))
+        future = self._submit(authenticate, username, password)
+        self._watch(jid, future)
         return jid
 
     def register(self, email, username, password):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(register, email, username, password)
-        self.output_queue.put((jid, future))
+        future = self._submit(register, email, username, password)
+        self._watch(jid, future)
         return jid
 
     def get_cards(self):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(get_cards, self.token)
-        self.output_queue.put((jid, future))
+        future = self._submit(get_cards, self.token)
+        self._watch(jid, future)
         return jid
 
     def get_tasks(self):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(get_tasks, self.token)
-        self.output_queue.put((jid, future))
+        future = self._submit(get_tasks, self.token)
+        self._watch(jid, future)
         return jid
 
     def get_preferences(self):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(get_preferences, self.token)
-        self.output_queue.put((jid, future))
+        future = self._submit(get_preferences, self.token)
+        self._watch(jid, future)
         return jid
 
     def create_card(self, card):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(create_card, self.token, card)
-        self.output_queue.put((jid, future))
+        future = self._submit(create_card, self.token, card)
+        self._watch(jid, future)
         return jid
 
     def create_task(self, task):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(create_task, self.token, task)
-        self.output_queue.put((jid, future))
+        future = self._submit(create_task, self.token, task)
+        self._watch(jid, future)
         return jid
 
     def remove_task(self, task):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(remove_task, self.token, task)
-        self.output_queue.put((jid, future))
+        future = self._submit(remove_task, self.token, task)
+        self._watch(jid, future)
         return jid
 
     def modify_task(self, task):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(modify_task, self.token, task)
-        self.output_queue.put((jid, future))
+        future = self._submit(modify_task, self.token, task)
+        self._watch(jid, future)
+        return jid
+
+    def reconcile(self, curr_data):
+        jid = self._job_id_counter
+        self._job_id_counter += 1
+        future = self._submit(reconcile_with_server, self.token, curr_data)
+        self._watch(jid, future)
         return jid
 
-    def sync(self, file_data, curr_data):
+    def sync(self, changes):
         jid = self._job_id_counter
         self._job_id_counter += 1
-        future = self.executor.submit(sync_diff, self.token, file_data, curr_data)
-        self.output_queue.put((jid, future))
+        # Batches are submitted one by one as their dependencies finish, see api.sync.
+        future = SyncExecutor(self._submit, self.token, changes).start()
+        self._watch(jid, future)
         return jid
@@ -0,0 +1,226 @@
+"""
+Hash tree over cards, task buckets and tasks.
+
+Root hashes every card node, card node hashes the card, its preference and
+BUCKETS buckets of its tasks, and a bucket hashes fingerprints of its tasks.
+Two trees are reconciled from the root down, only nodes whose hashes differ
+are asked for, so the cost is proportional to how much the datasets diverged.
+Server serves the same tree under urls['merkle'], MerkleTree built from any
+other dataset works as a local stand-in for it. Server hashes resources with
+integer positions, so the local tree is built from them too (see api.resources.to_wire).
+"""
+import struct
+from hashlib import blake2b
+from api.urls import urls
+from api.methods import get_merkle_node
+from api.resources import to_wire, from_wire
+from persistence.baseline import fingerprint, DIGEST_SIZE
+
+
+# Tasks of a card are split into buckets by rid.
+BUCKETS = 16
+NODE_DIGEST_SIZE = 16
+
+_LEAF = struct.Struct('<q{}s'.format(DIGEST_SIZE))
+_NODE = struct.Struct('<q{}s'.format(NODE_DIGEST_SIZE))
+_NO_FINGERPRINT = bytes(DIGEST_SIZE)
+
+
+def _hash(parts):
+    h = blake2b(digest_size=NODE_DIGEST_SIZE)
+    for part in parts:
+        h.update(part)
+    return h.digest()
+
+
+def bucket_of(task_rid):
+    return task_rid % BUCKETS
+
+
+def _resources(data, kind):
+    if hasattr(data, 'resources'):
+        return data.resources(kind)
+    return data[kind]
+
+
+class MerkleTree(object):
+    """Tree of a dataset that's in memory, cards, tasks and preferences are resource dicts."""
+
+    def __init__(self, cards, tasks, preferences):
+        self.requests = 0
+        self.resources = 0
+        self._cards = {card['rid']: card for card in cards}
+        self._preferences = {pref['card_rid']: pref for pref in preferences}
+        # Card rid -> buckets of task rid -> (fingerprint, task).
+        self._buckets = {card_rid: [{} for _ in range(BUCKETS)] for card_rid in self._cards}
+        for task in tasks:
+            buckets = self._buckets.get(task['card_rid'])
+            if buckets is not None:
+                buckets[bucket_of(task['rid'])][task['rid']] = (fingerprint(task), task)
+
+        self._bucket_hashes = {}
+        self._card_hashes = {}
+        for card_rid, card in self._cards.items():
+            bucket_hashes = [_hash(_LEAF.pack(rid, bucket[rid][0]) for rid in sorted(bucket))
+                             for bucket in self._buckets[card_rid]]
+            pref = self._preferences.get(card_rid)
+            self._bucket_hashes[card_rid] = bucket_hashes
+            self._card_hashes[card_rid] = _hash([fingerprint(card),
+                                                 fingerprint(pref) if pref is not None else _NO_FINGERPRINT]
+                                                + bucket_hashes)
+        self._root = _hash(_NODE.pack(card_rid, self._card_hashes[card_rid])
+                           for card_rid in sorted(self._card_hashes))
+
+    @classmethod
+    def from_data(cls, data):
+        """Tree of a snapshot, or of a dict of resource lists like the storage file."""
+        return cls(list(_resources(data, 'cards')), _resources(data, 'tasks'),
+                   list(_resources(data, 'preferences')))
+
+    def root(self):
+        self.requests += 1
+        return self._root
+
+    def card_hashes(self):
+        self.requests += 1
+        return dict(self._card_hashes)
+
+    def card_node(self, card_rid):
+        """Card, its preference and hashes of its buckets."""
+        self.requests += 1
+        self.resources += 2
+        return {'card': self._cards[card_rid], 'preference': self._preferences.get(card_rid),
+                'buckets': list(self._bucket_hashes[card_rid])}
+
+    def bucket(self, card_rid, index):
+        """Task rid -> task of one bucket."""
+        self.requests += 1
+        tasks = {rid: task for rid, (_, task) in self._buckets[card_rid][index].items()}
+        self.resources += len(tasks)
+        return tasks
+
+    def card_tasks(self, card_rid):
+        """Every task of the card, for cards the other side doesn't have at all."""
+        self.requests += 1
+        tasks = {rid: task for bucket in self._buckets[card_rid] for rid, (_, task) in bucket.items()}
+        self.resources += len(tasks)
+        return tasks
+
+
+class RemoteMerkleTree(object):
+    """Same tree as served by the server, every call is a request."""
+
+    def __init__(self, session, token):
+        self.session = session
+        self.token = token
+        self.requests = 0
+        self.resources = 0
+
+    def _get(self, path):
+        self.requests += 1
+        return get_merkle_node(self.session, self.token, urls['merkle'] + path)
+
+    def root(self):
+        return bytes.fromhex(self._get('')['hash'])
+
+    def card_hashes(self):
+        return {int(rid): bytes.fromhex(value) for rid, value in self._get('cards/').items()}
+
+    def card_node(self, card_rid):
+        node = self._get('cards/{}/'.format(card_rid))
+        self.resources += 2
+        return {'card': node['card'], 'preference': node['preference'],
+                'buckets': [bytes.fromhex(value) for value in node['buckets']]}
+
+    def bucket(self, card_rid, index):
+        tasks = self._get('cards/{}/buckets/{}/'.format(card_rid, index))
+        self.resources += len(tasks)
+        return {task['rid']: task for task in tasks}
+
+    def card_tasks(self, card_rid):
+        tasks = self._get('cards/{}/tasks/'.format(card_rid))
+        self.resources += len(tasks)
+        return {task['rid']: task for task in tasks}
+
+
+class Divergence(object):
+    """
+    Resources that differ between two trees, kind -> rid -> (local, remote),
+    either of them is None if that side doesn't have the resource.
+    """
+
+    def __init__(self):
+        self.resources = {'cards': {}, 'tasks': {}, 'preferences': {}}
+        self.requests = 0
+        self.transferred = 0
+
+    def add(self, kind, rid, local, remote):
+        # Task that moved to another card shows up under both of them.
+        old_local, old_remote = self.resources[kind].get(rid, (None, None))
+        self.resources[kind][rid] = (local if local is not None else old_local,
+                                     remote if remote is not None else old_remote)
+
+    def __len__(self):
+        return sum(len(resources) for resources in self.resources.values())
+
+
+def reconcile(local, remote):
+    """Walks both trees from the root and returns the Divergence, only differing subtrees are transferred."""
+    divergence = Divergence()
+    requests, transferred = remote.requests, remote.resources
+    if local.root() != remote.root():
+        local_cards = local.card_hashes()
+        remote_cards = remote.card_hashes()
+        for card_rid in sorted(local_cards.keys() | remote_cards.keys()):
+            if local_cards.get(card_rid) == remote_cards.get(card_rid):
+                continue
+            _reconcile_card(divergence, local, remote, card_rid,
+                            card_rid in local_cards, card_rid in remote_cards)
+    divergence.requests = remote.requests - requests
+    divergence.transferred = remote.resources - transferred
+    return divergence
+
+
+def _reconcile_card(divergence, local, remote, card_rid, in_local, in_remote):
+    local_node = local.card_node(card_rid) if in_local else None
+    remote_node = remote.card_node(card_rid) if in_remote else None
+    local_card = local_node['card'] if local_node else None
+    remote_card = remote_node['card'] if remote_node else None
+    if local_card != remote_card:
+        divergence.add('cards', card_rid, local_card, remote_card)
+    local_pref = local_node['preference'] if local_node else None
+    remote_pref = remote_node['preference'] if remote_node else None
+    if local_pref != remote_pref:
+        # Preferences are matched by rid, card might have got a new one.
+        for pref in (local_pref, remote_pref):
+            if pref is not None:
+                divergence.add('preferences', pref['rid'],
+                               local_pref if local_pref is not None and local_pref['rid'] == pref['rid'] else None,
+                               remote_pref if remote_pref is not None and remote_pref['rid'] == pref['rid'] else None)
+
+    if local_node is None or remote_node is None:
+        pairs = [(local.card_tasks(card_rid) if local_node else {},
+                  remote.card_tasks(card_rid) if remote_node else {})]
+    else:
+        pairs = [(local.bucket(card_rid, i), remote.bucket(card_rid, i)) for i in range(BUCKETS)
+                 if local_node['buckets'][i] != remote_node['buckets'][i]]
+    for local_tasks, remote_tasks in pairs:
+        for task_rid in local_tasks.keys() | remote_tasks.keys():
+            local_task = local_tasks.get(task_rid)
+            remote_task = remote_tasks.get(task_rid)
+            if local_task != remote_task:
+                divergence.add('tasks', task_rid, local_task, remote_task)
+
+
+def reconcile_with_server(session, token, data):
+    """Runs on the dispatcher thread, data is a snapshot of the local state."""
+    local = MerkleTree([to_wire(card) for card in _resources(data, 'cards')],
+                       (to_wire(task) for task in _resources(data, 'tasks')),
+                       list(_resources(data, 'preferences')))
+    divergence = reconcile(local, RemoteMerkleTree(session, token))
+    # Storage works with position keys.
+    for resources in divergence.resources.values():
+        for rid, (local_res, remote_res) in resources.items():
+            resources[rid] = (from_wire(local_res) if local_res is not None else None,
+                              from_wire(remote_res) if remote_res is not None else None)
+    return divergence
@@ -1,4 +1,5 @@
 from datetime import datetime
+from utils import positions
 
 
 class ResourceBase(object):
@@ -12,6 +13,12 @@ class ResourceBase(object):
     def from_json(cls, json_resource):
         return cls(**json_resource)
 
+    def replace(self, **changes):
+        """Copy of the resource with some fields changed, stored resources are never modified in place."""
+        fields = dict(vars(self))
+        fields.update(changes)
+        return type(self)(**fields)
+
     def to_json(self):
         if self.field_map is None:
             return vars(self)
@@ -26,13 +33,34 @@ class ResourceBase(object):
         return output
 
 
+def to_wire(resource):
+    """
+    Resource dict as the server takes it, positions go out as the integers
+    their keys stand for (see utils.positions), fractional keys can't.
+    """
+    position = resource.get('position')
+    if isinstance(position, str):
+        value = positions.key_integer(position)
+        if value is not None:
+            return dict(resource, position=value)
+    return resource
+
+
+def from_wire(resource):
+    """Resource dict from the server, integer positions become the keys that stand for them."""
+    position = resource.get('position')
+    if isinstance(position, int):
+        return dict(resource, position=positions.integer_key(position))
+    return resource
+
+
 class CardResource(ResourceBase):
 
     def __init__(self, **kwargs):
         self.rid = kwargs['rid']
         self.name = kwargs['name']
-        # For perfermance reasons, update position just before API synchronization
-        self.position = kwargs['position']
+        # Position key (see utils.positions), assigned by storage when the card is added.
+        self.position = kwargs.get('position', None)
 
 
 class TaskResource(ResourceBase):
@@ -40,7 +68,7 @@ class TaskResource(ResourceBase):
     def __init__(self, **kwargs):
         self.rid = kwargs['rid']
         self.description = kwargs['description']
-        # For perfermance reasons, update position just before API synchronization
+        # Position key (see utils.positions), assigned by storage when the task is placed.
         self.position = kwargs.get('position', None)
         self.card_rid = kwargs['card_rid']
         self.created = kwargs.get('created', datetime.now().timestamp())
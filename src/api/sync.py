@@ -0,0 +1,142 @@
+"""
+Uploads a change set as a small graph of batch requests.
+
+Every batch waits only for the batches it depends on, the rest run concurrently
+on the dispatcher pool, so a sync takes about as many round trips as the longest
+chain of dependencies (three) instead of one round trip for every batch.
+"""
+import time
+import threading
+from concurrent.futures import Future
+from api import methods
+from api.resources import to_wire
+
+
+UPDATES, REMOVES, ADDS = range(3)
+
+# Method, kind and part of the change set it sends, and batches that must be on the server first.
+SYNC_STEPS = (
+    ('add_cards', 'cards', ADDS, ()),
+    ('update_cards', 'cards', UPDATES, ()),
+    ('remove_tasks', 'tasks', REMOVES, ()),
+    ('remove_preferences', 'preferences', REMOVES, ()),
+    # Tasks and preferences can go into cards that are being added.
+    ('add_tasks', 'tasks', ADDS, ('add_cards',)),
+    ('update_tasks', 'tasks', UPDATES, ('add_cards',)),
+    ('update_preferences', 'preferences', UPDATES, ('add_cards',)),
+    # Card might get a new preference in place of the removed one.
+    ('add_preferences', 'preferences', ADDS, ('add_cards', 'remove_preferences')),
+    # Removing a card takes its tasks with it, tasks that moved out of it must be moved first.
+    ('remove_cards', 'cards', REMOVES, ('remove_tasks', 'update_tasks', 'remove_preferences')),
+)
+
+
+class SyncReport(object):
+    """How long every batch took and in which wave it ran, times are from the start of the sync."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.steps = {}
+        # Steps the server confirmed, in the order they finished, and errors of the ones that failed.
+        self.completed = []
+        self.failed = {}
+
+    def to_json(self):
+        return {
+            'wall_time': (self.finished or time.monotonic()) - self.started,
+            'waves': max((step['wave'] for step in self.steps.values()), default=0),
+            'steps': self.steps,
+        }
+
+
+class SyncFailed(Exception):
+    """Raised once every batch that went out is done, report tells which of them went through."""
+
+    def __init__(self, error, report):
+        super().__init__(str(error))
+        self.error = error
+        self.report = report
+
+
+class SyncExecutor(object):
+    """
+    Runs SYNC_STEPS for changes (kind -> (updates, removes, adds), see ChangeSet.resolve()).
+    submit(func, *args) runs func on the pool and returns its future.
+    """
+
+    def __init__(self, submit, token, changes):
+        self.submit = submit
+        self.token = token
+        self.report = SyncReport()
+        self.future = Future()
+        self._lock = threading.Lock()
+        # Removes are rids, the rest are resources that go out in the form the server takes.
+        self._batches = {name: changes[kind][part] if part == REMOVES else
+                         [to_wire(resource) for resource in changes[kind][part]]
+                         for name, kind, part, _ in SYNC_STEPS}
+        self._dependencies = {name: dependencies for name, _, _, dependencies in SYNC_STEPS}
+        self._pending = {name for name, batch in self._batches.items() if batch}
+        self._running = set()
+        self._error = None
+        # Wave a finished step ran in, steps with nothing to send count as done before the first wave.
+        self._waves = {name: 0 for name in self._batches if name not in self._pending}
+
+    def start(self):
+        """Returns a future that's done once every batch is on the server, its result is the SyncReport."""
+        self._advance()
+        return self.future
+
+    def _advance(self):
+        with self._lock:
+            if self.future.done():
+                return
+            ready = [] if self._error is not None else \
+                [name for name in self._pending
+                 if all(dependency in self._waves for dependency in self._dependencies[name])]
+            for name in ready:
+                self._pending.discard(name)
+                self._running.add(name)
+            if not self._running and (self._error is not None or not self._pending):
+                self.report.finished = time.monotonic()
+                if self._error is not None:
+                    self.future.set_exception(SyncFailed(self._error, self.report))
+                else:
+                    self.future.set_result(self.report)
+                return
+        for idx, name in enumerate(ready):
+            wave = 1 + max((self._waves[dependency] for dependency in self._dependencies[name]), default=0)
+            started = time.monotonic()
+            try:
+                batch_future = self.submit(getattr(methods, name), self.token, self._batches[name])
+            except RuntimeError as error:
+                # Pool was shut down, neither this batch nor the ones after it go out.
+                with self._lock:
+                    self._running.difference_update(ready[idx:])
+                    if self._error is None:
+                        self._error = error
+                self._advance()
+                return
+            batch_future.add_done_callback(
+                lambda done, name=name, wave=wave, started=started: self._step_done(name, wave, started, done))
+
+    def _step_done(self, name, wave, started, done):
+        finished = time.monotonic()
+        error = done.exception()
+        with self._lock:
+            self._running.discard(name)
+            self.report.steps[name] = {
+                'items': len(self._batches[name]),
+                'wave': wave,
+                'started': started - self.report.started,
+                'time': finished - started,
+            }
+            if error is None:
+                self._waves[name] = wave
+                self.report.completed.append(name)
+            else:
+                self.report.failed[name] = error
+                if self._error is None:
+                    # Batches that already went out can't be taken back, nothing else is sent.
+                    self._error = error
+        self._advance()
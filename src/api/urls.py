@@ -12,7 +12,8 @@ urls = {
     'tasks': 'api/tasks/',
     'preferences': 'api/preferences/',
     'register': 'api/register/',
-    'authenticate': 'api/token-auth/'
+    'authenticate': 'api/token-auth/',
+    'merkle': 'api/merkle/',
 }
 
 prepend_domain(urls)
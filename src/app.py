@@ -4,6 +4,7 @@ from cards.widgets import CardWidget, CardWidgetManager, CardSidebar, SidebarCon
 from cards.models import CardsModel
 from widgets import SaveDialog, CredentialsScreen
 from storage import Storage
+from persistence.autosave import Autosave
 from shortcuts import set_shortcut
 
 
@@ -13,12 +14,18 @@ class AppWindow(QMainWindow):
         super().__init__(None)
         self.resize(width, height)
 
-        self.storage = Storage()
+        # Only the session file is read here, the rest is parsed once the window is shown.
+        self.storage = Storage(journaled=True, deferred=True)
         self.storage.debug = False
+        self.logged_in = False
+        self.card_model = None
+        self.autosave = None
 
         # Shortcuts
         set_shortcut('save', self.save, self)
         set_shortcut('quit', self.close, self)
+        set_shortcut('undo', self.undo, self)
+        set_shortcut('redo', self.redo, self)
         ###########
 
         self.cw = QWidget(self)  # central widget
@@ -36,22 +43,70 @@ class AppWindow(QMainWindow):
         self.show()
 
     def load(self):
-        self.storage.fetch_all()
-        card_model = CardsModel(self.storage)
-        sidebar = CardSidebar(card_model, parent=self.cw)
+        # Window is built empty, cards are added by the storage events once the state is loaded.
+        self.build()
+        self.cw.setEnabled(False)
+        self.storage.load_in_background(on_done=self.loaded)
+
+    def loaded(self):
+        self.storage.wait_loaded()
+        if self.storage.baseline and self._reconcile():
+            if self.storage.outbox:
+                # Operations the last session couldn't get through to the server.
+                self.storage.sync()
+        else:
+            try:
+                self.storage.fetch_all()
+            except RuntimeError as err:
+                # Outbox didn't get through, local state stays and the sync is retried.
+                print('Fetch skipped:', err)
+        self.logged_in = True
+        self.autosave = Autosave(self.storage)
+        self.cw.setEnabled(True)
+
+    def _reconcile(self):
+        # Synced before, only what diverged since then is transferred. Servers without
+        # the hash tree endpoints (or any other failure) get the full fetch instead.
+        try:
+            self.storage.reconcile()
+        except Exception as err:
+            print('Reconcile failed, fetching everything:', err)
+            return False
+        return True
+
+    def build(self):
+        self.card_model = CardsModel(self.storage)
+        sidebar = CardSidebar(self.card_model, parent=self.cw)
         sidebar.logout.connect(self.logout)
         self.sidebar_container = SidebarContainer(sidebar)
-        self.manager = CardWidgetManager(card_model, self.cw)
+        self.manager = CardWidgetManager(self.card_model, self.cw)
 
         self.layout.addWidget(self.sidebar_container)
         self.layout.addWidget(self.manager)
-        self.logged_in = True
+
+    def undo(self):
+        # Widgets follow the storage events, so only what the undo step changed is redrawn.
+        if self.logged_in:
+            self.storage.undo()
+
+    def redo(self):
+        if self.logged_in:
+            self.storage.redo()
 
     def clear_and_load(self):
         self.clear()
         self.load()
 
     def clear(self):
+        if self.autosave is not None:
+            self.autosave.stop()
+            print('Autosave metrics:', self.autosave.metrics.to_json())
+            self.autosave = None
+        if self.card_model is not None:
+            # Storage outlives the widgets, they must stop observing it.
+            self.manager.remove_all()
+            self.card_model.close()
+            self.card_model = None
         # TODO: test if takeAt(last index) is faster than takeAt(0)
         item = self.layout.takeAt(0)
         while item != None:
@@ -59,7 +114,8 @@ class AppWindow(QMainWindow):
             item = self.layout.takeAt(0)
 
     def logout(self):
-        if self.storage.saved is False:
+        # Autosave keeps the file up to date, it's the server that might be behind.
+        if self.storage.synced is False:
             dialog = SaveDialog(self)
             result = dialog.exec()
             if result == dialog.Accepted:
@@ -67,22 +123,27 @@ class AppWindow(QMainWindow):
             elif result == dialog.Canceled:
                 return
 
+        # Autosave gets stopped with the widgets, it must not save anything after the wipe.
+        self.clear()
         self.storage.wipe()
 
-        self.clear()
         creds_screen = CredentialsScreen(self.storage.authenticate, self.storage.register, parent=self.cw)
         creds_screen.logged_in.connect(self.clear_and_load)
         self.layout.addWidget(creds_screen)
         self.logged_in = False
 
     def closeEvent(self, event):
-        if self.storage.saved is False and self.logged_in is True:
+        if self.storage.synced is False and self.logged_in is True:
             dialog = SaveDialog(self)
             result = dialog.exec()
             if result == dialog.Accepted:
                 self.save()
             elif result == dialog.Canceled:
                 event.ignore()
+                return
+        if self.autosave is not None:
+            self.autosave.save()
+        print('Connection metrics:', self.storage.dispatcher.connection_stats())
 
     def save(self):
         self.storage.sync()
@@ -0,0 +1,56 @@
+"""
+Compares TaskSequence with a plain list on the operations storage does with tasks.
+
+    python -m benchmarks.sequence [max_exponent]
+"""
+import sys
+import random
+import timeit
+from utils.sequence import TaskSequence
+
+
+OPERATIONS = 1000
+
+
+def _bench(factory, size, operation):
+    seq = factory(range(size))
+    rng = random.Random(size)
+    indexes = [rng.randrange(size) for _ in range(OPERATIONS)]
+
+    def insert_pop():
+        for idx in indexes:
+            seq.insert(idx, -1)
+            seq.pop(idx)
+
+    def move():
+        for idx in indexes:
+            seq.insert(size - 1 - idx, seq.pop(idx))
+
+    def lookup():
+        for idx in indexes:
+            seq[idx]
+
+    def front():
+        for _ in indexes:
+            seq.insert(0, -1)
+        for _ in indexes:
+            seq.pop(0)
+
+    run = {'insert+pop': insert_pop, 'move': move, 'lookup': lookup, 'front': front}[operation]
+    # Per operation time in microseconds.
+    return min(timeit.repeat(run, number=1, repeat=3)) / OPERATIONS * 1e6
+
+
+def main(max_exponent=6):
+    print('{:>9} {:>11} {:>12} {:>12} {:>8}'.format('tasks', 'operation', 'list us/op', 'seq us/op', 'speedup'))
+    for exponent in range(3, max_exponent + 1):
+        size = 10 ** exponent
+        for operation in ('insert+pop', 'move', 'front', 'lookup'):
+            list_time = _bench(list, size, operation)
+            seq_time = _bench(TaskSequence, size, operation)
+            print('{:>9} {:>11} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+                size, operation, list_time, seq_time, list_time / seq_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 6)
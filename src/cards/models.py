@@ -1,22 +1,44 @@
 from storage import Storage
 from api.resources import CardResource, PreferenceResource
 from tasks.models import TasksModel
+from persistence.events import CardAdded, CardRemoved, CardUpdated, PreferenceChanged
 
 
 class CardsModel(object):
 
     def __init__(self, storage):
         self._st = storage
-        self._last_rid = None
         self._on_click_observers = []
+        self._on_add_observers = []
         self._on_remove_observers = []
+        self._on_update_observers = []
+        self._st.on_change(self.storage_changed)
 
     def on_click(self, observer):
         self._on_click_observers.append(observer)
 
+    def on_add(self, observer):
+        self._on_add_observers.append(observer)
+
     def on_remove(self, observer):
         self._on_remove_observers.append(observer)
 
+    def on_update(self, observer):
+        self._on_update_observers.append(observer)
+
+    def storage_changed(self, event):
+        # Cards come and go through storage, that's how undo and fetches reach the views too.
+        if isinstance(event, CardAdded):
+            self.notify_add(event.card_rid, event.index)
+        elif isinstance(event, CardRemoved):
+            self.notify_remove(event.card_rid)
+        elif isinstance(event, CardUpdated):
+            self.notify_update(event.card_rid, event.index)
+
+    def notify_add(self, card_rid, index):
+        for observer in self._on_add_observers:
+            observer(card_rid, index)
+
     def notify_show(self, card_rid):
         for observer in self._on_click_observers:
             observer(card_rid)
@@ -25,6 +47,10 @@ class CardsModel(object):
         for observer in self._on_remove_observers:
             observer(card_rid)
 
+    def notify_update(self, card_rid, index):
+        for observer in self._on_update_observers:
+            observer(card_rid, index)
+
     def cards(self):
         return [(card.rid, card.name) for card in self._st.cards]
 
@@ -32,53 +58,43 @@ class CardsModel(object):
         return self._st.get_card(card_rid).name
 
     def add_card(self, card_name):
-        new_rid = self._get_new_rid()
-        num_cards = len(self._st.cards)
-        card = CardResource(rid=new_rid, name=card_name, position=num_cards)
-        self._st.add_card(card)
-        pref_rid = self._get_new_pref_rid()
+        new_rid = self._st.new_rid('cards')
+        card = CardResource(rid=new_rid, name=card_name)
+        pref_rid = self._st.new_rid('preferences')
         pref = PreferenceResource(rid=pref_rid, card_rid=new_rid, warning_time=0,
                                   danger_time=0, show_date=False)
-        self._st.add_preference(new_rid, pref)
+        with self._st.undo_step():
+            self._st.add_card(card)
+            self._st.add_preference(new_rid, pref)
         return new_rid
 
     def remove_card(self, card_rid):
         self._st.remove_card(card_rid)
-        self.notify_remove(card_rid)
 
     def show_card(self, card_rid):
         self.notify_show(card_rid)
 
     def update_card(self, card_rid, new_card_name):
-        self._cards_map[card_rid].name = new_card_name
-        self._storage.update_card(self._cards_map[card_rid])
-
-    def _get_new_rid(self):
-        new_rid = self._last_rid + 1 if self._last_rid else 1
-        while True:
-            if new_rid in self._st.card_rids:
-                new_rid += 1
-            else:
-                return new_rid
-
-    def _get_new_pref_rid(self):
-        new_rid = 0
-        while True:
-            if new_rid in self._st.preference_rids:
-                new_rid += 1
-            else:
-                return new_rid
+        card = self._st.get_card(card_rid)
+        self._st.update_card(card_rid, card.replace(name=new_card_name))
 
     def get_task_model(self, card_rid):
+        self._st.open_card(card_rid)
         return TasksModel(self._st, card_rid)
 
+    def close_card(self, card_rid):
+        self._st.close_card(card_rid)
+
+    def close(self):
+        self._st.remove_observer(self.storage_changed)
+
     def get_card_preferences(self, card_rid):
         return PreferencesModel(self._st, card_rid)
 
     def transfer_task(self, from_crid, to_crid, from_idx, to_idx):
-        task = self._st.pop_task(from_crid, from_idx)
-        task.card_rid = to_crid
-        self._st.insert_task(to_crid, to_idx, task)
+        with self._st.undo_step():
+            task = self._st.pop_task(from_crid, from_idx)
+            self._st.insert_task(to_crid, to_idx, task.replace(card_rid=to_crid))
 
 
 class PreferencesModel(object):
@@ -86,6 +102,27 @@ class PreferencesModel(object):
     def __init__(self, storage, card_rid):
         self._st = storage
         self.crid = card_rid
+        self._on_change_observers = []
+        self._st.on_change(self.notify_change, card_rid)
+
+    def on_change(self, observer):
+        # observer(changed) gets names of the changed fields.
+        self._on_change_observers.append(observer)
+
+    def notify_change(self, event):
+        if not isinstance(event, PreferenceChanged):
+            return
+        for observer in self._on_change_observers:
+            observer(event.changed)
+
+    def close(self):
+        self._st.remove_observer(self.notify_change, self.crid)
+        self._on_change_observers.clear()
+
+    def update(self, **fields):
+        """Changes several fields at once, as a single undo step."""
+        pref = self._st.get_preference(self.crid)
+        self._st.replace_preference(self.crid, pref.replace(**fields))
 
     @property
     def show_date(self):
@@ -11,6 +11,7 @@ from tasks.models import TasksModel
 from tasks.actions import Action
 from resources.manager import resource
 from cards.preferences import Preferences
+from persistence.events import TaskInserted, TaskRemoved, TaskMoved, TaskUpdated
 
 import time
 import datetime
@@ -23,6 +24,7 @@ class CardWidgetManager(QScrollArea):
         self.model = card_model
         self.model.on_click(self.show_or_remove)
         self.model.on_remove(self.remove_if_exists)
+        self.model.on_update(self.update_if_exists)
 
         self.mwidget = QWidget()
         self.mlayout = QHBoxLayout()
@@ -33,6 +35,7 @@ class CardWidgetManager(QScrollArea):
         self.setFrameShape(QScrollArea.NoFrame)
 
         self._active_cards = {}
+        self._card_actions = {}
 
         self.drag_index = None
         self.drag_source = None
@@ -47,6 +50,11 @@ class CardWidgetManager(QScrollArea):
         if card_rid in self._active_cards:
             self.remove_card(card_rid)
 
+    def update_if_exists(self, card_rid, index):
+        # Card can be renamed by undo or by the server while it's open.
+        if card_rid in self._card_actions:
+            self._card_actions[card_rid].card_updated(self.model.get_name(card_rid))
+
     def remove_card(self, card_rid):
         card_widget = self._active_cards[card_rid]
         self.mlayout.removeWidget(card_widget)
@@ -57,6 +65,13 @@ class CardWidgetManager(QScrollArea):
         #   will hold both card_widget and card_actions.
         card_widget.parent().deleteLater()
         self._active_cards.pop(card_rid)
+        self._card_actions.pop(card_rid)
+        card_widget.close_models()
+        self.model.close_card(card_rid)
+
+    def remove_all(self):
+        for card_rid in list(self._active_cards):
+            self.remove_card(card_rid)
 
     def show_card(self, card_rid):
         container = QWidget(self)
@@ -75,6 +90,7 @@ class CardWidgetManager(QScrollArea):
         container.setFixedWidth(300)
 
         self._active_cards[card_rid] = card_widget
+        self._card_actions[card_rid] = card_actions
         self.mlayout.addWidget(container)
         card_widget.load()
 
@@ -89,12 +105,9 @@ class CardWidgetManager(QScrollArea):
             drop_source.move_task(self.drag_index, drop_index)
             return
 
-        # it's very important to transfer tasks before we call view methods
-        # because view methods relly on models to do their job properly
+        # Both cards update their widgets from the storage events.
         self.model.transfer_task(self.drag_source.rid, drop_source.rid,
                                  self.drag_index, drop_index)
-        self.drag_source.pop_widget(self.drag_index)
-        drop_source.insert_widget(drop_index)
 
     def _fix_drop_offset(self, drop_index, indicator):
         if self.drag_index < drop_index:
@@ -155,23 +168,9 @@ class CardWidget(QWidget):
         action_edit.signal.connect(self.run_edit_task_dialog)
         self.actions = [action_remove, action_edit]
 
-        show_date = self.pmodel.show_date
-
-        warning_time = self.pmodel.warning_time
-        danger_time = self.pmodel.danger_time
         current_time = datetime.datetime.now().timestamp()
-
         for rid, text, created in self.tmodel.data():
-            icon = None
-            if danger_time and created + danger_time <= current_time:
-                icon = self._danger_icon
-            elif warning_time and created + warning_time <= current_time:
-                icon = self._warning_icon
-
-            if show_date:
-                dt = datetime.datetime.fromtimestamp(created)
-                text = "{}\n({}.{}.{} {}:{})".format(text, dt.day, dt.month, dt.year, dt.hour, dt.minute)
-
+            text, icon = self.task_display(text, created, current_time)
             task_widget = TaskWidget(rid, text, self.actions, icon)
             item = QListWidgetItem()
             item.setSizeHint(task_widget.sizeHint())
@@ -180,75 +179,88 @@ class CardWidget(QWidget):
 
             QApplication.processEvents()
 
+        # From now on widgets follow the models, only the rows that changed are touched.
+        self.tmodel.on_change(self.task_changed)
+        self.pmodel.on_change(self.preferences_changed)
+
         t2 = time.perf_counter()
         print('Time took:', t2 - t1)
 
-    def reload(self):
-        self.lw.clear()
-        self.load()
+    def close_models(self):
+        self.tmodel.close()
+        self.pmodel.close()
+
+    def task_display(self, text, created, current_time=None):
+        """Returns text and icon of a task widget, as the card preferences say."""
+        if self.pmodel.show_date:
+            dt = datetime.datetime.fromtimestamp(created)
+            text = "{}\n({}.{}.{} {}:{})".format(text, dt.day, dt.month, dt.year, dt.hour, dt.minute)
+
+        if current_time is None:
+            current_time = datetime.datetime.now().timestamp()
+        icon = None
+        danger_time = self.pmodel.danger_time
+        warning_time = self.pmodel.warning_time
+        if danger_time and created + danger_time <= current_time:
+            icon = self._danger_icon
+        elif warning_time and created + warning_time <= current_time:
+            icon = self._warning_icon
+        return text, icon
+
+    def task_changed(self, event):
+        if isinstance(event, TaskInserted):
+            self.insert_widget(event.index, event.task)
+        elif isinstance(event, TaskRemoved):
+            self.lw.takeItem(event.index)
+        elif isinstance(event, TaskMoved):
+            self.lw.takeItem(event.old_index)
+            self.insert_widget(event.new_index, event.task)
+        elif isinstance(event, TaskUpdated):
+            self.update_widget(event.index, event.task)
+
+    def preferences_changed(self, changed):
+        # Widgets are updated in place, none of them is created again.
+        if not {'show_date', 'warning_time', 'danger_time'}.intersection(changed):
+            return
+        current_time = datetime.datetime.now().timestamp()
+        for idx, (rid, text, created) in enumerate(self.tmodel.data()):
+            item = self.lw.item(idx)
+            widget = self.lw.itemWidget(item)
+            text, icon = self.task_display(text, created, current_time)
+            widget.set_text(text)
+            widget.set_icon(icon)
+            item.setSizeHint(widget.sizeHint())
 
     def remove_task(self, pos):
         idx = self.lw.indexAt(self.lw.mapFromGlobal(pos)).row()
-        item = self.lw.takeItem(idx)
-        del item
         self.tmodel.remove(idx)
 
     def get_task(self, index):
         return self.tmodel[index]
 
     def pop_task(self, index):
-        item = self.lw.takeItem(index)
-        del item
         return self.tmodel.remove(index)
 
-    def pop_widget(self, index):
-        item = self.lw.item(index)
-        widget = self.lw.itemWidget(item)
-        self.lw.takeItem(index)
-        return widget
-
-    def insert_widget(self, index):
-        rid, text, created = self.tmodel.data(index)
-
-        if self.pmodel.show_date:
-            dt = datetime.datetime.fromtimestamp(created)
-            text = "{}\n({}.{}.{} {}:{})".format(text, dt.day, dt.month, dt.year, dt.hour, dt.minute)
-
-        dtime = self.pmodel.danger_time
-        wtime = self.pmodel.warning_time
-        icon = None
-        now = datetime.datetime.now().timestamp()
-        if dtime and dtime + created <= now:
-            icon = self._danger_icon
-        elif wtime and wtime + created <= now:
-            icon = self._warning_icon
-
-        task_widget = TaskWidget(rid, text, self.actions, icon)
+    def insert_widget(self, index, task):
+        text, icon = self.task_display(task.description, task.created)
+        task_widget = TaskWidget(task.rid, text, self.actions, icon)
         item = QListWidgetItem()
         item.setSizeHint(task_widget.sizeHint())
         self.lw.insertItem(index, item)
         self.lw.setItemWidget(item, task_widget)
 
-    def move_task(self, from_idx, to_idx):
-        item = self.lw.item(from_idx)
+    def update_widget(self, index, task):
+        item = self.lw.item(index)
         widget = self.lw.itemWidget(item)
-        text = widget.label.text()
-        if widget.icon_btn:
-            icon = widget.icon_btn.icon()
-        else:
-            icon = None
-        rid, _, _ = self.tmodel.data(from_idx)
-        widget = TaskWidget(rid, text, self.actions, icon)
-        self.lw.takeItem(from_idx)
+        text, icon = self.task_display(task.description, task.created)
+        widget.rid = task.rid
+        widget.set_text(text)
+        widget.set_icon(icon)
+        item.setSizeHint(widget.sizeHint())
 
+    def move_task(self, from_idx, to_idx):
         self.tmodel.move(from_idx, to_idx)
 
-        item = QListWidgetItem()
-        item.setSizeHint(widget.sizeHint())
-        self.lw.insertItem(to_idx, item)
-        self.lw.setItemWidget(item, widget)
-        x = 42
-
     def turn_on_selection(self):
         self.lw.setSelectionMode(QAbstractItemView.NoSelection)
         self.lw.clearSelection()
@@ -278,26 +290,7 @@ class CardWidget(QWidget):
 
     def add_task(self, text):
         created = datetime.datetime.now().timestamp()
-        rid = self.tmodel.add(text, created)
-
-        if self.pmodel.show_date:
-            dt = datetime.datetime.fromtimestamp(created)
-            text = "{}\n({}.{}.{} {}:{})".format(text, dt.day, dt.month, dt.year, dt.hour, dt.minute)
-
-        icon = None
-        wtime = self.pmodel.warning_time
-        dtime = self.pmodel.danger_time
-        current_time = datetime.datetime.now().timestamp()
-        if dtime and created + dtime <= current_time:
-            icon = self._danger_icon
-        elif wtime and created + wtime <= current_time:
-            icon = self._warning_icon
-
-        task_widget = TaskWidget(rid, text, self.actions, icon)
-        item = QListWidgetItem()
-        item.setSizeHint(task_widget.sizeHint())
-        self.lw.addItem(item)
-        self.lw.setItemWidget(item, task_widget)
+        self.tmodel.add(text, created)
 
     def run_edit_task_dialog(self, pos):
         index = self.lw.indexAt(self.lw.mapFromGlobal(pos)).row()
@@ -309,15 +302,6 @@ class CardWidget(QWidget):
 
     def edit_task(self, index, description, created_at):
         self.tmodel.update(index, description, created_at)
-        item = self.lw.item(index)
-        widget = self.lw.itemWidget(item)
-        if self.pmodel.show_date:
-            dt = datetime.datetime.fromtimestamp(created_at)
-            content = "{}\n({}.{}.{} {}:{})".format(description, dt.day, dt.month, dt.year, dt.hour, dt.minute)
-        else:
-            content = description
-        widget.set_text(content)
-        item.setSizeHint(widget.sizeHint())
 
 
 class CustomListWidget(QListWidget):
@@ -411,6 +395,10 @@ class CardActions(QWidget):
         layout.addStretch(1)
         self.setLayout(layout)
 
+    def card_updated(self, card_name):
+        self.card_widget.name = card_name
+        self.cardname_lbl.setText(card_name)
+
     def selection_triggered(self):
         if not self.selection_flag:
             self.card_widget.turn_on_selection()
@@ -430,12 +418,9 @@ class CardActions(QWidget):
         dialog.accepted.connect(self.card_widget.add_task)
         dialog.exec_()
 
-    def preferences_changed(self):
-        self.card_widget.reload()
-
     def run_preferences_dialog(self):
+        # Card widget follows preference changes by itself.
         dialog = PreferencesDialog(self.card_widget.pmodel)
-        dialog.accepted.connect(self.preferences_changed)
         dialog.exec_()
 
 
@@ -446,6 +431,9 @@ class CardSidebar(Sidebar):
 
     def __init__(self, model, max_size=100, parent=None):
         super().__init__(model, max_size, parent)
+        self.model.on_add(self.card_added)
+        self.model.on_remove(self.remove_widget)
+        self.model.on_update(self.card_updated)
 
     def load(self):
         print('IN CardSidebar > load')
@@ -463,13 +451,20 @@ class CardSidebar(Sidebar):
         self.model.show_card(card_rid)
 
     def remove(self, card_rid):
+        # Widget is removed when the model says the card is gone.
         self.model.remove_card(card_rid)
-        self.remove_widget(card_rid)
 
     def create(self, card_name):
-        card_rid = self.model.add_card(card_name)
-        wgt = self.create_widget(card_rid, card_name)
-        self.add_widget(wgt)
+        self.model.add_card(card_name)
+
+    def card_added(self, card_rid, index):
+        wgt = self.create_widget(card_rid, self.model.get_name(card_rid))
+        self.insert_widget(index, wgt)
+
+    def card_updated(self, card_rid, index):
+        # Name or place changed, widget is made again in the new place.
+        self.remove_widget(card_rid)
+        self.card_added(card_rid, index)
 
 
 class SidebarContainer(QWidget):
@@ -647,9 +642,8 @@ class PreferencesDialog(QDialog):
     def accept(self):
         wtime = self.warning_time.seconds()
         dtime = self.danger_time.seconds()
-        self.pmodel.warning_time = wtime
-        self.pmodel.danger_time = dtime
-        self.pmodel.show_date = self.show_date_checkbox.isChecked()
+        self.pmodel.update(warning_time=wtime, danger_time=dtime,
+                           show_date=self.show_date_checkbox.isChecked())
         self.accepted.emit()
         super().accept()
 
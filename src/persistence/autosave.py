@@ -0,0 +1,108 @@
+import time
+from PyQt5.QtCore import QTimer
+
+
+# Save once there were no changes for this many seconds...
+AUTOSAVE_DEBOUNCE = 2.0
+# ...but never leave a change unsaved for longer than this.
+AUTOSAVE_MAX_STALENESS = 30.0
+
+
+class Autosave(object):
+    """
+    Saves storage some time after it changes.
+
+    Every mutation restarts a single shot timer, so a burst of edits ends up in one save
+    once the user pauses for debounce seconds. Timer never runs past max_staleness seconds
+    from the first unsaved change, so a user who never pauses still gets saves that often.
+    Storage.save() only takes a snapshot on the GUI thread, it is serialized and written
+    by the storage writer thread (journaled storage only has to fsync the journal).
+    """
+
+    def __init__(self, storage, debounce=AUTOSAVE_DEBOUNCE, max_staleness=AUTOSAVE_MAX_STALENESS):
+        self._st = storage
+        self.debounce = debounce
+        self.max_staleness = max_staleness
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.save)
+        # Time of the first change since the last save, None while everything is saved.
+        self._dirty_since = None
+        self.metrics = AutosaveMetrics(storage)
+        self._st.on_mutation(self.mutated)
+
+    def mutated(self):
+        now = time.monotonic()
+        self.metrics.mutations += 1
+        if self._dirty_since is None:
+            self._dirty_since = now
+        delay = min(self.debounce, self._dirty_since + self.max_staleness - now)
+        self._timer.start(max(0, int(delay * 1000)))
+
+    def save(self):
+        self._timer.stop()
+        if self._dirty_since is None:
+            return
+        if self._st.saved:
+            # Somebody else saved in the meantime.
+            self._dirty_since = None
+            return
+        started = time.monotonic()
+        self._st.save()
+        finished = time.monotonic()
+        self.metrics.record(started - self._dirty_since, finished - started, finished)
+        self._dirty_since = None
+
+    def stop(self):
+        """Saves pending changes right away and stops watching storage."""
+        self._st.remove_mutation_observer(self.mutated)
+        self.save()
+
+
+class AutosaveMetrics(object):
+    """How often autosave saves and what it costs, for tuning debounce and staleness."""
+
+    def __init__(self, storage):
+        self._st = storage
+        self.created = time.monotonic()
+        self.mutations = 0
+        self.saves = 0
+        # Time a change waited to be saved, from the first unsaved change to the save.
+        self.staleness = 0.0
+        self.max_staleness = 0.0
+        # Time save() took on the GUI thread.
+        self.save_time = 0.0
+        self.max_save_time = 0.0
+        self._last_save = None
+        self.intervals = 0.0
+        journal = storage.journal
+        self._journal_start = journal.bytes_written if journal else 0
+
+    def record(self, staleness, save_time, now):
+        self.saves += 1
+        self.staleness += staleness
+        self.max_staleness = max(self.max_staleness, staleness)
+        self.save_time += save_time
+        self.max_save_time = max(self.max_save_time, save_time)
+        if self._last_save is not None:
+            self.intervals += now - self._last_save
+        self._last_save = now
+
+    def to_json(self):
+        elapsed = time.monotonic() - self.created
+        journal = self._st.journal
+        output = {
+            'mutations': self.mutations,
+            'saves': self.saves,
+            'saves_per_minute': 60 * self.saves / elapsed if elapsed else 0.0,
+            'mutations_per_save': self.mutations / self.saves if self.saves else 0.0,
+            'mean_interval': self.intervals / (self.saves - 1) if self.saves > 1 else 0.0,
+            'mean_staleness': self.staleness / self.saves if self.saves else 0.0,
+            'max_staleness': self.max_staleness,
+            'mean_save_time': self.save_time / self.saves if self.saves else 0.0,
+            'max_save_time': self.max_save_time,
+            'journal_bytes': journal.bytes_written - self._journal_start if journal else 0,
+        }
+        # Bytes and latency of the snapshot writes themselves, including ones autosave didn't ask for.
+        output['writer'] = self._st.writer.stats.to_json()
+        return output
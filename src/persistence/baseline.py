@@ -0,0 +1,128 @@
+import json
+import struct
+from hashlib import blake2b
+
+
+# Next to the storage file, fingerprints of the state the server had after the last sync.
+BASELINE_SUFFIX = ".baseline"
+BASELINE_MAGIC = b'WTSB'
+BASELINE_VERSION = 2
+KINDS = ('cards', 'tasks', 'preferences')
+# 64 bits are plenty to tell two versions of the same resource apart.
+DIGEST_SIZE = 8
+
+_HEADER = struct.Struct('<4sBQ3I')
+_ENTRY = struct.Struct('<q{}s'.format(DIGEST_SIZE))
+
+
+def fingerprint(resource):
+    """Hash of the resource dict, equal resources have equal fingerprints whatever the key order."""
+    text = json.dumps(resource, sort_keys=True, separators=(',', ':'))
+    return blake2b(text.encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+
+def _resources(data, kind):
+    # Snapshots hand out resource dicts without copying them, plain dicts are lists already.
+    if hasattr(data, 'resources'):
+        return data.resources(kind)
+    return data[kind]
+
+
+class SyncBaseline(object):
+    """
+    What the server has, as rid -> fingerprint of every card, task and preference.
+
+    It's 16 bytes a resource on disk and replaces the copy of the last synchronized
+    state, diff() needs only the current state to tell what changed since then.
+    Generation goes up with every applied sync, change sets written next to the
+    snapshot remember the generation they were recorded against.
+    """
+
+    def __init__(self, fingerprints=None, generation=0):
+        self.fingerprints = fingerprints if fingerprints is not None else {kind: {} for kind in KINDS}
+        self.generation = generation
+
+    @classmethod
+    def from_data(cls, data, generation=0):
+        """Baseline of data, a snapshot or a dict of resource lists like the storage file."""
+        return cls({kind: {res['rid']: fingerprint(res) for res in _resources(data, kind)} for kind in KINDS},
+                   generation)
+
+    def __contains__(self, kind_rid):
+        kind, rid = kind_rid
+        return rid in self.fingerprints[kind]
+
+    def diff(self, data):
+        """
+        Compares current state against the baseline in one pass over it.
+        Returns changes as kind -> (updates, removed rids, adds), and fingerprint
+        updates that turn the baseline into the baseline of data, see apply().
+        """
+        changes = {}
+        fingerprint_updates = {}
+        for kind in KINDS:
+            old = self.fingerprints[kind]
+            current = set()
+            kind_updates = fingerprint_updates[kind] = {}
+            updates = []
+            adds = []
+            for res in _resources(data, kind):
+                fp = fingerprint(res)
+                current.add(res['rid'])
+                old_fp = old.get(res['rid'])
+                if old_fp is None:
+                    adds.append(res)
+                elif old_fp != fp:
+                    updates.append(res)
+                else:
+                    continue
+                kind_updates[res['rid']] = fp
+            removes = [rid for rid in old if rid not in current]
+            kind_updates.update((rid, None) for rid in removes)
+            changes[kind] = (updates, removes, adds)
+        return changes, fingerprint_updates
+
+    def apply(self, fingerprint_updates):
+        """Takes kind -> {rid: fingerprint, or None if the resource is gone}."""
+        for kind, kind_updates in fingerprint_updates.items():
+            fingerprints = self.fingerprints[kind]
+            for rid, fp in kind_updates.items():
+                if fp is None:
+                    fingerprints.pop(rid, None)
+                else:
+                    fingerprints[rid] = fp
+        self.generation += 1
+
+    def copy(self):
+        return SyncBaseline({kind: dict(fingerprints) for kind, fingerprints in self.fingerprints.items()},
+                            self.generation)
+
+    def __len__(self):
+        return sum(len(fingerprints) for fingerprints in self.fingerprints.values())
+
+    def to_bytes(self):
+        parts = [_HEADER.pack(BASELINE_MAGIC, BASELINE_VERSION, self.generation,
+                              *(len(self.fingerprints[kind]) for kind in KINDS))]
+        for kind in KINDS:
+            parts.extend(_ENTRY.pack(rid, fp) for rid, fp in self.fingerprints[kind].items())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, raw):
+        if len(raw) < _HEADER.size or raw[:len(BASELINE_MAGIC)] != BASELINE_MAGIC:
+            raise ValueError("Not a sync baseline.")
+        magic, version, generation, *counts = _HEADER.unpack_from(raw)
+        if version != BASELINE_VERSION:
+            raise ValueError("Unsupported sync baseline version {}.".format(version))
+        fingerprints = {}
+        offset = _HEADER.size
+        for kind, count in zip(KINDS, counts):
+            end = offset + count * _ENTRY.size
+            fingerprints[kind] = dict(_ENTRY.iter_unpack(raw[offset:end]))
+            offset = end
+        return cls(fingerprints, generation)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
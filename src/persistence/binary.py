@@ -0,0 +1,244 @@
+"""
+Compact binary storage format.
+
+    magic 'WTDB' | version u16 | flags u16
+    meta       u32 length + JSON (token, rids, journal_seq, changes)
+    strings    u32 count, then u32 length + utf-8 bytes for every string
+    cards      u32 count, then CARD records
+    prefs      u32 count, then PREFERENCE records
+    segments   u32 count, then q card_rid | u32 length | task segment
+
+Every card's tasks are a self-contained segment with its own string table
+(task descriptions and positions), so a segment can be kept as is while the card isn't
+touched and reused on the next save without encoding it again.
+
+    segment    u32 count | strings | TASK records
+
+Positions are keys (see utils.positions) kept in the string tables, position
+None is stored as string index 0xFFFFFFFF. Version 1 stored integer positions,
+its files are still read, their positions come out as None and storage gives
+them fresh keys in the stored order.
+
+All integers are little endian.
+"""
+import sys
+import json
+import struct
+from persistence import compression
+from persistence.loader import iter_items
+
+
+MAGIC = b'WTDB'
+VERSION = 2
+NO_STRING = 0xFFFFFFFF
+
+HEADER = struct.Struct('<4sHH')
+COUNT = struct.Struct('<I')
+SEGMENT_HEADER = struct.Struct('<qI')
+# rid, name string index, position string index
+CARD = struct.Struct('<qII')
+# rid, card_rid, warning_time, danger_time, show_date
+PREFERENCE = struct.Struct('<qqqq?')
+# rid, card_rid, created, description string index, position string index
+TASK = struct.Struct('<qqdII')
+# Version 1 records had integer positions.
+CARD_V1 = struct.Struct('<qqI')
+TASK_V1 = struct.Struct('<qqqdI')
+
+
+def is_binary(head):
+    return head[:len(MAGIC)] == MAGIC
+
+
+def _encode_strings(strings):
+    parts = [COUNT.pack(len(strings))]
+    for s in strings:
+        raw = s.encode('utf-8')
+        parts.append(COUNT.pack(len(raw)))
+        parts.append(raw)
+    return b''.join(parts)
+
+
+def _decode_strings(data, offset):
+    count, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    strings = []
+    for _ in range(count):
+        length, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        strings.append(bytes(data[offset:offset + length]).decode('utf-8'))
+        offset += length
+    return strings, offset
+
+
+def _add_string(strings, s):
+    if not isinstance(s, str):
+        return NO_STRING
+    strings.append(s)
+    return len(strings) - 1
+
+
+def _get_string(strings, idx):
+    return strings[idx] if idx != NO_STRING else None
+
+
+def encode_tasks(task_dicts):
+    strings = []
+    records = []
+    for t in task_dicts:
+        description = _add_string(strings, t['description'])
+        position = _add_string(strings, t['position'])
+        records.append(TASK.pack(t['rid'], t['card_rid'], t['created'], description, position))
+    return COUNT.pack(len(records)) + _encode_strings(strings) + b''.join(records)
+
+
+def decode_tasks(segment):
+    if not segment:
+        return []
+    count, = COUNT.unpack_from(segment, 0)
+    strings, offset = _decode_strings(segment, COUNT.size)
+    tasks = []
+    for rid, card_rid, created, description, position in TASK.iter_unpack(
+            segment[offset:offset + count * TASK.size]):
+        tasks.append({
+            'rid': rid, 'description': strings[description],
+            'position': _get_string(strings, position),
+            'card_rid': card_rid, 'created': created,
+        })
+    return tasks
+
+
+def _upgrade_segment_v1(segment):
+    if not segment:
+        return segment
+    count, = COUNT.unpack_from(segment, 0)
+    descriptions, offset = _decode_strings(segment, COUNT.size)
+    tasks = [{'rid': rid, 'description': descriptions[description], 'position': None,
+              'card_rid': card_rid, 'created': created}
+             for rid, _, card_rid, created, description in TASK_V1.iter_unpack(
+                 segment[offset:offset + count * TASK_V1.size])]
+    return encode_tasks(tasks)
+
+
+def task_rids(segment):
+    """Rids of the tasks in the segment, without decoding their descriptions."""
+    if not segment:
+        return []
+    count, = COUNT.unpack_from(segment, 0)
+    _, offset = _decode_strings(segment, COUNT.size)
+    return [record[0] for record in TASK.iter_unpack(segment[offset:offset + count * TASK.size])]
+
+
+def encode_snapshot(cards, preferences, meta, segments):
+    """
+    cards and preferences are lists of resource dicts, segments is a list
+    of (card_rid, segment) pairs, with segments already encoded by encode_tasks.
+    """
+    return b''.join(encode_snapshot_parts(cards, preferences, meta, segments))
+
+
+def encode_snapshot_parts(cards, preferences, meta, segments):
+    """Same as encode_snapshot, but the snapshot is returned as a tuple of byte strings."""
+    names = []
+    card_records = []
+    for c in cards:
+        name = _add_string(names, c['name'])
+        card_records.append(CARD.pack(c['rid'], name, _add_string(names, c['position'])))
+    pref_records = [PREFERENCE.pack(p['rid'], p['card_rid'], p['warning_time'], p['danger_time'], p['show_date'])
+                    for p in preferences]
+    raw_meta = json.dumps(meta).encode('utf-8')
+    parts = [
+        HEADER.pack(MAGIC, VERSION, 0),
+        COUNT.pack(len(raw_meta)), raw_meta,
+        _encode_strings(names),
+        COUNT.pack(len(card_records)), b''.join(card_records),
+        COUNT.pack(len(pref_records)), b''.join(pref_records),
+        COUNT.pack(len(segments)),
+    ]
+    for card_rid, segment in segments:
+        parts.append(SEGMENT_HEADER.pack(card_rid, len(segment)))
+        parts.append(segment)
+    return tuple(parts)
+
+
+def decode_snapshot(data):
+    """Returns (cards, preferences, meta, segments), segments are left encoded."""
+    magic, version, _ = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a binary storage file.")
+    if version not in (1, VERSION):
+        raise ValueError("Unsupported binary storage version {}.".format(version))
+    offset = HEADER.size
+    length, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    meta = json.loads(bytes(data[offset:offset + length]).decode('utf-8'))
+    offset += length
+    names, offset = _decode_strings(data, offset)
+
+    count, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    if version == 1:
+        cards = [{'rid': rid, 'name': names[name], 'position': None}
+                 for rid, _, name in CARD_V1.iter_unpack(data[offset:offset + count * CARD_V1.size])]
+        offset += count * CARD_V1.size
+    else:
+        cards = [{'rid': rid, 'name': names[name], 'position': _get_string(names, position)}
+                 for rid, name, position in CARD.iter_unpack(data[offset:offset + count * CARD.size])]
+        offset += count * CARD.size
+
+    count, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    preferences = [{'rid': rid, 'card_rid': card_rid, 'warning_time': warning_time,
+                    'danger_time': danger_time, 'show_date': show_date}
+                   for rid, card_rid, warning_time, danger_time, show_date in
+                   PREFERENCE.iter_unpack(data[offset:offset + count * PREFERENCE.size])]
+    offset += count * PREFERENCE.size
+
+    count, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    segments = {}
+    for _ in range(count):
+        card_rid, length = SEGMENT_HEADER.unpack_from(data, offset)
+        offset += SEGMENT_HEADER.size
+        segments[card_rid] = bytes(data[offset:offset + length])
+        if version == 1:
+            segments[card_rid] = _upgrade_segment_v1(segments[card_rid])
+        offset += length
+    return cards, preferences, meta, segments
+
+
+def decode_data(data):
+    """Decode the whole snapshot into the same dict json storage file holds."""
+    cards, preferences, meta, segments = decode_snapshot(data)
+    tasks = []
+    for card in cards:
+        tasks.extend(decode_tasks(segments.get(card['rid'], b'')))
+    output = {'cards': cards, 'tasks': tasks, 'preferences': preferences}
+    output.update(meta)
+    return output
+
+
+def convert_file(json_path, binary_path):
+    """One shot conversion of a json storage file into the binary format."""
+    data = {'cards': [], 'preferences': []}
+    tasks = {}
+    meta = {'token': None}
+    # Source can be a compressed storage file too.
+    with compression.open_text(json_path) as f:
+        for key, value, _ in iter_items(f):
+            if key in ('cards', 'preferences'):
+                data[key].append(value)
+            elif key == 'tasks':
+                tasks.setdefault(value['card_rid'], []).append(value)
+            else:
+                meta[key] = value
+    segments = [(card['rid'], encode_tasks(tasks.get(card['rid'], []))) for card in data['cards']]
+    with open(binary_path, 'wb') as f:
+        f.write(encode_snapshot(data['cards'], data['preferences'], meta, segments))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python -m persistence.binary storage.json storage.bin')
+        sys.exit(1)
+    convert_file(sys.argv[1], sys.argv[2])
@@ -0,0 +1,185 @@
+from api.resources import CardResource, TaskResource, PreferenceResource
+from persistence import events
+from persistence.baseline import KINDS, fingerprint
+
+
+CREATED = 'created'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+
+RESOURCE_TYPES = {'cards': CardResource, 'tasks': TaskResource, 'preferences': PreferenceResource}
+
+
+class Change(object):
+    __slots__ = ('state', 'fields', 'resource')
+
+    def __init__(self, state, fields=None, resource=None):
+        self.state = state
+        # Names of modified fields, None means all of them.
+        self.fields = fields
+        # Latest version of the resource, None once it's deleted.
+        self.resource = resource
+
+
+class ChangeSet(object):
+    """
+    Resources changed since the last sync, one Change per rid.
+
+    Storage records events of every mutation here and changes are collapsed as they
+    come in, rids the server has (the ones in the baseline) can be modified or deleted,
+    other rids can only be created, so creating and then deleting a task leaves nothing
+    behind. resolve() costs as much as the number of changed rids, sync never has to
+    look at the rest of the state.
+    Set that isn't complete missed some changes, sync has to diff the whole state then.
+    It's written into every snapshot, so it's always in step with the state on disk.
+    """
+
+    def __init__(self, baseline, complete=True):
+        self.baseline = baseline
+        self.complete = complete
+        self.changes = {kind: {} for kind in KINDS}
+
+    def __len__(self):
+        return sum(len(changes) for changes in self.changes.values())
+
+    def resources(self, kind):
+        """Latest versions of the resources of the kind that were created or modified."""
+        return [change.resource for change in self.changes[kind].values() if change.resource is not None]
+
+    def upsert(self, kind, resource, fields=None):
+        """Resource was created, or fields of it were modified."""
+        change = self.changes[kind].get(resource.rid)
+        if (kind, resource.rid) not in self.baseline:
+            self.changes[kind][resource.rid] = Change(CREATED, None, resource)
+        elif change is None:
+            self.changes[kind][resource.rid] = Change(MODIFIED, set(fields) if fields else None, resource)
+        else:
+            if change.state == DELETED or fields is None or change.fields is None:
+                # Deleted and created again, server gets the whole resource.
+                change.fields = None
+            else:
+                change.fields.update(fields)
+            change.state = MODIFIED
+            change.resource = resource
+
+    def delete(self, kind, rid):
+        if (kind, rid) in self.baseline:
+            self.changes[kind][rid] = Change(DELETED)
+        else:
+            # Server never heard of it.
+            self.changes[kind].pop(rid, None)
+
+    def record(self, event):
+        if isinstance(event, (events.TaskInserted, events.TaskUpdated)):
+            previous = getattr(event, 'previous', None)
+            if previous is not None and previous.rid != event.task.rid:
+                # Task took the place of another one.
+                self.delete('tasks', previous.rid)
+                previous = None
+            fields = _changed(previous, event.task) if previous is not None else None
+            if fields is None or fields:
+                self.upsert('tasks', event.task, fields)
+        elif isinstance(event, events.TaskMoved):
+            self.upsert('tasks', event.task, ('position',))
+        elif isinstance(event, events.TaskRemoved):
+            self.delete('tasks', event.task.rid)
+        elif isinstance(event, events.CardAdded):
+            self.upsert('cards', event.card)
+        elif isinstance(event, events.CardUpdated):
+            fields = _changed(event.previous, event.card)
+            if fields:
+                self.upsert('cards', event.card, fields)
+        elif isinstance(event, events.CardRemoved):
+            self.delete('cards', event.card_rid)
+            for task_rid in event.task_rids or ():
+                self.delete('tasks', task_rid)
+            if event.preference is not None:
+                self.delete('preferences', event.preference.rid)
+        elif isinstance(event, events.PreferenceChanged):
+            self.upsert('preferences', event.preference, event.changed)
+
+    def replace(self, kind, old, new):
+        """Records whatever turns resources old into new, resources are matched by rid."""
+        new_by_rid = {res.rid: res for res in new}
+        old_fields = {}
+        for res in old:
+            if res.rid in new_by_rid:
+                old_fields[res.rid] = res
+            else:
+                self.delete(kind, res.rid)
+        for rid, res in new_by_rid.items():
+            previous = old_fields.get(rid)
+            if previous is None:
+                self.upsert(kind, res)
+            elif previous is not res:
+                fields = _changed(previous, res)
+                if fields:
+                    self.upsert(kind, res, fields)
+
+    def settle(self, kind, rid, resource):
+        """
+        Baseline was brought up to what the server has for rid outside of a sync,
+        resource is what storage has now (None if nothing), change is worked out again.
+        """
+        self.changes[kind].pop(rid, None)
+        old_fp = self.baseline.fingerprints[kind].get(rid)
+        if resource is None:
+            if old_fp is not None:
+                self.changes[kind][rid] = Change(DELETED)
+        elif old_fp is None:
+            self.changes[kind][rid] = Change(CREATED, None, resource)
+        elif fingerprint(resource.to_json()) != old_fp:
+            self.changes[kind][rid] = Change(MODIFIED, None, resource)
+
+    def resolve(self):
+        """
+        Changes as kind -> (updates, removed rids, adds) of resource dicts, and the
+        fingerprint updates that bring the baseline up to date once the server has them.
+        """
+        changes = {}
+        fingerprint_updates = {}
+        for kind in KINDS:
+            updates, removes, adds = [], [], []
+            kind_updates = fingerprint_updates[kind] = {}
+            for rid, change in self.changes[kind].items():
+                if change.state == DELETED:
+                    removes.append(rid)
+                    kind_updates[rid] = None
+                    continue
+                res = change.resource.to_json()
+                fp = fingerprint(res)
+                if change.state == MODIFIED and self.baseline.fingerprints[kind].get(rid) == fp:
+                    # Changed back to what the server has, or deleted and brought back by undo.
+                    continue
+                (adds if change.state == CREATED else updates).append(res)
+                kind_updates[rid] = fp
+            changes[kind] = (updates, removes, adds)
+        return changes, fingerprint_updates
+
+    def to_json(self):
+        return {
+            'generation': self.baseline.generation,
+            'changes': {kind: [[rid, change.state, sorted(change.fields) if change.fields is not None else None,
+                                change.resource.to_json() if change.resource is not None else None]
+                               for rid, change in changes.items()]
+                        for kind, changes in self.changes.items()},
+        }
+
+    @classmethod
+    def from_json(cls, data, baseline):
+        """Change set recorded against another generation of the baseline comes back incomplete."""
+        if data.get('generation') != baseline.generation:
+            return cls(baseline, complete=False)
+        change_set = cls(baseline)
+        for kind, changes in data['changes'].items():
+            resource_type = RESOURCE_TYPES[kind]
+            for rid, state, fields, resource in changes:
+                change_set.changes[kind][rid] = Change(
+                    state, set(fields) if fields is not None else None,
+                    resource_type.from_json(resource) if resource is not None else None)
+        return change_set
+
+
+def _changed(old, new):
+    old_fields = old.to_json()
+    return tuple(name for name, value in new.to_json().items() if old_fields.get(name) != value)
@@ -0,0 +1,60 @@
+import io
+import bz2
+import gzip
+import lzma
+
+
+CODECS = ('gzip', 'bz2', 'lzma')
+DEFAULT_LEVELS = {'gzip': 6, 'bz2': 9, 'lzma': 6}
+# Magic bytes each codec starts its stream with.
+MAGICS = {
+    'gzip': b'\x1f\x8b',
+    'bz2': b'BZh',
+    'lzma': b'\xfd7zXZ\x00',
+}
+MAGIC_LENGTH = max(len(magic) for magic in MAGICS.values())
+
+
+def detect(head):
+    """Returns the codec the file starting with head was compressed with, or None."""
+    for codec, magic in MAGICS.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def open_read(path):
+    """
+    Opens storage file for reading in binary mode, decompressing it on the fly if needed.
+    Caller gets a file object either way, so nothing is decompressed up front.
+    """
+    with open(path, 'rb') as f:
+        codec = detect(f.read(MAGIC_LENGTH))
+    if codec == 'gzip':
+        return gzip.open(path, 'rb')
+    if codec == 'bz2':
+        return bz2.open(path, 'rb')
+    if codec == 'lzma':
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def open_text(path):
+    return io.TextIOWrapper(open_read(path), encoding='utf-8')
+
+
+def open_write(fileobj, codec, level=None):
+    """
+    Wraps binary file object, everything written to the wrapper gets compressed
+    and passed on as it goes. Closing the wrapper leaves fileobj open.
+    """
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if codec == 'gzip':
+        # Keep the output deterministic, so unchanged state gives identical file.
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level, mtime=0)
+    if codec == 'bz2':
+        return bz2.BZ2File(fileobj, 'wb', compresslevel=level)
+    if codec == 'lzma':
+        return lzma.LZMAFile(fileobj, 'wb', preset=level)
+    raise ValueError("Unknown compression codec {}, use one of {}.".format(codec, CODECS))
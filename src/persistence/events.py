@@ -0,0 +1,192 @@
+"""
+Change events emitted by Storage.
+
+Every mutation emits events that describe exactly what changed, indexes in
+task events are valid at the moment the event is emitted, so applying events
+in the order they arrive keeps a view in step with storage.
+"""
+
+
+class StorageEvent(object):
+    fields = ('card_rid',)
+
+    def __init__(self, *args):
+        for name, value in zip(self.fields, args):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.fields)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.fields
+            if name not in ('task', 'card', 'previous', 'preference')))
+
+
+class TaskInserted(StorageEvent):
+    fields = ('card_rid', 'index', 'task')
+
+
+class TaskRemoved(StorageEvent):
+    fields = ('card_rid', 'index', 'task')
+
+
+class TaskMoved(StorageEvent):
+    fields = ('card_rid', 'old_index', 'new_index', 'task')
+
+
+class TaskUpdated(StorageEvent):
+    # Previous is the task that was at the index before, it might have had another rid.
+    fields = ('card_rid', 'index', 'task', 'previous')
+
+
+class CardAdded(StorageEvent):
+    fields = ('card_rid', 'index', 'card')
+
+
+class CardRemoved(StorageEvent):
+    # Rids of tasks and the preference that went away with the card, they're
+    # only known when the card was removed by remove_card.
+    fields = ('card_rid', 'index', 'card', 'task_rids', 'preference')
+    task_rids = None
+    preference = None
+
+
+class CardUpdated(StorageEvent):
+    # Card moved from old_index to index, previous is the card resource it replaced.
+    fields = ('card_rid', 'old_index', 'index', 'card', 'previous')
+
+
+class PreferenceChanged(StorageEvent):
+    # Names of changed fields, preference is the new preference resource.
+    fields = ('card_rid', 'changed', 'preference')
+
+
+TASK_EVENTS = (TaskInserted, TaskRemoved, TaskMoved, TaskUpdated)
+CARD_EVENTS = (CardAdded, CardRemoved, CardUpdated)
+
+
+def _content(task):
+    # Positions change on every move, a move alone isn't an update.
+    return task.description, task.created
+
+
+def diff_tasks(card_rid, old, new):
+    """
+    Events that turn task list old into new, tasks are matched by rid.
+    Longest run of tasks that kept their order stays put and only the rest is moved,
+    so undoing a single move is a single move event.
+    """
+    new_index = {task.rid: i for i, task in enumerate(new)}
+    events = []
+    current = list(old)
+    for i in range(len(current) - 1, -1, -1):
+        if current[i].rid not in new_index:
+            events.append(TaskRemoved(card_rid, i, current.pop(i)))
+
+    targets = [new_index[task.rid] for task in current]
+    staying = set(_increasing_run(targets))
+    placed = [target in staying for target in targets]
+    for target in sorted(t for t in targets if t not in staying):
+        old_idx = targets.index(target)
+        targets.pop(old_idx)
+        placed.pop(old_idx)
+        task = current.pop(old_idx)
+        # Right after the last placed task that comes before it, which keeps placed tasks in order.
+        idx = 0
+        for j in range(len(targets)):
+            if placed[j] and targets[j] < target:
+                idx = j + 1
+        targets.insert(idx, target)
+        placed.insert(idx, True)
+        current.insert(idx, new[target])
+        if old_idx != idx:
+            events.append(TaskMoved(card_rid, old_idx, idx, new[target]))
+        if _content(task) != _content(new[target]):
+            events.append(TaskUpdated(card_rid, idx, new[target], task))
+
+    # Everything before a new task is in place by the time it's inserted.
+    for i, task in enumerate(new):
+        if i >= len(current) or current[i].rid != task.rid:
+            current.insert(i, task)
+            events.append(TaskInserted(card_rid, i, task))
+        elif current[i] is not task and _content(current[i]) != _content(task):
+            events.append(TaskUpdated(card_rid, i, task, current[i]))
+    return events
+
+
+def _increasing_run(values):
+    """Longest increasing subsequence of values."""
+    tails = []
+    tail_idx = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        previous[i] = tail_idx[lo - 1] if lo else None
+        if lo == len(tails):
+            tails.append(value)
+            tail_idx.append(i)
+        else:
+            tails[lo] = value
+            tail_idx[lo] = i
+    output = []
+    i = tail_idx[-1] if tail_idx else None
+    while i is not None:
+        output.append(values[i])
+        i = previous[i]
+    return output
+
+
+def diff_cards(old, new):
+    """Events that turn card list old into new, cards are matched by rid."""
+    new_rids = {card.rid for card in new}
+    events = []
+    current = list(old)
+    for i in range(len(current) - 1, -1, -1):
+        if current[i].rid not in new_rids:
+            events.append(CardRemoved(current[i].rid, i, current.pop(i)))
+    # Cards before i are in place, so a card that's still around is at i or after it.
+    for i, card in enumerate(new):
+        j = next((j for j in range(i, len(current)) if current[j].rid == card.rid), None)
+        if j is None:
+            current.insert(i, card)
+            events.append(CardAdded(card.rid, i, card))
+        elif j != i or current[j] is not card and current[j].to_json() != card.to_json():
+            previous = current.pop(j)
+            current.insert(i, card)
+            events.append(CardUpdated(card.rid, j, i, card, previous))
+    return events
+
+
+def diff_state(old_cards, old_preferences, new_cards, new_preferences, task_lists):
+    """
+    Events that turn one state of storage into another. task_lists maps card rid to
+    (old tasks, new tasks) of cards whose tasks might differ, other cards are left alone.
+    """
+    events = diff_cards(old_cards, new_cards)
+    for card_rid, (old, new) in task_lists.items():
+        events.extend(diff_tasks(card_rid, old, new))
+    for card_rid, pref in new_preferences.items():
+        # Preferences of added cards come with the card.
+        old = old_preferences.get(card_rid)
+        if old is not None and old is not pref:
+            changed = changed_fields(old, pref)
+            if changed:
+                events.append(PreferenceChanged(card_rid, changed, pref))
+    return events
+
+
+def changed_fields(old, new):
+    """Names of preference fields that differ, every field if there was no preference before."""
+    new_fields = new.to_json()
+    if old is None:
+        return tuple(new_fields)
+    old_fields = old.to_json()
+    return tuple(name for name, value in new_fields.items() if old_fields.get(name) != value)
@@ -0,0 +1,130 @@
+import os
+import glob
+import json
+from api.resources import ResourceBase, CardResource, TaskResource, PreferenceResource
+
+
+JOURNAL_SUFFIX = ".journal"
+
+RESOURCE_TYPES = {cls.__name__: cls for cls in (CardResource, TaskResource, PreferenceResource)}
+
+
+def encode_arg(arg):
+    if isinstance(arg, ResourceBase):
+        return {'resource': type(arg).__name__, 'fields': arg.to_json()}
+    return arg
+
+
+def decode_arg(arg):
+    if isinstance(arg, dict) and 'resource' in arg:
+        return RESOURCE_TYPES[arg['resource']].from_json(arg['fields'])
+    return arg
+
+
+class Journal(object):
+    """
+    Append-only log of storage mutations, one JSON record per line: [seq, method_name, args].
+    Records are replayed on top of the last snapshot, snapshot remembers the seq
+    of the last record it already contains, so replaying is idempotent.
+    On compaction current log is rotated away into a numbered segment,
+    and the segment is deleted once the new snapshot has been written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.seq = 0
+        self._file = None
+        # Bytes appended since the journal was opened.
+        self.bytes_written = 0
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        return self._file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def size(self):
+        if not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path)
+
+    def append(self, method_name, args):
+        self.seq += 1
+        record = [self.seq, method_name, [encode_arg(arg) for arg in args]]
+        f = self._open()
+        line = json.dumps(record) + '\n'
+        f.write(line)
+        self.bytes_written += len(line)
+        # Flush to the OS on every record, fsync is left for sync().
+        f.flush()
+
+    def sync(self):
+        fsync = self.fsync_later()
+        if fsync is not None:
+            fsync()
+
+    def fsync_later(self):
+        """
+        Returns a callable that fsyncs records appended so far, or None if nothing was appended.
+        It can run on another thread, even once the journal is rotated or closed.
+        """
+        if self._file is None:
+            return None
+        self._file.flush()
+        fd = os.dup(self._file.fileno())
+
+        def fsync():
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return fsync
+
+    def rotated_paths(self):
+        paths = glob.glob(glob.escape(self.path) + '.*')
+        paths = [path for path in paths if path.rsplit('.', 1)[1].isdigit()]
+        return sorted(paths, key=lambda path: int(path.rsplit('.', 1)[1]))
+
+    def records(self, after_seq=0):
+        for path in self.rotated_paths() + [self.path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        seq, method_name, args = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of the log, nothing after it was committed.
+                        break
+                    self.seq = max(self.seq, seq)
+                    if seq <= after_seq:
+                        continue
+                    yield seq, method_name, [decode_arg(arg) for arg in args]
+
+    def rotate(self):
+        """
+        Move current log aside, returns seq of the last record in it
+        and path of the segment, which should be discarded once snapshot is written.
+        """
+        self.close()
+        rotated_path = '{}.{}'.format(self.path, self.seq)
+        if os.path.exists(self.path):
+            os.replace(self.path, rotated_path)
+        return self.seq, rotated_path
+
+    def discard(self, rotated_path):
+        # Segments are replayed in order, anything older than this one is in the snapshot too.
+        for path in self.rotated_paths():
+            if int(path.rsplit('.', 1)[1]) <= int(rotated_path.rsplit('.', 1)[1]):
+                os.remove(path)
+
+    def clear(self):
+        self.close()
+        for path in self.rotated_paths() + [self.path]:
+            if os.path.exists(path):
+                os.remove(path)
+        self.seq = 0
@@ -0,0 +1,94 @@
+import json
+
+
+CHUNK_SIZE = 256 * 1024
+WHITESPACE = ' \t\n\r'
+
+
+class StreamingParser(object):
+    """
+    Incremental parser for the storage file, it never holds more than
+    one chunk of the file plus the element that's being decoded.
+
+    items() yields (key, value, text) for every top level key, and for keys
+    whose value is an array it yields every element separately.
+    Text is the exact JSON of the value as it appears in the file.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError("Unexpected end of storage file.")
+
+    def _next(self, expected):
+        ch = self._peek()
+        if ch not in expected:
+            raise ValueError("Expected one of {!r} at offset {}, got {!r}.".format(expected, self.pos, ch))
+        self.pos += 1
+        return ch
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            # Number at the very end of the buffer might continue in the next chunk.
+            if end == len(self.buf) and self._more():
+                continue
+            text = self.buf[self.pos:end]
+            self.pos = end
+            return value, text
+
+    def items(self):
+        self._next('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key, _ = self._value()
+            self._next(':')
+            if self._peek() == '[':
+                self.pos += 1
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        value, text = self._value()
+                        yield key, value, text
+                        if self._next(',]') == ']':
+                            break
+            else:
+                value, text = self._value()
+                yield key, value, text
+            if self._next(',}') == '}':
+                return
+
+
+def iter_items(f, chunk_size=CHUNK_SIZE):
+    return StreamingParser(f, chunk_size).items()
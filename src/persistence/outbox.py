@@ -0,0 +1,127 @@
+import json
+from persistence.baseline import KINDS
+from persistence.changes import CREATED, MODIFIED, DELETED
+
+
+# Next to the storage file, operations the server hasn't confirmed yet.
+OUTBOX_SUFFIX = ".outbox"
+# Next to the storage file, batches the server refused, one JSON line for every batch.
+REJECTED_SUFFIX = ".rejected"
+
+# Seconds before the first retry of a failed sync, doubled with every failure up to the maximum.
+RETRY_DELAY = 5.0
+MAX_RETRY_DELAY = 300.0
+
+def retry_delay(failures):
+    """Seconds to wait before retrying after failures failed syncs in a row."""
+    return min(RETRY_DELAY * 2 ** max(failures - 1, 0), MAX_RETRY_DELAY)
+
+
+def confirmed_changes(changes, steps):
+    """Parts of changes sent by the sync steps that went through, in the same layout."""
+    confirmed = {kind: ([], [], []) for kind in KINDS}
+    for step in steps:
+        kind, part = _STEP_PARTS[step]
+        confirmed[kind][part].extend(changes[kind][part])
+    return confirmed
+
+
+# Sync steps (see api.sync) as kind and part of (updates, removed rids, adds) they send.
+_STEP_PARTS = {'{}_{}'.format(verb, kind): (kind, part)
+               for kind in KINDS for part, verb in enumerate(('update', 'remove', 'add'))}
+
+
+class Outbox(object):
+    """
+    Operations synced but not confirmed by the server, as kind -> rid -> (state, resource dict).
+
+    Every sync merges its changes in here and sends the whole outbox, which is written
+    next to the storage file before anything goes out, so edits made while the server
+    can't be reached survive restarts and go out with the next sync that gets through.
+    Operations on the same rid collapse into one, a create followed by edits is still a
+    single create and a create followed by a remove is nothing at all.
+    """
+
+    def __init__(self):
+        self.operations = {kind: {} for kind in KINDS}
+
+    def __len__(self):
+        return sum(len(operations) for operations in self.operations.values())
+
+    def __contains__(self, kind_rid):
+        kind, rid = kind_rid
+        return rid in self.operations[kind]
+
+    def add(self, kind, rid, state, resource=None):
+        operations = self.operations[kind]
+        old = operations.get(rid)
+        if old is None:
+            operations[rid] = (state, resource)
+        elif state == DELETED:
+            if old[0] == CREATED:
+                # Server never got it, so there's nothing to remove.
+                del operations[rid]
+            else:
+                operations[rid] = (DELETED, None)
+        elif old[0] == CREATED:
+            operations[rid] = (CREATED, resource)
+        else:
+            # Server still has its version, removed or not, so it's overwritten.
+            operations[rid] = (MODIFIED, resource)
+
+    def merge(self, changes):
+        """Adds changes as kind -> (updates, removed rids, adds), see ChangeSet.resolve()."""
+        for kind, (updates, removes, adds) in changes.items():
+            for res in updates:
+                self.add(kind, res['rid'], MODIFIED, res)
+            for rid in removes:
+                self.add(kind, rid, DELETED)
+            for res in adds:
+                self.add(kind, res['rid'], CREATED, res)
+
+    def changes(self):
+        """Everything in the outbox as kind -> (updates, removed rids, adds)."""
+        changes = {}
+        for kind, operations in self.operations.items():
+            updates, removes, adds = [], [], []
+            for rid, (state, resource) in operations.items():
+                if state == DELETED:
+                    removes.append(rid)
+                else:
+                    (adds if state == CREATED else updates).append(resource)
+            changes[kind] = (updates, removes, adds)
+        return changes
+
+    def confirm(self, changes):
+        """Drops operations the server got, ones replaced since they were sent stay."""
+        for kind, (updates, removes, adds) in changes.items():
+            operations = self.operations[kind]
+            for rid, state, resource in ([(res['rid'], MODIFIED, res) for res in updates]
+                                         + [(rid, DELETED, None) for rid in removes]
+                                         + [(res['rid'], CREATED, res) for res in adds]):
+                current = operations.get(rid)
+                if current is None:
+                    continue
+                if current == (state, resource):
+                    del operations[rid]
+                elif state == CREATED and current[0] == CREATED:
+                    # Server has it now, later edits are an update.
+                    operations[rid] = (MODIFIED, current[1])
+                elif state == DELETED and current[0] == MODIFIED:
+                    operations[rid] = (CREATED, current[1])
+
+    def to_json(self):
+        return {kind: [[rid, state, resource] for rid, (state, resource) in operations.items()]
+                for kind, operations in self.operations.items()}
+
+    @classmethod
+    def from_json(cls, data):
+        outbox = cls()
+        for kind, operations in data.items():
+            outbox.operations[kind] = {rid: (state, resource) for rid, state, resource in operations}
+        return outbox
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_json(json.load(f))
@@ -0,0 +1,182 @@
+import os
+import json
+from functools import partial
+from storage import Storage, STORAGE_NAME, COMPRESSION_NONE
+from api.resources import CardResource, PreferenceResource
+from persistence.snapshot import FORMAT_JSON, FORMAT_BINARY
+from persistence.baseline import SyncBaseline
+from persistence.outbox import Outbox
+from persistence.changes import ChangeSet
+from persistence import compression
+
+
+SHARDED_NAME = "storage.shards"
+MANIFEST_NAME = "manifest"
+MANIFEST_VERSION = 1
+
+SHARD_EXTENSIONS = {FORMAT_JSON: '.json', FORMAT_BINARY: '.bin'}
+
+
+class Shard(object):
+    """Tasks of one card as they were written to disk, at some generation."""
+
+    def __init__(self, file_name, generation, task_rids):
+        self.file_name = file_name
+        self.generation = generation
+        self.task_rids = task_rids
+
+
+class ShardedStorage(Storage):
+    """
+    Storage engine that keeps the state in a directory, small manifest holds the token,
+    cards, preferences and the task rids of every card, and tasks of each card are in
+    a shard file of their own. Save writes only shards of cards whose generation changed
+    and then the manifest, which is what makes them part of the state, so a crash halfway
+    through leaves the old manifest pointing at the old shards.
+    Shards are read when their card is hydrated, cards that are never opened are never read.
+    """
+
+    default_name = SHARDED_NAME
+
+    def __init__(self, filename=None, path=None, journaled=False, backend='sharded', storage_format=None,
+                 compression=None, compression_level=None, deferred=False):
+        # Save rewrites only shards of changed cards, journal would only duplicate that.
+        self._shards = {}
+        super().__init__(filename, path, journaled=False, backend=backend, storage_format=storage_format,
+                         compression=compression, compression_level=compression_level, deferred=deferred)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, MANIFEST_NAME)
+
+    def load(self):
+        if os.path.exists(self.manifest_path):
+            self.load_manifest()
+            self.load_baseline()
+            return
+        os.makedirs(self.path, exist_ok=True)
+        json_path = os.path.join(os.path.dirname(self.path), STORAGE_NAME)
+        if os.path.exists(json_path):
+            # None of the imported cards has a shard yet, so the first save writes all of them.
+            self.load_snapshot(json_path)
+        if self.format is None:
+            self.format = FORMAT_JSON
+        if self.compression == COMPRESSION_NONE:
+            self.compression = None
+        self.load_baseline()
+
+    def load_manifest(self):
+        with open(self.manifest_path, 'rb') as f:
+            codec = compression.detect(f.read(compression.MAGIC_LENGTH))
+        with compression.open_read(self.manifest_path) as f:
+            manifest = json.loads(f.read().decode('utf-8'))
+        if manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError("Unsupported shard manifest version {}.".format(manifest.get('version')))
+
+        self.cards = [CardResource.from_json(res) for res in manifest['cards']]
+        for card in self.cards:
+            self._card_index[card.rid] = card
+            self.rids.observe('cards', card.rid)
+        self.preferences = {}
+        for res in manifest['preferences']:
+            pref = PreferenceResource.from_json(res)
+            self.preferences[pref.card_rid] = pref
+            self.preference_rids.add(pref.rid)
+            self.rids.observe('preferences', pref.rid)
+        for card_rid, shard in manifest['shards'].items():
+            card_rid = int(card_rid)
+            self._shards[card_rid] = Shard(shard['file'], shard['generation'], shard['tasks'])
+            # Versions of the loaded shards are what's on disk.
+            self._generations[card_rid] = shard['generation']
+            for task_rid in shard['tasks']:
+                self._task_index[task_rid] = card_rid
+                self.rids.observe('tasks', task_rid)
+        self._generation = manifest['generation']
+        self.token = manifest.get('token')
+        self.rids.update(manifest.get('rids', {}))
+        self._stored_changes = manifest.get('changes')
+        self._rekey('cards', self.cards)
+        if self.format is None:
+            self.format = manifest.get('format', FORMAT_JSON)
+        if self.compression is None:
+            self.compression = codec
+        elif self.compression == COMPRESSION_NONE:
+            self.compression = None
+
+    def _read_shard(self, file_name):
+        with compression.open_read(os.path.join(self.path, file_name)) as f:
+            raw = f.read()
+        return raw if file_name.endswith(SHARD_EXTENSIONS[FORMAT_BINARY]) else raw.decode('utf-8')
+
+    def _version(self, card_rid):
+        version = super()._version(card_rid)
+        shard = self._shards.get(card_rid)
+        if (version.tasks is None and version.source is None and card_rid not in self._fragments
+                and shard is not None and shard.generation == version.generation):
+            # Version is read from its shard only if somebody needs it.
+            version.source = partial(self._read_shard, shard.file_name)
+        return version
+
+    def _stored_fragment(self, card_rid):
+        if card_rid in self._fragments:
+            return self._fragments[card_rid]
+        # Goes through the version, so snapshots that share it don't read the shard again.
+        return self._version(card_rid).stored() or ''
+
+    def save(self):
+        if self.debug:
+            return
+        snapshot = self.snapshot()
+        shards = {}
+        for card in snapshot.cards:
+            version = snapshot.versions[card.rid]
+            shard = self._shards.get(card.rid)
+            if shard is None or shard.generation != version.generation:
+                # Generations are never reused, so neither are shard file names.
+                file_name = '{}-{}{}'.format(card.rid, version.generation, SHARD_EXTENSIONS[self.format])
+                shard = Shard(file_name, version.generation, version.task_rids())
+                self.writer.submit(os.path.join(self.path, file_name), partial(version.fragment, self.format),
+                                   self.compression, self.compression_level)
+            shards[card.rid] = shard
+        self._shards = shards
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'generation': self._generation,
+            'format': self.format,
+            'token': snapshot.token,
+            'rids': snapshot.rids,
+            'cards': [card.to_json() for card in snapshot.cards],
+            'preferences': [pref.to_json() for pref in snapshot.preferences.values()],
+            'shards': {card_rid: {'file': shard.file_name, 'generation': shard.generation, 'tasks': shard.task_rids}
+                       for card_rid, shard in shards.items()},
+            'changes': self.changes.to_json(),
+        }
+        file_names = {shard.file_name for shard in shards.values()}
+        self.writer.submit(self.manifest_path, partial(json.dumps, manifest), self.compression,
+                           self.compression_level, after=partial(self._remove_stale_shards, file_names))
+        self.saved = True
+        print("Storage state saved!")
+
+    def _remove_stale_shards(self, file_names):
+        # Runs on the writer thread once the manifest is written, nothing refers to other shards anymore.
+        for file_name in os.listdir(self.path):
+            if file_name != MANIFEST_NAME and file_name not in file_names:
+                os.remove(os.path.join(self.path, file_name))
+
+    def wipe(self):
+        self._stop_sync()
+        self.clear_history()
+        self.writer.flush()
+        self._clear_state()
+        manifest = {'version': MANIFEST_VERSION, 'generation': self._generation, 'format': self.format,
+                    'token': None, 'rids': {}, 'cards': [], 'preferences': [], 'shards': {}}
+        self._shards = {}
+        self.baseline = SyncBaseline(generation=self.baseline.generation + 1)
+        self.changes = ChangeSet(self.baseline)
+        self.outbox = Outbox()
+        self._write_outbox()
+        self._write_baseline()
+        self.writer.submit(self.manifest_path, json.dumps(manifest), self.compression,
+                           self.compression_level, after=partial(self._remove_stale_shards, set()))
+        self._write_session(None)
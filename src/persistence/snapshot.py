@@ -0,0 +1,166 @@
+import json
+from api.resources import TaskResource
+from persistence import binary
+from utils import positions
+
+
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+
+
+def decode_fragment(fragment):
+    if isinstance(fragment, bytes):
+        return binary.decode_tasks(fragment)
+    return json.loads('[' + fragment + ']') if fragment else []
+
+
+def encode_fragment(task_dicts, storage_format):
+    if storage_format == FORMAT_BINARY:
+        return binary.encode_tasks(task_dicts)
+    return ', '.join(json.dumps(res) for res in task_dicts)
+
+
+def fragment_matches(fragment, storage_format):
+    return fragment is not None and isinstance(fragment, bytes) == (storage_format == FORMAT_BINARY)
+
+
+class CardVersion(object):
+    """
+    Tasks of one card at some generation, it never changes once it's created.
+    Tasks are either a frozen TaskSequence or the serialized fragment, fragment
+    is encoded on demand and cached, so versions shared by several snapshots
+    get encoded only once, on whichever thread needs them first.
+    """
+
+    def __init__(self, generation, tasks=None, fragment=None, source=None):
+        self.generation = generation
+        self.tasks = tasks
+        self._fragment = fragment
+        # Reads the fragment, for versions whose tasks are still on disk.
+        self.source = source
+
+    def stored(self):
+        """Fragment in whatever format it was serialized in, None if there's none yet."""
+        if self._fragment is None and self.source is not None:
+            self._fragment = self.source()
+        return self._fragment
+
+    def fragment(self, storage_format):
+        fragment = self.stored()
+        if not fragment_matches(fragment, storage_format):
+            fragment = encode_fragment(self.task_dicts(), storage_format)
+            self._fragment = fragment
+        return fragment
+
+    def task_dicts(self):
+        if self.tasks is not None:
+            return [dict(task.to_json()) for task in self.tasks]
+        task_dicts = decode_fragment(self.stored() or '')
+        # Fragments written before position keys have integer positions.
+        if not positions.is_ordered(res['position'] for res in task_dicts):
+            for res, key in zip(task_dicts, positions.keys(len(task_dicts))):
+                res['position'] = key
+        return task_dicts
+
+    def resources(self):
+        if self.tasks is not None:
+            return self.tasks
+        return [TaskResource.from_json(res) for res in self.task_dicts()]
+
+    def task_rids(self):
+        if self.tasks is not None:
+            return [task.rid for task in self.tasks]
+        fragment = self.stored()
+        if isinstance(fragment, bytes):
+            return binary.task_rids(fragment)
+        return [res['rid'] for res in decode_fragment(fragment or '')]
+
+
+class StorageSnapshot(object):
+    """
+    Read-only version of the whole storage state.
+
+    Resources are never modified in place once they're in storage and task
+    sequences are shared copy-on-write, so taking a snapshot costs one CardVersion
+    per changed card, and it can be read from any thread while storage keeps changing.
+    It can be indexed like the dict of the storage file ('cards', 'tasks', 'preferences', 'token').
+    """
+
+    def __init__(self, cards, preferences, token, rids, versions, storage_format):
+        self.cards = cards
+        self.preferences = preferences
+        self.token = token
+        self.rids = rids
+        self.versions = versions
+        self.format = storage_format
+
+    def __getitem__(self, key):
+        if key == 'cards':
+            return [dict(card.to_json()) for card in self.cards]
+        if key == 'tasks':
+            tasks = []
+            for card in self.cards:
+                tasks.extend(self.versions[card.rid].task_dicts())
+            return tasks
+        if key == 'preferences':
+            return [dict(pref.to_json()) for pref in self.preferences.values()]
+        if key == 'token':
+            return self.token
+        raise KeyError(key)
+
+    def resources(self, kind):
+        """Resource dicts of one kind without copying them, they must not be modified."""
+        if kind == 'cards':
+            return (card.to_json() for card in self.cards)
+        if kind == 'tasks':
+            return self._task_resources()
+        if kind == 'preferences':
+            return (pref.to_json() for pref in self.preferences.values())
+        raise KeyError(kind)
+
+    def _task_resources(self):
+        for card in self.cards:
+            version = self.versions[card.rid]
+            if version.tasks is not None:
+                for task in version.tasks:
+                    yield task.to_json()
+            else:
+                yield from version.task_dicts()
+
+    def serialize(self, journal_seq=None, changes=None):
+        """Snapshot in the storage file format, as a tuple of parts, changes is ChangeSet.to_json()."""
+        # Only cards changed since their last serialization get encoded again,
+        # cards and preferences are one per card, so they are cheap to redo.
+        if self.format == FORMAT_BINARY:
+            meta = {'token': self.token, 'rids': self.rids}
+            if journal_seq is not None:
+                meta['journal_seq'] = journal_seq
+            if changes is not None:
+                meta['changes'] = changes
+            return binary.encode_snapshot_parts(
+                [card.to_json() for card in self.cards],
+                [pref.to_json() for pref in self.preferences.values()], meta,
+                [(card.rid, self.versions[card.rid].fragment(self.format)) for card in self.cards])
+
+        # Tasks are written last, so the loader gets to cards and preferences first.
+        # Fragments are handed to the writer as separate parts, the whole file is never joined in memory.
+        parts = [
+            '{"cards": ' + json.dumps([card.to_json() for card in self.cards]),
+            ', "preferences": ' + json.dumps([pref.to_json() for pref in self.preferences.values()]),
+            ', "token": ' + json.dumps(self.token),
+            ', "rids": ' + json.dumps(self.rids),
+        ]
+        if journal_seq is not None:
+            parts.append(', "journal_seq": ' + json.dumps(journal_seq))
+        if changes is not None:
+            parts.append(', "changes": ' + json.dumps(changes))
+        parts.append(', "tasks": [')
+        separator = ''
+        for card in self.cards:
+            fragment = self.versions[card.rid].fragment(self.format)
+            if fragment:
+                parts.append(separator)
+                parts.append(fragment)
+                separator = ', '
+        parts.append(']}')
+        return tuple(parts)
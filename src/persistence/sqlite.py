@@ -0,0 +1,604 @@
+import os
+import json
+import sqlite3
+from bisect import bisect_left
+from functools import partial
+from storage import Storage, STORAGE_NAME, unsave, unsave_all, unsave_positions
+from api.resources import CardResource, TaskResource, PreferenceResource
+from utils.rids import RidAllocator
+from utils import positions
+from persistence import compression, events
+from persistence.baseline import SyncBaseline
+from persistence.changes import RESOURCE_TYPES
+from persistence.snapshot import StorageSnapshot, CardVersion
+from persistence.outbox import confirmed_changes
+from api.sync import SyncFailed
+
+
+SQLITE_NAME = "storage.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cards (
+    rid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    position TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    rid INTEGER PRIMARY KEY,
+    card_rid INTEGER NOT NULL,
+    position TEXT NOT NULL,
+    description TEXT,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_card_position ON tasks (card_rid, position);
+CREATE TABLE IF NOT EXISTS preferences (
+    rid INTEGER PRIMARY KEY,
+    card_rid INTEGER NOT NULL UNIQUE,
+    warning_time INTEGER,
+    danger_time INTEGER,
+    show_date INTEGER
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+TABLES = ('cards', 'tasks', 'preferences')
+TASK_COLUMNS = "rid, description, position, card_rid, created"
+# Columns of the resources that are compared against the synced tables, see _unsynced_changes().
+SYNC_COLUMNS = {
+    'cards': ('rid', 'name', 'position'),
+    'tasks': ('rid', 'description', 'position', 'card_rid', 'created'),
+    'preferences': ('rid', 'card_rid', 'warning_time', 'danger_time', 'show_date'),
+}
+
+
+def task_from_row(row):
+    return TaskResource(rid=row[0], description=row[1], position=row[2],
+                        card_rid=row[3], created=row[4])
+
+
+def row_to_json(kind, row):
+    res = dict(zip(SYNC_COLUMNS[kind], row))
+    if kind == 'preferences':
+        res['show_date'] = bool(res['show_date'])
+    return res
+
+
+class TaskRids(object):
+    """Answers `rid in storage.task_rids` without keeping every rid in memory."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __contains__(self, rid):
+        row = self.db.execute("SELECT 1 FROM tasks WHERE rid = ?", (rid,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+
+class SqliteStorage(Storage):
+    """
+    Storage engine that keeps tasks in an SQLite database instead of in memory.
+    Cards and preferences are few, so they are cached in memory and written through.
+    Changes are committed on save(), until then they live in an open transaction.
+    Task positions are keys (see utils.positions), index of a task is the number
+    of tasks in its card with a smaller key, so nothing is renumbered on a move.
+    Sorted keys of the cards that were accessed are kept in memory, an index
+    is turned into a key by them and the task is looked up by the key.
+    """
+
+    default_name = SQLITE_NAME
+    # Connection can only be used by the thread that opened it.
+    loads_in_background = False
+    # Synced tables are diffed on sync, see sync().
+    tracks_changes = False
+
+    def __init__(self, filename=None, path=None, journaled=False, backend='sqlite', storage_format=None,
+                 compression=None, compression_level=None, deferred=False):
+        # Database has its own log, journal would only duplicate it.
+        super().__init__(filename, path, journaled=False, backend=backend, deferred=deferred)
+        # Tasks live in the database, every undo step would be a copy of all of them.
+        self.undo_limit = 0
+
+    def load(self):
+        new_database = not os.path.exists(self.path)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+        self._keys = {}
+        for table in TABLES:
+            self.db.execute("CREATE TABLE IF NOT EXISTS synced_{0} AS SELECT * FROM {0} WHERE 0".format(table))
+            # Copies don't get the primary key, confirmed and rekeyed rows are looked up by rid.
+            self.db.execute("CREATE INDEX IF NOT EXISTS synced_{0}_rid ON synced_{0} (rid)".format(table))
+        self.db.commit()
+
+        json_path = os.path.join(os.path.dirname(self.path), STORAGE_NAME)
+        if new_database and os.path.exists(json_path):
+            with compression.open_text(json_path) as f:
+                self.import_from_file(f)
+
+        self.cards = [CardResource(rid=rid, name=name, position=position) for rid, name, position in
+                      self.db.execute("SELECT rid, name, position FROM cards ORDER BY position")]
+        self._card_index = {card.rid: card for card in self.cards}
+        self.card_rids = self._card_index.keys()
+        self.task_rids = TaskRids(self.db)
+        self.preferences = {}
+        for rid, card_rid, warning_time, danger_time, show_date in self.db.execute(
+                "SELECT rid, card_rid, warning_time, danger_time, show_date FROM preferences"):
+            self.preferences[card_rid] = PreferenceResource(
+                rid=rid, card_rid=card_rid, warning_time=warning_time,
+                danger_time=danger_time, show_date=bool(show_date))
+        self.preference_rids = set(pref.rid for pref in self.preferences.values())
+        self._upgrade_positions()
+        self.token = self._get_meta('token')
+        self.rids = RidAllocator(self._get_meta('rids'))
+        for kind in TABLES:
+            max_rid = self.db.execute("SELECT MAX(rid) FROM {}".format(kind)).fetchone()[0]
+            if max_rid is not None:
+                self.rids.observe(kind, max_rid)
+
+    def _upgrade_positions(self):
+        # Databases created before position keys have integer positions, they get the keys that stand for them.
+        old_positions = [card.position for card in self.cards]
+        positions.rekey(self.cards)
+        self.db.executemany("UPDATE cards SET position = ? WHERE rid = ?",
+                            [(card.position, card.rid) for card, position in zip(self.cards, old_positions)
+                             if card.position != position])
+        old_cards = [row[0] for row in self.db.execute(
+            "SELECT DISTINCT card_rid FROM tasks WHERE typeof(position) != 'text'")]
+        for card_rid in old_cards:
+            tasks = self.tasks(card_rid)
+            positions.rekey(tasks)
+            self.db.executemany("UPDATE tasks SET position = ? WHERE rid = ?",
+                                [(task.position, task.rid) for task in tasks])
+        self.db.commit()
+
+    def import_from_file(self, f):
+        data = json.load(f)
+        rekeyed = self._replace_all(
+            [CardResource.from_json(res) for res in data['cards']],
+            [TaskResource.from_json(res) for res in data['tasks']],
+            [PreferenceResource.from_json(res) for res in data['preferences']])
+        self._set_meta('token', data['token'])
+        self._mark_synced(rekeyed)
+        self.db.commit()
+
+    def _get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _replace_all(self, cards, tasks, preferences):
+        self._keys.clear()
+        self.db.execute("DELETE FROM cards")
+        self.db.execute("DELETE FROM tasks")
+        self.db.execute("DELETE FROM preferences")
+        # Positions coming from older files or the api might not be keys yet,
+        # returns (kind, resource, old position) of the ones that got new keys.
+        cards = sorted(cards, key=lambda c: positions.sort_key(c.position))
+        rekeyed = [('cards', card, old_position) for card, old_position in positions.rekey(cards)]
+        self.db.executemany("INSERT INTO cards (rid, name, position) VALUES (?, ?, ?)",
+                            [(c.rid, c.name, c.position) for c in cards])
+        tasks_by_card = {}
+        for task in tasks:
+            tasks_by_card.setdefault(task.card_rid, []).append(task)
+        rows = []
+        for card_tasks in tasks_by_card.values():
+            card_tasks.sort(key=lambda t: positions.sort_key(t.position))
+            rekeyed.extend(('tasks', task, old_position) for task, old_position in positions.rekey(card_tasks))
+            rows.extend((t.rid, t.description, t.position, t.card_rid, t.created) for t in card_tasks)
+        self.db.executemany("INSERT INTO tasks ({}) VALUES (?, ?, ?, ?, ?)".format(TASK_COLUMNS), rows)
+        self.db.executemany("INSERT INTO preferences (rid, card_rid, warning_time, danger_time, show_date) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            [(p.rid, p.card_rid, p.warning_time, p.danger_time, p.show_date) for p in preferences])
+        return rekeyed
+
+    def _mark_synced(self, rekeyed=()):
+        for table in TABLES:
+            self.db.execute("DELETE FROM synced_{}".format(table))
+            self.db.execute("INSERT INTO synced_{0} SELECT * FROM {0}".format(table))
+        # Server still has the old positions, new keys go out with the next sync.
+        for kind in ('cards', 'tasks'):
+            self.db.executemany("UPDATE synced_{} SET position = ? WHERE rid = ?".format(kind),
+                                [(old_position, res.rid) for res_kind, res, old_position in rekeyed if res_kind == kind])
+
+    @unsave_all
+    def fetch_cards(self, jid=None):
+        if jid is None:
+            jid = self.dispatcher.get_cards()
+        self.cards = self.extract_future(jid).result()
+        self.rids.observe_all(self.cards)
+        self._card_index = {card.rid: card for card in self.cards}
+        self.card_rids = self._card_index.keys()
+        print('Cards updated.')
+
+    @unsave_all
+    def fetch_tasks(self, jid=None):
+        if jid is None:
+            jid = self.dispatcher.get_tasks()
+        # Requests aren't atomic, cards created on the server after cards were sent are left out.
+        self._fetched_tasks = [task for task in self.extract_future(jid).result()
+                               if task.card_rid in self._card_index]
+        self.rids.observe_all(self._fetched_tasks)
+        print('Taks updated.')
+
+    @unsave_all
+    def fetch_preferences(self, jid=None):
+        if jid is None:
+            jid = self.dispatcher.get_preferences()
+        self.preferences = {pref.card_rid: pref for pref in self.extract_future(jid).result()
+                            if pref.card_rid in self._card_index}
+        self.rids.observe_all(self.preferences.values())
+        self.preference_rids = set(pref.rid for pref in self.preferences.values())
+
+    def fetch_all(self):
+        if self._pending_sync() and not self.flush_sync():
+            raise RuntimeError("Changes couldn't be synced, fetching would lose them.")
+        old_state = self._observed_state()
+        # Requests run concurrently, results are joined in order, cards first.
+        jids = self.dispatcher.get_cards(), self.dispatcher.get_tasks(), self.dispatcher.get_preferences()
+        self.fetch_cards(jids[0])
+        self.fetch_tasks(jids[1])
+        self.fetch_preferences(jids[2])
+        rekeyed = self._replace_all(self.cards, self._fetched_tasks, self.preferences.values())
+        self._fetched_tasks = None
+        self._set_meta('token', self.token)
+        self._mark_synced(rekeyed)
+        self.save()
+        self._notify_replaced(old_state)
+        self.synced = True
+
+    def get_task(self, card_rid, task_idx):
+        keys = self._card_keys(card_rid)
+        if task_idx < 0:
+            task_idx += len(keys)
+        if not 0 <= task_idx < len(keys):
+            raise IndexError("Task index {} out of range.".format(task_idx))
+        row = self.db.execute("SELECT {} FROM tasks WHERE card_rid = ? AND position = ?".format(TASK_COLUMNS),
+                              (card_rid, keys[task_idx])).fetchone()
+        return task_from_row(row)
+
+    def find_task(self, card_rid, task_rid):
+        row = self.db.execute("SELECT {} FROM tasks WHERE rid = ? AND card_rid = ?".format(TASK_COLUMNS),
+                              (task_rid, card_rid)).fetchone()
+        if row is None:
+            raise ValueError("Task with rid {} doesn't exist".format(task_rid))
+        return task_from_row(row)
+
+    def locate_task(self, task_rid):
+        row = self.db.execute("SELECT card_rid, position FROM tasks WHERE rid = ?", (task_rid,)).fetchone()
+        if row is None:
+            return None
+        card_rid, position = row
+        return card_rid, bisect_left(self._card_keys(card_rid), position)
+
+    def tasks(self, card_rid):
+        return [task_from_row(row) for row in self.db.execute(
+            "SELECT {} FROM tasks WHERE card_rid = ? ORDER BY position".format(TASK_COLUMNS), (card_rid,))]
+
+    def _card_keys(self, card_rid):
+        """Sorted task keys of the card, read through the (card_rid, position) index once."""
+        keys = self._keys.get(card_rid)
+        if keys is None:
+            keys = self._keys[card_rid] = [row[0] for row in self.db.execute(
+                "SELECT position FROM tasks WHERE card_rid = ? ORDER BY position", (card_rid,))]
+        return keys
+
+    def _count_tasks(self, card_rid):
+        return len(self._card_keys(card_rid))
+
+    def _position_between(self, card_rid, idx, skip=None, keep=None):
+        """Key for a task placed at idx, among tasks of the card other than the one at index skip."""
+        keys = self._card_keys(card_rid)
+        neighbours = []
+        for i in (idx - 1, idx):
+            if skip is not None and i >= skip:
+                i += 1
+            neighbours.append(keys[i] if 0 <= i < len(keys) else None)
+        before, after = neighbours
+        # Tasks that come from the server keep their keys if they can.
+        if keep is not None and positions.fits(keep, before, after):
+            return keep
+        return positions.key_between(before, after)
+
+    def _insert_task_row(self, card_rid, task, position):
+        task.card_rid = card_rid
+        task.position = position
+        self.db.execute("INSERT INTO tasks ({}) VALUES (?, ?, ?, ?, ?)".format(TASK_COLUMNS),
+                        (task.rid, task.description, task.position, card_rid, task.created))
+
+    @unsave
+    def add_card(self, card_resource):
+        self.cards.append(card_resource)
+        if not self._position_fits(self.cards, len(self.cards) - 1):
+            card_resource.position = self._position_at(self.cards, len(self.cards) - 1)
+        self._card_index[card_resource.rid] = card_resource
+        self.db.execute("INSERT INTO cards (rid, name, position) VALUES (?, ?, ?)",
+                        (card_resource.rid, card_resource.name, card_resource.position))
+        self.notify_change(events.CardAdded(card_resource.rid, len(self.cards) - 1, card_resource))
+
+    @unsave
+    def add_task(self, card_rid, task_resource):
+        keys = self._card_keys(card_rid)
+        self._insert_task_row(card_rid, task_resource, positions.key_between(keys[-1] if keys else None, None))
+        keys.append(task_resource.position)
+        self.notify_change(events.TaskInserted(card_rid, len(keys) - 1, task_resource))
+
+    @unsave
+    def add_preference(self, card_rid, preference_resource):
+        if self.preferences.get(card_rid, False):
+            raise ValueError("Can't add preference, card with rid={} "
+                             "already has preference set.".format(card_rid))
+        self.preferences[card_rid] = preference_resource
+        self.preference_rids.add(preference_resource.rid)
+        self._write_preference(preference_resource)
+        self.notify_change(events.PreferenceChanged(
+            card_rid, events.changed_fields(None, preference_resource), preference_resource))
+
+    def _write_preference(self, pref):
+        self.db.execute("INSERT OR REPLACE INTO preferences (rid, card_rid, warning_time, danger_time, show_date) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (pref.rid, pref.card_rid, pref.warning_time, pref.danger_time, pref.show_date))
+
+    @unsave
+    def remove_card(self, card_rid):
+        card = self._card_index.pop(card_rid)
+        card_idx = self.cards.index(card)
+        del self.cards[card_idx]
+        self.db.execute("DELETE FROM cards WHERE rid = ?", (card_rid,))
+        task_rids = [row[0] for row in self.db.execute("SELECT rid FROM tasks WHERE card_rid = ?", (card_rid,))]
+        self.db.execute("DELETE FROM tasks WHERE card_rid = ?", (card_rid,))
+        self._keys.pop(card_rid, None)
+        pref = self.preferences.pop(card_rid)
+        self.preference_rids.remove(pref.rid)
+        self.db.execute("DELETE FROM preferences WHERE rid = ?", (pref.rid,))
+        self.notify_change(events.CardRemoved(card_rid, card_idx, card, task_rids, pref))
+
+    @unsave
+    def pop_task(self, card_rid, task_index):
+        if task_index < 0:
+            task_index += self._count_tasks(card_rid)
+        task = self.get_task(card_rid, task_index)
+        self.db.execute("DELETE FROM tasks WHERE rid = ?", (task.rid,))
+        del self._card_keys(card_rid)[task_index]
+        self.notify_change(events.TaskRemoved(card_rid, task_index, task))
+        return task
+
+    @unsave
+    def insert_task(self, card_rid, idx, task_resource):
+        count = self._count_tasks(card_rid)
+        # Mimic list.insert for out of range and negative indexes.
+        if idx < 0:
+            idx = max(0, count + idx)
+        idx = min(idx, count)
+        self._insert_task_row(card_rid, task_resource,
+                              self._position_between(card_rid, idx, keep=task_resource.position))
+        self._card_keys(card_rid).insert(idx, task_resource.position)
+        self.notify_change(events.TaskInserted(card_rid, idx, task_resource))
+
+    @unsave
+    def move_task(self, card_rid, old_idx, new_idx):
+        count = self._count_tasks(card_rid)
+        if old_idx < 0:
+            old_idx += count
+        task = self.get_task(card_rid, old_idx)
+        if new_idx < 0:
+            new_idx = max(0, count - 1 + new_idx)
+        new_idx = min(new_idx, count - 1)
+        task.position = self._position_between(card_rid, new_idx, skip=old_idx)
+        self.db.execute("UPDATE tasks SET position = ? WHERE rid = ?", (task.position, task.rid))
+        keys = self._card_keys(card_rid)
+        del keys[old_idx]
+        keys.insert(new_idx, task.position)
+        self.notify_change(events.TaskMoved(card_rid, old_idx, new_idx, task))
+
+    @unsave
+    def update_task(self, card_rid, idx, task_resource):
+        if idx < 0:
+            idx += self._count_tasks(card_rid)
+        old_task = self.get_task(card_rid, idx)
+        task_resource.position = old_task.position
+        self.db.execute("UPDATE tasks SET rid = ?, description = ?, created = ? WHERE rid = ?",
+                        (task_resource.rid, task_resource.description, task_resource.created, old_task.rid))
+        self.notify_change(events.TaskUpdated(card_rid, idx, task_resource, old_task))
+
+    @unsave
+    def update_card(self, card_rid, card_resource):
+        event = self._replace_card(card_rid, card_resource)
+        self.db.execute("UPDATE cards SET name = ?, position = ? WHERE rid = ?",
+                        (event.card.name, event.card.position, card_rid))
+        self.notify_change(event)
+
+    @unsave_positions
+    def set_card_positions(self, keys):
+        for idx, key in keys:
+            old_card = self.cards[idx]
+            card = old_card.replace(position=key)
+            self.cards[idx] = card
+            self._card_index[card.rid] = card
+            self.db.execute("UPDATE cards SET position = ? WHERE rid = ?", (key, card.rid))
+            self.notify_change(events.CardUpdated(card.rid, idx, idx, card, old_card))
+
+    @unsave_positions
+    def set_task_positions(self, card_rid, keys):
+        card_keys = self._card_keys(card_rid)
+        # Keys only move forward, going from the last one no two tasks ever share a key.
+        for idx, key in reversed(keys):
+            old_task = self.get_task(card_rid, idx)
+            task = old_task.replace(position=key)
+            self.db.execute("UPDATE tasks SET position = ? WHERE rid = ?", (key, task.rid))
+            card_keys[idx] = key
+            self.notify_change(events.TaskUpdated(card_rid, idx, task, old_task))
+
+    @unsave
+    def update_preference(self, card_rid, field, new_value):
+        # check if attribute exists first
+        old_value = getattr(self.preferences[card_rid], field)
+        setattr(self.preferences[card_rid], field, new_value)
+        self._write_preference(self.preferences[card_rid])
+        if old_value != new_value:
+            self.notify_change(events.PreferenceChanged(card_rid, (field,), self.preferences[card_rid]))
+
+    @unsave
+    def replace_preference(self, card_rid, preference_resource):
+        old_pref = self.preferences.get(card_rid)
+        self.preferences[card_rid] = preference_resource
+        self.db.execute("DELETE FROM preferences WHERE card_rid = ?", (card_rid,))
+        self._write_preference(preference_resource)
+        changed = events.changed_fields(old_pref, preference_resource)
+        if changed:
+            self.notify_change(events.PreferenceChanged(card_rid, changed, preference_resource))
+
+    def snapshot(self):
+        """Copy of the state, see StorageSnapshot, all of the tasks are read from the database."""
+        tasks = {}
+        for row in self.db.execute("SELECT {} FROM tasks ORDER BY card_rid, position".format(TASK_COLUMNS)):
+            task = task_from_row(row)
+            tasks.setdefault(task.card_rid, []).append(task)
+        # Preferences are modified in place here.
+        preferences = {card_rid: pref.replace() for card_rid, pref in self.preferences.items()}
+        return StorageSnapshot(tuple(self.cards), preferences, self.token, self.rids.to_json(),
+                               {card.rid: CardVersion(0, tuple(tasks.get(card.rid, ()))) for card in self.cards},
+                               self.format)
+
+    def restore(self, snapshot):
+        """Writes the state of the snapshot into the database, all of it is rewritten."""
+        old_state = self._observed_state()
+        self._replace_all(snapshot.cards, [task for version in snapshot.versions.values()
+                                           for task in version.resources()], snapshot.preferences.values())
+        self.cards = list(snapshot.cards)
+        self._card_index = {card.rid: card for card in self.cards}
+        self.card_rids = self._card_index.keys()
+        self.preferences = dict(snapshot.preferences)
+        self.preference_rids = set(pref.rid for pref in self.preferences.values())
+        self.saved = False
+        self.synced = False
+        self._notify_replaced(old_state)
+        self.notify_mutation()
+
+    def apply_divergence(self, divergence):
+        # Synced tables are the baseline here, it's only needed while the divergence is applied.
+        self.baseline = SyncBaseline.from_data(self._read_data('synced_'))
+        try:
+            super().apply_divergence(divergence)
+        finally:
+            self.baseline = SyncBaseline()
+
+    def _settle_divergence(self, divergence, remote_fps):
+        # Synced tables get what the server has now, whatever differs from it is uploaded by sync.
+        current = {}
+        for kind, resources in divergence.resources.items():
+            current[kind] = ([RESOURCE_TYPES[kind].from_json(remote).to_json()
+                              for local, remote in resources.values() if remote is not None],
+                             [rid for rid, (local, remote) in resources.items() if remote is None], [])
+        self._mark_sent(current)
+        self.save()
+
+    def save(self):
+        if self.debug:
+            return
+        self._set_meta('token', self.token)
+        self._set_meta('rids', self.rids.to_json())
+        self.db.commit()
+        self.saved = True
+        print("Storage state saved!")
+
+    def _read_data(self, prefix=''):
+        cards_resource = [{'rid': rid, 'name': name, 'position': position} for rid, name, position in
+                          self.db.execute("SELECT rid, name, position FROM {}cards".format(prefix))]
+        tasks_resource = [vars(task_from_row(row)) for row in
+                          self.db.execute("SELECT {} FROM {}tasks".format(TASK_COLUMNS, prefix))]
+        preferences_resource = [
+            {'rid': rid, 'card_rid': card_rid, 'warning_time': warning_time,
+             'danger_time': danger_time, 'show_date': bool(show_date)}
+            for rid, card_rid, warning_time, danger_time, show_date in self.db.execute(
+                "SELECT rid, card_rid, warning_time, danger_time, show_date FROM {}preferences".format(prefix))]
+        return {
+            'cards': cards_resource, 'tasks': tasks_resource,
+            'preferences': preferences_resource, 'token': self.token
+        }
+
+    def sync(self):
+        if self._sync_job is not None:
+            self._sync_again = True
+            return
+        self._sync_again = False
+        # Synced tables are what the server confirmed, whatever differs from them is sent,
+        # so operations of a failed sync stay in the database and are sent again.
+        changes = self._unsynced_changes()
+        updates, _, adds = changes['tasks']
+        if self._use_integer_positions(set(task['card_rid'] for task in updates + adds
+                                           if positions.key_integer(task['position']) is None)):
+            changes = self._unsynced_changes()
+        self.synced = True
+        if self._retry_timer is not None:
+            self._retry_timer.stop()
+        if not any(part for kind_changes in changes.values() for part in kind_changes):
+            return
+        self._sync_job = self.dispatcher.sync(changes)
+        self.dispatcher.on_done(self._sync_job, partial(self._check_for_sync_errors, self._sync_job, changes))
+
+    def _unsynced_changes(self):
+        """
+        Rows that differ from the synced tables as kind -> (updates, removed rids, adds),
+        tables are compared by the database, only rows that changed are read.
+        """
+        changes = {}
+        for kind, columns in SYNC_COLUMNS.items():
+            selected = ', '.join('t.' + column for column in columns)
+            differs = ' OR '.join('t.{0} IS NOT s.{0}'.format(column) for column in columns[1:])
+            updates = [row_to_json(kind, row) for row in self.db.execute(
+                "SELECT {} FROM {} t JOIN synced_{} s ON s.rid = t.rid WHERE {}".format(
+                    selected, kind, kind, differs))]
+            removes = [row[0] for row in self.db.execute(
+                "SELECT rid FROM synced_{0} WHERE rid NOT IN (SELECT rid FROM {0})".format(kind))]
+            adds = [row_to_json(kind, row) for row in self.db.execute(
+                "SELECT {} FROM {} t WHERE t.rid NOT IN (SELECT rid FROM synced_{})".format(selected, kind, kind))]
+            changes[kind] = (updates, removes, adds)
+        return changes
+
+    def _pending_sync(self):
+        return any(part for kind_changes in self._unsynced_changes().values() for part in kind_changes)
+
+    def sync_finished(self, sent):
+        self._mark_sent(sent)
+
+    def sync_failed(self, sent, error):
+        if isinstance(error, SyncFailed):
+            self._mark_sent(confirmed_changes(sent, error.report.completed))
+            rejected = self._reject(sent, error)
+            if rejected is not None:
+                # Synced tables take them too, so they aren't sent again.
+                self._mark_sent(rejected)
+        self._retry_failed_sync(error)
+
+    def _mark_sent(self, sent):
+        """Writes changes the server confirmed into the synced tables, edits made since then stay unsynced."""
+        # Savepoint leaves the transaction of unsaved edits open, it's committed on save().
+        self.db.execute("SAVEPOINT mark_sent")
+        for kind, (updates, removes, adds) in sent.items():
+            table = 'synced_' + kind
+            # Synced tables have no primary key to replace rows by.
+            self.db.executemany("DELETE FROM {} WHERE rid = ?".format(table),
+                                [(rid,) for rid in removes] + [(res['rid'],) for res in updates + adds])
+            for res in updates + adds:
+                columns = sorted(res)
+                self.db.execute("INSERT INTO {} ({}) VALUES ({})".format(
+                    table, ', '.join(columns), ', '.join('?' * len(columns))), [res[c] for c in columns])
+        # Without unsaved edits this commits right away, sending them again would be rejected by the server.
+        self.db.execute("RELEASE mark_sent")
+
+    def wipe(self):
+        self._stop_sync()
+        self._clear_state()
+        self._replace_all([], [], [])
+        self._mark_synced()
+        self._clear_rejected()
+        self.db.execute("DELETE FROM meta")
+        self.db.commit()
+        self._write_session(None)
@@ -0,0 +1,136 @@
+import os
+import time
+import atexit
+import threading
+from collections import deque
+from persistence import compression
+
+
+class SnapshotWriter(object):
+    """
+    Writes storage snapshots to disk on a dedicated thread.
+
+    Snapshot has to be an immutable string, bytes, a tuple of them, or a callable that
+    returns one of those and is called on the writer thread, so the GUI thread can keep
+    mutating storage while it's being written. Every write goes to a temporary file,
+    which is fsynced and then renamed over the old one, so the file on disk
+    is always either the old or the new snapshot, never a torn one.
+
+    Plain saves that arrive while a write is in flight are coalesced, only the
+    latest one gets written. Jobs with hooks act as barriers and keep their order,
+    because hooks move files around (journal segments, stale shards).
+    Other blocking file work (journal fsync) can be queued with call().
+    """
+
+    def __init__(self):
+        self._jobs = deque()
+        self._cond = threading.Condition()
+        self._busy = False
+        self.stats = WriterStats()
+        self._thread = threading.Thread(target=self._run, name='SnapshotWriter', daemon=True)
+        self._thread.start()
+        # Writer thread is a daemon, make sure queued snapshots land before we exit.
+        atexit.register(self.flush)
+
+    def submit(self, path, snapshot, codec=None, level=None, before=None, after=None):
+        with self._cond:
+            last = self._jobs[-1] if self._jobs else None
+            if (before is None and after is None and last is not None
+                    and last['before'] is None and last['after'] is None and last['path'] == path):
+                last.update(snapshot=snapshot, codec=codec, level=level)
+                self.stats.coalesced += 1
+            else:
+                self._jobs.append({'path': path, 'snapshot': snapshot, 'codec': codec, 'level': level,
+                                   'before': before, 'after': after, 'submitted': time.perf_counter()})
+            self._cond.notify_all()
+
+    def call(self, func):
+        """Runs func on the writer thread once the jobs submitted before it are done."""
+        with self._cond:
+            self._jobs.append({'path': None, 'snapshot': None, 'codec': None, 'level': None,
+                               'before': None, 'after': func, 'submitted': time.perf_counter()})
+            self._cond.notify_all()
+
+    def flush(self):
+        """Block until every submitted snapshot is on disk."""
+        with self._cond:
+            while self._jobs or self._busy:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._jobs:
+                    self._cond.wait()
+                job = self._jobs.popleft()
+                self._busy = True
+            try:
+                if job['before']:
+                    job['before']()
+                if job['path'] is not None:
+                    started = time.perf_counter()
+                    size = write_atomic(job['path'], job['snapshot'], job['codec'], job['level'])
+                    self.stats.record(size, job['submitted'], started, time.perf_counter())
+                if job['after']:
+                    job['after']()
+            except Exception as err:
+                print('Snapshot writer error:', err)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+
+def write_atomic(path, snapshot, codec=None, level=None):
+    tmp_path = path + '.tmp'
+    if callable(snapshot):
+        snapshot = snapshot()
+    chunks = snapshot if isinstance(snapshot, tuple) else (snapshot,)
+    with open(tmp_path, 'wb') as raw:
+        # Chunks are compressed one by one, compressed output is never held in memory as a whole.
+        f = compression.open_write(raw, codec, level) if codec else raw
+        for chunk in chunks:
+            f.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if f is not raw:
+            f.close()
+        raw.flush()
+        size = raw.tell()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    # Rename itself is durable only once the directory entry is synced.
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    return size
+
+
+class WriterStats(object):
+    """Counters of what the writer did, updated on the writer thread."""
+
+    def __init__(self):
+        self.writes = 0
+        # Saves that replaced a queued one instead of being written.
+        self.coalesced = 0
+        self.bytes_written = 0
+        # Time from submit to the file being in place, and the part of it spent writing.
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.write_time = 0.0
+
+    def record(self, size, submitted, started, finished):
+        self.writes += 1
+        self.bytes_written += size
+        self.latency += finished - submitted
+        self.max_latency = max(self.max_latency, finished - submitted)
+        self.write_time += finished - started
+
+    def to_json(self):
+        return {
+            'writes': self.writes, 'coalesced': self.coalesced, 'bytes_written': self.bytes_written,
+            'mean_latency': self.latency / self.writes if self.writes else 0.0,
+            'max_latency': self.max_latency,
+            'mean_write_time': self.write_time / self.writes if self.writes else 0.0,
+        }
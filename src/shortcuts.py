@@ -6,6 +6,8 @@ from PyQt5.QtCore import Qt
 shortcuts = {
     'save': QKeySequence(Qt.CTRL + Qt.Key_S),
     'quit': QKeySequence(Qt.CTRL + Qt.Key_Q),
+    'undo': QKeySequence(Qt.CTRL + Qt.Key_Z),
+    'redo': QKeySequence(Qt.CTRL + Qt.SHIFT + Qt.Key_Z),
 }
 
 active_shortcuts = []
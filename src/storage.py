@@ -1,129 +1,696 @@
 import os
+import io
 import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
 from requests.exceptions import ConnectionError
 from utils.singletons import GenericSingleton
 from api.dispatcher import ApiCallDispatcher
-from api.resources import CardResource, TaskResource, PreferenceResource
-from queue import Queue
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import QTimer
-from api.methods import NoInternetConnection, InvalidCredentials
+from api.sync import SyncFailed
+from api.resources import CardResource, TaskResource, PreferenceResource, from_wire
+from PyQt5.QtCore import QObject, QTimer, Qt, pyqtSignal
+from api.methods import NoInternetConnection, InvalidCredentials, BatchFailed
+from persistence.journal import Journal, JOURNAL_SUFFIX
+from persistence.writer import SnapshotWriter
+from persistence.loader import iter_items
+from persistence.baseline import SyncBaseline, BASELINE_SUFFIX, fingerprint
+from persistence.changes import ChangeSet, RESOURCE_TYPES
+from persistence.outbox import Outbox, OUTBOX_SUFFIX, REJECTED_SUFFIX, retry_delay, confirmed_changes
+from persistence.snapshot import StorageSnapshot, CardVersion, decode_fragment, fragment_matches, \
+    FORMAT_JSON, FORMAT_BINARY
+from persistence import binary, compression, events
+from utils.rids import RidAllocator
+from utils import positions
+from utils.sequence import TaskSequence
 
 
 STORAGE_NAME = "storage.json"
+# Pass it as compression to write the storage file uncompressed.
+COMPRESSION_NONE = "none"
+# Whole copy of the last synchronized state kept by older versions, it's turned into a SyncBaseline.
+LEGACY_BASELINE_SUFFIX = ".base"
+# Small file next to the storage file that holds the session token,
+# it's all that has to be read to tell if the user is logged in.
+SESSION_SUFFIX = ".session"
+# Compact the journal into a new snapshot once it grows past this many bytes.
+JOURNAL_COMPACT_SIZE = 4 * 1024 * 1024
+# Cards that aren't open get serialized back once more than this many tasks are hydrated.
+HYDRATION_BUDGET = 50000
+# Number of undo steps kept in memory.
+UNDO_LIMIT = 100
+
+
+class LoaderSignals(QObject):
+    # Emitted from the loader thread, receivers get it on the thread storage was made on.
+    finished = pyqtSignal()
 
 
 def unsave(func):
+    def wrapper(instance, *args, **kwargs):
+        with instance.undo_step(), instance.recording_changes():
+            return_value = func(instance, *args, **kwargs)
+        instance.saved = False
+        instance.synced = False
+        instance.rids.observe_all(args)
+        instance.mark_changed(args)
+        if instance.journal:
+            instance.journal_record(func.__name__, args)
+        instance.notify_mutation()
+        return return_value
+    return wrapper
+
+
+def unsave_all(func):
+    # Used by methods that replace the whole state, there is nothing to journal there.
     def wrapper(instance, *args, **kwargs):
         return_value = func(instance, *args, **kwargs)
         instance.saved = False
+        instance.mark_all_changed()
+        instance.notify_mutation()
         return return_value
     return wrapper
 
 
+def unsave_positions(func):
+    # Used by methods that give resources other keys in the same order, there's nothing to undo.
+    def wrapper(instance, *args):
+        with instance.recording_changes():
+            func(instance, *args)
+        instance.saved = False
+        if instance.journal:
+            instance.journal_record(func.__name__, args)
+        instance.notify_mutation()
+    return wrapper
+
+
 class Storage(object, metaclass=GenericSingleton):
 
+    default_name = STORAGE_NAME
+    # Whether load_in_background() can load on another thread.
+    loads_in_background = True
+    # Whether mutations are recorded in a ChangeSet, so sync doesn't have to diff the whole state.
+    tracks_changes = True
 
+    def __new__(cls, *args, **kwargs):
+        # Storage(backend='sqlite') gives you the SQLite engine behind the same interface,
+        # backend='sharded' keeps every card in a file of its own.
+        if cls is Storage and kwargs.get('backend', 'json') == 'sqlite':
+            from persistence.sqlite import SqliteStorage
+            cls = SqliteStorage
+        elif cls is Storage and kwargs.get('backend', 'json') == 'sharded':
+            from persistence.sharded import ShardedStorage
+            cls = ShardedStorage
+        return super().__new__(cls)
 
-    def __init__(self, filename=None, path=None):
-        self.name = filename if filename else STORAGE_NAME
+    def __init__(self, filename=None, path=None, journaled=False, backend='json', storage_format=None,
+                 compression=None, compression_level=None, deferred=False):
+        self.name = filename if filename else self.default_name
+        # Format snapshots are written in, if it's None the format of the loaded file is kept.
+        self.format = storage_format
+        # Same goes for the compression codec, files are decompressed transparently whatever it is.
+        self.compression = compression
+        self.compression_level = compression_level
         if path:
-            if path.endswith(filename):
+            if path.endswith(self.name):
                 self.path = path
             else:
-                self.path = os.path.join(path, filename)
+                self.path = os.path.join(path, self.name)
         else:
             self.path = os.path.join(os.getcwd(), self.name)
 
         self.cards = []
-        self.card_rids = set()
-        self._tasks = {}
-        self.task_rids = set()
+        # Rid indexes, card rid -> card and task rid -> card rid.
+        # Rid sets are just views of them.
+        self._card_index = {}
+        self.card_rids = self._card_index.keys()
+        self._task_index = {}
+        # Task rid -> position key, tasks of a card are ordered by them, so the key finds the index.
+        # Entries can be outdated, locate_task checks the task it finds.
+        self._task_keys = {}
+        # Only cards whose tasks were accessed are here, others are kept serialized in _fragments.
+        # Ordered from least to most recently used, every card holds a TaskSequence.
+        self._tasks = OrderedDict()
+        self.hydration_budget = HYDRATION_BUDGET
+        # Open card rids mapped to number of times they were opened, these are never evicted.
+        self._open_cards = {}
+        self.task_rids = self._task_index.keys()
         self.preferences = {}
         self.preference_rids = set()
         self.token = None
-        # You have to load first, in order to check if token exists.
-        with open(self.path, 'r') as f:
-            self.load_from_file(f)
-
-        # Check saved attribute to see if file content and storage object are synchronized.
-        self.saved = True
+        # Source of new rids, persisted with the snapshot.
+        self.rids = RidAllocator()
+        # Serialized tasks of every card that wasn't touched since it was last serialized.
+        self._fragments = {}
+        self.journal_seq = 0
+        # In journaled mode mutations are appended to the journal as they happen
+        # and save() only has to fsync it, full snapshot is written on compaction.
+        self.journal = Journal(self.path + JOURNAL_SUFFIX) if journaled else None
+        self.journal_limit = JOURNAL_COMPACT_SIZE
+        # GUI thread only takes snapshots, they are serialized and written on the writer thread.
+        self.writer = SnapshotWriter()
+        # Card rid -> generation of its tasks, bumped on every change, and the CardVersion
+        # of the latest generation that was snapshotted.
+        self._generation = 0
+        self._generations = {}
+        self._versions = {}
+        # Undo and redo stacks of snapshots.
+        self._undo = []
+        self._redo = []
+        self._undo_depth = 0
+        self.undo_limit = UNDO_LIMIT
+        # Card rid -> observers of changes to that card, observers under None get every change.
+        self._change_observers = {}
+        # Called after every mutation, without arguments.
+        self._mutation_observers = []
+        self.session_path = self.path + SESSION_SUFFIX
+        # Fingerprints of what the server has, sync() diffs the current state against it.
+        self.baseline = SyncBaseline()
+        self.baseline_path = self.path + BASELINE_SUFFIX
+        # (kind, resource, old position) of resources rekey() gave new keys, the server doesn't have them yet.
+        self._rekeyed = []
+        # What changed since the last sync, events are recorded into it while a mutator runs.
+        self.changes = ChangeSet(self.baseline) if self.tracks_changes else None
+        self._recording = 0
+        # Synced operations the server hasn't confirmed, see sync().
+        self.outbox = Outbox()
+        self.outbox_path = self.path + OUTBOX_SUFFIX
+        self.rejected_path = self.path + REJECTED_SUFFIX
+        self._sync_job = None
+        self._sync_again = False
+        self._retry_timer = None
+        # Failed syncs in a row, retries back off with it.
+        self._sync_failures = 0
+        # Change set as it was read from the snapshot, load_baseline() checks it against the baseline.
+        self._stored_changes = None
+        # True once the token came from the session file or a login, it's newer than the one in the snapshot.
+        self._session = False
+        self._loaded = False
+        self._loader = None
+        self._load_error = None
+        # Called once the loader thread is done, and what the observers saw before it started.
+        self._on_loaded = []
+        self._state_before_load = None
+        self._loader_signals = LoaderSignals()
+        self._loader_signals.finished.connect(self._loader_finished, Qt.QueuedConnection)
         # If debug is True, calling save() won't save anything.
         self.debug = False
+        # You have to know the token, in order to tell if the user is logged in. Deferred storage
+        # reads just the session file, the rest is loaded by load_in_background() or wait_loaded().
+        # Check saved attribute to see if file content and storage object are synchronized,
+        # and synced to see if the server has every change, load tells what it found.
+        self.saved = True
+        self.synced = True
+        if not (deferred and self.read_session()):
+            self._load_all()
 
-        self.output_queue = Queue()
-        self.dispatcher = ApiCallDispatcher(self.output_queue)
+        self.dispatcher = ApiCallDispatcher()
         if self.token:
             self.dispatcher.token = self.token
 
-    @unsave
-    def fetch_cards(self):
-        jid = self.dispatcher.get_cards()
+    @unsave_all
+    def fetch_cards(self, jid=None):
+        if jid is None:
+            jid = self.dispatcher.get_cards()
         future = self.extract_future(jid)
 
-        self.cards = future.result()
+        self.cards = sorted(future.result(), key=lambda card: positions.sort_key(card.position))
+        self._rekey('cards', self.cards)
+        self.rids.observe_all(self.cards)
+        self._card_index.clear()
+        self._task_index.clear()
+        self._task_keys = {}
+        self._tasks.clear()
         for c in self.cards:
-            self.card_rids.add(c.rid)
-            self._tasks[c.rid] = []
+            self._card_index[c.rid] = c
+            self._tasks[c.rid] = TaskSequence()
         print('Cards updated.')
 
-    @unsave
-    def fetch_tasks(self):
-        jid = self.dispatcher.get_tasks()
+    @unsave_all
+    def fetch_tasks(self, jid=None):
+        if jid is None:
+            jid = self.dispatcher.get_tasks()
         future = self.extract_future(jid)
 
         for task in future.result():
-            task_pos = task.position
-            curr_len = len(self._tasks[task.card_rid])
-            if curr_len <= task_pos:
-                self._tasks[task.card_rid].extend([0] * (1 + task_pos - curr_len))
-            self._tasks[task.card_rid][task_pos] = task
-            self.task_rids.add(task.rid)
+            if task.card_rid not in self._card_index:
+                # Requests aren't atomic, card was created on the server after cards were sent.
+                continue
+            self.rids.observe('tasks', task.rid)
+            self.tasks(task.card_rid).append(task)
+            self._task_index[task.rid] = task.card_rid
+        for task_list in self._tasks.values():
+            task_list.sort(key=lambda task: positions.sort_key(task.position))
+            self._rekey('tasks', task_list)
         print('Taks updated.')
 
-    @unsave
-    def fetch_preferences(self):
+    @unsave_all
+    def fetch_preferences(self, jid=None):
         self.preferences = {}
-        jid = self.dispatcher.get_preferences()
+        if jid is None:
+            jid = self.dispatcher.get_preferences()
         future = self.extract_future(jid)
 
         for pref in future.result():
+            if pref.card_rid not in self._card_index:
+                continue
+            self.rids.observe('preferences', pref.rid)
             self.preferences[pref.card_rid] = pref
             self.preference_rids.add(pref.rid)
 
     def fetch_all(self):
-        self.fetch_cards()
-        self.fetch_tasks()
-        self.fetch_preferences()
-        self.save()
+        # Fetched state replaces the local one, changes the server doesn't have yet go out first.
+        if self._pending_sync() and not self.flush_sync():
+            raise RuntimeError("Changes couldn't be synced, fetching would lose them.")
+        old_state = self._observed_state()
+        # All three requests are in flight at once, so this waits for the slowest one only.
+        # Tasks are put into the buckets of the fetched cards, so cards go in first.
+        jids = self.dispatcher.get_cards(), self.dispatcher.get_tasks(), self.dispatcher.get_preferences()
+        self._rekeyed = []
+        self.fetch_cards(jids[0])
+        self.fetch_tasks(jids[1])
+        self.fetch_preferences(jids[2])
+        self.clear_history()
+        self._notify_replaced(old_state)
+        self.synced = True
+        # Fetched state is what the server has, so it becomes the new baseline.
+        self.baseline = SyncBaseline.from_data(self.snapshot(), self.baseline.generation + 1)
+        self.changes = ChangeSet(self.baseline)
+        self._record_rekeyed(in_baseline=True)
+        self._write_baseline()
+        if self.journal:
+            self.compact()
+            self.saved = True
+        else:
+            self.save()
+
+
+    def reconcile(self):
+        """
+        Brings in what changed on the server since the last sync without fetching
+        everything, only parts of the hash tree that differ are transferred (see api.merkle).
+        Resources that changed here as well keep the local version, next sync uploads it.
+        """
+        jid = self.dispatcher.reconcile(self.snapshot())
+        divergence = self.extract_future(jid).result()
+        self.apply_divergence(divergence)
+        print('Reconciled {} resources in {} requests, {} transferred.'.format(
+            len(divergence), divergence.requests, divergence.transferred))
+        return divergence
+
+    def apply_divergence(self, divergence):
+        remote_fps = {kind: {rid: fingerprint(RESOURCE_TYPES[kind].from_json(remote).to_json())
+                             if remote is not None else None
+                             for rid, (local, remote) in resources.items()}
+                      for kind, resources in divergence.resources.items()}
+
+        def incoming(kind):
+            # Remote version is taken only where the local one is still what the server had before.
+            resources = divergence.resources[kind]
+            # Baseline counts the outbox in, operations in it are local changes just the same.
+            return {rid: remote for rid, (local, remote) in resources.items()
+                    if (fingerprint(local) if local is not None else None) == self.baseline.fingerprints[kind].get(rid)
+                    and (kind, rid) not in self.outbox}
+
+        cards, tasks, prefs = incoming('cards'), incoming('tasks'), incoming('preferences')
+        remote_prefs = {pref['card_rid']: pref for pref in prefs.values() if pref is not None}
+        with self.undo_step():
+            for card_rid, card in cards.items():
+                if card is not None and card_rid in self._card_index:
+                    # Renamed or moved on another device.
+                    self.update_card(card_rid, CardResource.from_json(card))
+                elif card is not None:
+                    self.rids.observe('cards', card_rid)
+                    self.add_card(CardResource.from_json(card))
+                    pref = remote_prefs.pop(card_rid, None)
+                    if pref is not None:
+                        self.rids.observe('preferences', pref['rid'])
+                        self.add_preference(card_rid, PreferenceResource.from_json(pref))
+            for card_rid, pref in remote_prefs.items():
+                if card_rid in self._card_index:
+                    self.rids.observe('preferences', pref['rid'])
+                    self.replace_preference(card_rid, PreferenceResource.from_json(pref))
+            # Tasks leave their old places before any of them is put into a new one.
+            for task_rid in tasks:
+                location = self.locate_task(task_rid)
+                if location is not None:
+                    self.pop_task(*location)
+            for task in sorted((task for task in tasks.values() if task is not None),
+                               key=lambda task: positions.sort_key(task['position'])):
+                if task['card_rid'] not in self._card_index:
+                    # Card was removed here, so is the task.
+                    continue
+                self.rids.observe('tasks', task['rid'])
+                task_list = self.tasks(task['card_rid'])
+                key = positions.sort_key(task['position'])
+                idx = next((i for i, other in enumerate(task_list) if positions.sort_key(other.position) > key),
+                           len(task_list))
+                self.insert_task(task['card_rid'], idx, TaskResource.from_json(task))
+            for card_rid, card in cards.items():
+                if card is None and card_rid in self._card_index:
+                    self.remove_card(card_rid)
+        self.clear_history()
+        self._settle_divergence(divergence, remote_fps)
+
+    def _settle_divergence(self, divergence, remote_fps):
+        # Diverged rids are settled against what the server has now, whatever is left is uploaded by sync.
+        self.baseline.apply(remote_fps)
+        for kind, fps in remote_fps.items():
+            for rid in fps:
+                self.changes.settle(kind, rid, self._resource(kind, rid))
+        self._write_baseline()
+        if self.journal:
+            self.compact()
+            self.saved = True
+        else:
+            self.save()
+
+    def _resource(self, kind, rid):
+        if kind == 'cards':
+            return self._card_index.get(rid)
+        if kind == 'tasks':
+            location = self.locate_task(rid)
+            return self.tasks(location[0])[location[1]] if location is not None else None
+        return next((pref for pref in self.preferences.values() if pref.rid == rid), None)
 
 
     def extract_future(self, jid):
-        while True:
-            QApplication.processEvents()
-            if self.output_queue.empty():
-                continue
-            job_id, future = self.output_queue.get()
-            if job_id != jid:
-                self.output_queue.put((job_id, future))
-                continue
-            return future
+        # Blocks in an event loop until the job's signal arrives, GUI keeps running meanwhile.
+        return self.dispatcher.wait(jid)
+
 
+    def read_session(self):
+        """Reads the token from the session file, returns False if there's no session file."""
+        try:
+            with open(self.session_path, 'r') as f:
+                self.token = json.load(f)['token']
+        except (OSError, ValueError, KeyError):
+            return False
+        self._session = True
+        return True
+
+    def _write_session(self, token):
+        if self.debug:
+            return
+        self.writer.submit(self.session_path, json.dumps({'token': token}))
+
+    def _load_all(self):
+        token = self.token
+        self.load()
+        if self._session:
+            self.token = token
+        else:
+            # Session file is written once, from then on startup doesn't have to load everything.
+            self._session = True
+            self._write_session(self.token)
+        self.saved = True
+        # Changes recorded before the restart and the outbox still have to go out.
+        self.synced = not self._pending_sync()
+        self._loaded = True
+
+    def _pending_sync(self):
+        """True if some of the state hasn't reached the server yet."""
+        if self.outbox:
+            return True
+        if self.changes.complete:
+            return bool(self.changes)
+        changes, _ = self.baseline.diff(self.snapshot())
+        return any(part for kind_changes in changes.values() for part in kind_changes)
+
+    def load_in_background(self, on_done=None):
+        """
+        Starts loading the whole state on a thread, storage can't be used until wait_loaded() returns.
+        on_done() is called on the GUI thread once wait_loaded() doesn't have to wait anymore.
+        """
+        if self._loader is None and (self._loaded or not self.loads_in_background):
+            if on_done is not None:
+                on_done()
+            return
+        if on_done is not None:
+            self._on_loaded.append(on_done)
+        if self._loader is not None:
+            return
+        # Observers made before the load get the loaded state as events, see wait_loaded().
+        self._state_before_load = self._observed_state()
+        self._loader = threading.Thread(target=self._load_in_thread, name='StorageLoader', daemon=True)
+        self._loader.start()
+
+    def _load_in_thread(self):
+        try:
+            self._load_all()
+        except Exception as err:
+            self._load_error = err
+        finally:
+            self._loader_signals.finished.emit()
+
+    def _loader_finished(self):
+        callbacks, self._on_loaded = self._on_loaded, []
+        for callback in callbacks:
+            callback()
+
+    def wait_loaded(self):
+        """Blocks until the whole state is loaded, loads it right away if nothing did so yet."""
+        if self._loader is None:
+            if not self._loaded:
+                old_state = self._observed_state()
+                self._load_all()
+                self._notify_replaced(old_state)
+            return
+        self._loader.join()
+        self._loader = None
+        old_state, self._state_before_load = self._state_before_load, None
+        if self._load_error is not None:
+            err, self._load_error = self._load_error, None
+            raise err
+        self._notify_replaced(old_state)
+
+    def load(self):
+        self.load_snapshot(self.path)
+        self.load_baseline()
+        if self.journal:
+            self.replay_journal()
+
+    def load_baseline(self):
+        self.load_outbox()
+        stored_changes, self._stored_changes = self._stored_changes, None
+        try:
+            self.baseline = SyncBaseline.read(self.baseline_path)
+        except (OSError, ValueError):
+            pass
+        else:
+            # Changes of the journal are recorded again as it's replayed.
+            if stored_changes is not None:
+                self.changes = ChangeSet.from_json(stored_changes, self.baseline)
+            else:
+                self.changes = ChangeSet(self.baseline, complete=False)
+            self._record_rekeyed()
+            return
+        legacy_path = self.path + LEGACY_BASELINE_SUFFIX
+        if os.path.exists(legacy_path):
+            with compression.open_read(legacy_path) as f:
+                raw = f.read()
+            data = binary.decode_data(raw) if binary.is_binary(raw) else json.loads(raw.decode('utf-8'))
+            # Old copies have the integer positions the server has.
+            for kind in ('cards', 'tasks'):
+                data[kind] = [from_wire(res) for res in data[kind]]
+            self.baseline = SyncBaseline.from_data(data)
+            self.changes = ChangeSet(self.baseline, complete=False)
+            self._record_rekeyed()
+            self._write_baseline(after=lambda: os.remove(legacy_path))
+            return
+        # Snapshot was the synchronized state whenever there was no legacy baseline,
+        # whatever is in the journal on top of it is not.
+        self.baseline = SyncBaseline.from_data(self.snapshot())
+        self.changes = ChangeSet(self.baseline)
+        # Snapshot gave keys to tasks of the cards that aren't loaded yet, the same ones they'll get when loaded.
+        for card in self.cards:
+            if card.rid not in self._tasks:
+                self._rekey('tasks', [TaskResource.from_json(res)
+                                      for res in decode_fragment(self._stored_fragment(card.rid))])
+        self._record_rekeyed(in_baseline=True)
+        self._write_baseline()
+
+    def _rekey(self, kind, resources):
+        """positions.rekey() that remembers the replaced positions, see _record_rekeyed()."""
+        changed = positions.rekey(resources)
+        self._rekeyed.extend((kind, res, old_position) for res, old_position in changed)
+        return changed
+
+    def _record_rekeyed(self, in_baseline=False):
+        """
+        Records new keys given by _rekey() as changes, so the server gets them with the next sync,
+        otherwise it keeps the old positions and orders the resources differently.
+        in_baseline tells the baseline was built from the rekeyed state, it gets the old positions back.
+        """
+        rekeyed, self._rekeyed = self._rekeyed, []
+        for kind, res, old_position in rekeyed:
+            if in_baseline:
+                self.baseline.fingerprints[kind][res.rid] = fingerprint(dict(res.to_json(), position=old_position))
+            if self.changes is not None:
+                self.changes.upsert(kind, res, ('position',))
+
+    def _write_baseline(self, baseline=None, after=None):
+        if self.debug:
+            return
+        # Baseline is updated in place, the writer gets a copy.
+        baseline = baseline if baseline is not None else self.baseline.copy()
+        self.writer.submit(self.baseline_path, baseline.to_bytes, after=after)
+
+    def load_snapshot(self, path):
+        with open(path, 'rb') as f:
+            codec = compression.detect(f.read(compression.MAGIC_LENGTH))
+        with compression.open_read(path) as f:
+            is_binary = binary.is_binary(f.peek(len(binary.MAGIC))[:len(binary.MAGIC)])
+            if is_binary:
+                self.load_from_binary(f)
+            else:
+                with io.TextIOWrapper(f, encoding='utf-8') as text:
+                    self.load_from_file(text)
+        if self.format is None:
+            self.format = FORMAT_BINARY if is_binary else FORMAT_JSON
+        if self.compression is None:
+            self.compression = codec
+        elif self.compression == COMPRESSION_NONE:
+            self.compression = None
 
     def load_from_file(self, f):
-        data = json.load(f)
-        self.cards = [CardResource.from_json(res) for res in data['cards']]
-        self._tasks = {card.rid: [] for card in self.cards}
-        for task_data in data['tasks']:
-            task_res = TaskResource.from_json(task_data)
-            self._tasks[task_res.card_rid].append(task_res)
-            self.task_rids.add(task_res.rid)
+        # File is parsed as a stream, tasks are kept as JSON text of each card
+        # and they become TaskResource objects only when the card is accessed.
+        self.cards = []
+        self._tasks = OrderedDict()
+        self.preferences = {}
+        task_texts = {}
+        for key, value, text in iter_items(f):
+            if key == 'cards':
+                card = CardResource.from_json(value)
+                self.cards.append(card)
+                self._card_index[card.rid] = card
+                self.rids.observe('cards', card.rid)
+            elif key == 'tasks':
+                task_texts.setdefault(value['card_rid'], []).append(text)
+                self._task_index[value['rid']] = value['card_rid']
+                self.rids.observe('tasks', value['rid'])
+            elif key == 'preferences':
+                pref = PreferenceResource.from_json(value)
+                self.preferences[pref.card_rid] = pref
+                self.preference_rids.add(pref.rid)
+                self.rids.observe('preferences', pref.rid)
+            elif key == 'token':
+                self.token = value
+            elif key == 'rids':
+                self.rids.update(value)
+            elif key == 'journal_seq':
+                self.journal_seq = value
+            elif key == 'changes':
+                self._stored_changes = value
+        self._fragments = {card.rid: ', '.join(task_texts.get(card.rid, ())) for card in self.cards}
+        # Files written before position keys have integer positions.
+        self._rekey('cards', self.cards)
+
+    def load_from_binary(self, f):
+        # Task segments are kept encoded until the card is accessed, same as json fragments.
+        cards, preferences, meta, segments = binary.decode_snapshot(f.read())
+        self.cards = [CardResource.from_json(res) for res in cards]
+        self._tasks = OrderedDict()
+        for card in self.cards:
+            self._card_index[card.rid] = card
+            self.rids.observe('cards', card.rid)
+            segment = segments.get(card.rid, b'')
+            self._fragments[card.rid] = segment
+            for task_rid in binary.task_rids(segment):
+                self._task_index[task_rid] = card.rid
+                self.rids.observe('tasks', task_rid)
         self.preferences = {}
-        for resource in data['preferences']:
+        for resource in preferences:
             pref = PreferenceResource.from_json(resource)
             self.preferences[pref.card_rid] = pref
             self.preference_rids.add(pref.rid)
-        self.token = data['token']
+            self.rids.observe('preferences', pref.rid)
+        self.token = meta.get('token')
+        self.rids.update(meta.get('rids', {}))
+        self.journal_seq = meta.get('journal_seq', 0)
+        self._stored_changes = meta.get('changes')
+        self._rekey('cards', self.cards)
+
+    def _fragment(self, card_rid):
+        # Fragments are cached in the format snapshots are written in.
+        fragment = self._fragments.get(card_rid)
+        if fragment_matches(fragment, self.format):
+            return fragment
+        fragment = self._version(card_rid).fragment(self.format)
+        self._fragments[card_rid] = fragment
+        return fragment
+
+    def _stored_fragment(self, card_rid):
+        return self._fragments.get(card_rid, '')
+
+    def _hydrate(self, card_rid):
+        if card_rid not in self.card_rids:
+            raise KeyError(card_rid)
+        task_list = [TaskResource.from_json(res) for res in decode_fragment(self._stored_fragment(card_rid))]
+        if self._rekey('tasks', task_list):
+            self._fragments.pop(card_rid, None)
+            self._touch(card_rid)
+            self._record_rekeyed()
+        task_list = TaskSequence(task_list)
+        self._tasks[card_rid] = task_list
+        self._evict()
+        return task_list
+
+    def _evict(self):
+        hydrated = sum(len(task_list) for task_list in self._tasks.values())
+        for card_rid in list(self._tasks):
+            if hydrated <= self.hydration_budget:
+                return
+            if card_rid in self._open_cards:
+                continue
+            # Cards touched since they were hydrated have to be serialized first.
+            self._fragment(card_rid)
+            hydrated -= len(self._tasks.pop(card_rid))
+            self._versions.pop(card_rid, None)
+
+    def open_card(self, card_rid):
+        self._open_cards[card_rid] = self._open_cards.get(card_rid, 0) + 1
+
+    def close_card(self, card_rid):
+        count = self._open_cards.pop(card_rid, 0) - 1
+        if count > 0:
+            self._open_cards[card_rid] = count
+        self._evict()
+
+    def replay_journal(self):
+        journal, self.journal = self.journal, None
+        # Replayed mutations were already there when the app was closed, they aren't undo steps.
+        self._undo_depth += 1
+        try:
+            for seq, method_name, args in journal.records(after_seq=self.journal_seq):
+                getattr(self, method_name)(*args)
+        finally:
+            self.journal = journal
+            self._undo_depth -= 1
+        journal.seq = max(journal.seq, self.journal_seq)
+
+    def mark_changed(self, args):
+        # Every mutator takes card rid (or the card itself) as the first argument.
+        card_rid = args[0].rid if isinstance(args[0], CardResource) else args[0]
+        # New generation gets the card a new version, and a new fragment when it's saved.
+        self._touch(card_rid)
+        # Serialized tasks are the only copy of a card that wasn't hydrated.
+        if card_rid in self._tasks:
+            self._fragments.pop(card_rid, None)
+
+    def mark_all_changed(self):
+        for card_rid in self.card_rids:
+            self._touch(card_rid)
+        self._fragments = {}
+
+    def journal_record(self, method_name, args):
+        if self.debug:
+            return
+        self.journal.append(method_name, args)
+        if self.journal.size() > self.journal_limit:
+            self.compact()
 
     def is_authenticated(self):
         if self.token is None:
@@ -143,6 +710,8 @@ class Storage(object, metaclass=GenericSingleton):
         if isinstance(token, str):
             self.dispatcher.token = token
             self.token = token
+            self._session = True
+            self._write_session(token)
         else:
             return InvalidCredentials
         return True
@@ -161,6 +730,70 @@ class Storage(object, metaclass=GenericSingleton):
         else:
             return reg_message
 
+    def on_change(self, observer, card_rid=None):
+        """observer(event) is called with every event of the card, or of every card if card_rid is None."""
+        self._change_observers.setdefault(card_rid, []).append(observer)
+
+    def remove_observer(self, observer, card_rid=None):
+        observers = self._change_observers.get(card_rid, [])
+        if observer in observers:
+            observers.remove(observer)
+        if not observers:
+            self._change_observers.pop(card_rid, None)
+
+    def on_mutation(self, observer):
+        self._mutation_observers.append(observer)
+
+    def remove_mutation_observer(self, observer):
+        if observer in self._mutation_observers:
+            self._mutation_observers.remove(observer)
+
+    def notify_mutation(self):
+        if not self._loaded:
+            # Journal is being replayed, observers get the loaded state at once, see wait_loaded().
+            return
+        for observer in list(self._mutation_observers):
+            observer()
+
+    @contextmanager
+    def recording_changes(self):
+        """Events emitted inside the block go into the change set."""
+        self._recording += 1
+        try:
+            yield
+        finally:
+            self._recording -= 1
+
+    def notify_change(self, event):
+        if self._recording and self.changes is not None:
+            self.changes.record(event)
+        if not self._change_observers or not self._loaded:
+            return
+        for key in (None, event.card_rid):
+            # Observers can stop observing while they handle the event.
+            for observer in list(self._change_observers.get(key, ())):
+                observer(event)
+
+    def _observed(self, card_rid):
+        return None in self._change_observers or card_rid in self._change_observers
+
+    def _observed_state(self):
+        """State that _notify_replaced compares against, None if nobody is observing."""
+        if not self._change_observers:
+            return None
+        return (list(self.cards), dict(self.preferences),
+                {card.rid: list(self.tasks(card.rid)) for card in self.cards if self._observed(card.rid)})
+
+    def _notify_replaced(self, old_state):
+        # Used after the state was replaced wholesale, views only get what actually changed.
+        if old_state is None:
+            return
+        old_cards, old_preferences, old_tasks = old_state
+        task_lists = {card_rid: (tasks, self.tasks(card_rid)) for card_rid, tasks in old_tasks.items()
+                      if card_rid in self.card_rids}
+        for event in events.diff_state(old_cards, old_preferences, self.cards, self.preferences, task_lists):
+            self.notify_change(event)
+
     def get_preference(self, card_rid):
         return self.preferences[card_rid]
 
@@ -168,33 +801,81 @@ class Storage(object, metaclass=GenericSingleton):
         return getattr(self.preferences[card_rid], field)
 
     def get_card(self, card_rid):
-        for c in self.cards:
-            if c.rid == card_rid:
-                return c
-        raise ValueError("Card with rid {} doesn't exist.".format(card_rid))
+        card = self._card_index.get(card_rid)
+        if card is None:
+            raise ValueError("Card with rid {} doesn't exist.".format(card_rid))
+        return card
 
     def get_task(self, card_rid, task_idx):
-        return self._tasks[card_rid][task_idx]
+        return self.tasks(card_rid)[task_idx]
 
     def find_task(self, card_rid, task_rid):
-        for t in self._tasks[card_rid]:
-            if t.rid == task_rid:
-                return t
-        raise ValueError("Task with rid {} doesn't exist".format(task_rid))
+        location = self.locate_task(task_rid)
+        if location is None or location[0] != card_rid:
+            raise ValueError("Task with rid {} doesn't exist".format(task_rid))
+        return self.tasks(card_rid)[location[1]]
+
+    def locate_task(self, task_rid):
+        """Returns (card_rid, index) of the task, or None if there's no such task."""
+        card_rid = self._task_index.get(task_rid)
+        if card_rid is None:
+            return None
+        task_list = self.tasks(card_rid)
+        key = self._task_keys.get(task_rid)
+        if key is not None:
+            idx = task_list.bisect_left(positions.sort_key(key), lambda task: positions.sort_key(task.position))
+            if idx < len(task_list) and task_list[idx].rid == task_rid:
+                return card_rid, idx
+        # Key of the task isn't known, or the card was replaced since, keys of the card are read again.
+        location = None
+        for idx, task in enumerate(task_list):
+            self._task_keys[task.rid] = task.position
+            if task.rid == task_rid:
+                location = card_rid, idx
+        return location
+
+    def new_rid(self, kind):
+        return self.rids.allocate(kind)
+
+    def reserve_rids(self, kind, count):
+        return self.rids.reserve(kind, count)
 
     def tasks(self, card_rid):
-        return self._tasks[card_rid]
+        task_list = self._tasks.get(card_rid)
+        if task_list is None:
+            return self._hydrate(card_rid)
+        self._tasks.move_to_end(card_rid)
+        return task_list
+
+    def _position_at(self, resource_list, idx):
+        """Key for a resource placed at idx, between its neighbours in resource_list."""
+        before = resource_list[idx - 1].position if idx > 0 else None
+        after = resource_list[idx + 1].position if idx + 1 < len(resource_list) else None
+        return positions.key_between(before, after)
+
+    def _position_fits(self, resource_list, idx):
+        # Resources that come from the server keep their keys if they can.
+        before = resource_list[idx - 1].position if idx > 0 else None
+        after = resource_list[idx + 1].position if idx + 1 < len(resource_list) else None
+        return positions.fits(resource_list[idx].position, before, after)
 
     @unsave
     def add_card(self, card_resource):
         self.cards.append(card_resource)
-        self.card_rids.add(card_resource.rid)
-        self._tasks[card_resource.rid] = []
+        if not self._position_fits(self.cards, len(self.cards) - 1):
+            card_resource.position = self._position_at(self.cards, len(self.cards) - 1)
+        self._card_index[card_resource.rid] = card_resource
+        self._tasks[card_resource.rid] = TaskSequence()
+        self.notify_change(events.CardAdded(card_resource.rid, len(self.cards) - 1, card_resource))
 
     @unsave
     def add_task(self, card_rid, task_resource):
-        self._tasks[card_rid].append(task_resource)
-        self.task_rids.add(task_resource.rid)
+        task_list = self.tasks(card_rid)
+        task_list.append(task_resource)
+        task_resource.position = self._position_at(task_list, len(task_list) - 1)
+        self._task_index[task_resource.rid] = card_rid
+        self._task_keys[task_resource.rid] = task_resource.position
+        self.notify_change(events.TaskInserted(card_rid, len(task_list) - 1, task_resource))
 
     @unsave
     def add_preference(self, card_rid, preference_resource):
@@ -203,127 +884,508 @@ class Storage(object, metaclass=GenericSingleton):
                              "already has preference set.".format(card_rid))
         self.preferences[card_rid] = preference_resource
         self.preference_rids.add(preference_resource.rid)
+        self.notify_change(events.PreferenceChanged(
+            card_rid, events.changed_fields(None, preference_resource), preference_resource))
 
     @unsave
     def remove_card(self, card_rid):
-        index = -1
-        for idx, card in enumerate(self.cards):
-            if card.rid == card_rid:
-                index = idx
-                break
-        assert index != -1, "Can't remove card, card with rid={} doesn't exist.".format(card_rid)
-
-        self.cards.pop(index)
-        self.card_rids.remove(card_rid)
-        tasks = self._tasks.pop(card_rid)
+        assert card_rid in self._card_index, "Can't remove card, card with rid={} doesn't exist.".format(card_rid)
+
+        tasks = self.tasks(card_rid)
+        card = self._card_index.pop(card_rid)
+        card_idx = self.cards.index(card)
+        del self.cards[card_idx]
+        self._tasks.pop(card_rid, None)
+        self._fragments.pop(card_rid, None)
         for task in tasks:
-            self.task_rids.remove(task.rid)
+            del self._task_index[task.rid]
+            self._task_keys.pop(task.rid, None)
         pref = self.preferences.pop(card_rid)
         self.preference_rids.remove(pref.rid)
+        self.notify_change(events.CardRemoved(card_rid, card_idx, card, [task.rid for task in tasks], pref))
 
     @unsave
     def pop_task(self, card_rid, task_index):
-        task = self._tasks[card_rid].pop(task_index)
-        self.task_rids.remove(task.rid)
+        task_list = self.tasks(card_rid)
+        if task_index < 0:
+            task_index += len(task_list)
+        task = task_list.pop(task_index)
+        del self._task_index[task.rid]
+        self._task_keys.pop(task.rid, None)
+        self.notify_change(events.TaskRemoved(card_rid, task_index, task))
         return task
 
     @unsave
     def insert_task(self, card_rid, idx, task_resource):
-        self._tasks[card_rid].insert(idx, task_resource)
-        self.task_rids.add(task_resource.rid)
+        task_list = self.tasks(card_rid)
+        # Mimic list.insert for out of range and negative indexes.
+        if idx < 0:
+            idx = max(0, len(task_list) + idx)
+        idx = min(idx, len(task_list))
+        task_list.insert(idx, task_resource)
+        # Neighbours keep their positions, only the new task gets one, unless the one it has fits there.
+        if not self._position_fits(task_list, idx):
+            task_resource.position = self._position_at(task_list, idx)
+        self._task_index[task_resource.rid] = card_rid
+        self._task_keys[task_resource.rid] = task_resource.position
+        self.notify_change(events.TaskInserted(card_rid, idx, task_resource))
 
     @unsave
     def move_task(self, card_rid, old_idx, new_idx):
-        task_list = self._tasks[card_rid]
-        task = task_list[old_idx]
-        if old_idx < new_idx:
-            for idx in range(old_idx, new_idx):
-                task_list[idx] = task_list[idx + 1]
-        else:
-            for idx in range(old_idx, new_idx, -1):
-                task_list[idx] = task_list[idx - 1]
+        task_list = self.tasks(card_rid)
+        if old_idx < 0:
+            old_idx += len(task_list)
+        task = task_list.pop(old_idx)
+        if new_idx < 0:
+            new_idx = max(0, len(task_list) + new_idx)
+        new_idx = min(new_idx, len(task_list))
+        task_list.insert(new_idx, task)
+        # Moved task is the only one whose position changes.
+        task = task.replace(position=self._position_at(task_list, new_idx))
         task_list[new_idx] = task
+        self._task_keys[task.rid] = task.position
+        self.notify_change(events.TaskMoved(card_rid, old_idx, new_idx, task))
 
     @unsave
     def update_task(self, card_rid, idx, task_resource):
-        self._tasks[card_rid][idx] = task_resource
+        task_list = self.tasks(card_rid)
+        if idx < 0:
+            idx += len(task_list)
+        old_task = task_list[idx]
+        if task_resource.position != old_task.position:
+            task_resource = task_resource.replace(position=old_task.position)
+        task_list[idx] = task_resource
+        if old_task.rid != task_resource.rid:
+            del self._task_index[old_task.rid]
+            self._task_keys.pop(old_task.rid, None)
+            self._task_index[task_resource.rid] = card_rid
+            self._task_keys[task_resource.rid] = task_resource.position
+        self.notify_change(events.TaskUpdated(card_rid, idx, task_resource, old_task))
+
+    def _replace_card(self, card_rid, card_resource):
+        """
+        Puts card_resource in place of the card, wherever its position puts it among the other cards.
+        Returns the event that tells what happened.
+        """
+        old_card = self._card_index[card_rid]
+        old_idx = self.cards.index(old_card)
+        del self.cards[old_idx]
+        key = positions.sort_key(card_resource.position)
+        idx = next((i for i, card in enumerate(self.cards) if positions.sort_key(card.position) > key),
+                   len(self.cards))
+        self.cards.insert(idx, card_resource)
+        if not self._position_fits(self.cards, idx):
+            card_resource = card_resource.replace(position=self._position_at(self.cards, idx))
+            self.cards[idx] = card_resource
+        self._card_index[card_rid] = card_resource
+        return events.CardUpdated(card_rid, old_idx, idx, card_resource, old_card)
+
+    @unsave
+    def update_card(self, card_rid, card_resource):
+        self.notify_change(self._replace_card(card_rid, card_resource))
+
+    @unsave_positions
+    def set_card_positions(self, keys):
+        """Gives cards keys that keep their order, keys are [index, key] pairs, see positions.integer_keys()."""
+        for idx, key in keys:
+            old_card = self.cards[idx]
+            card = old_card.replace(position=key)
+            self.cards[idx] = card
+            self._card_index[card.rid] = card
+            self.notify_change(events.CardUpdated(card.rid, idx, idx, card, old_card))
+
+    @unsave_positions
+    def set_task_positions(self, card_rid, keys):
+        """Same as set_card_positions() for tasks of the card."""
+        task_list = self.tasks(card_rid)
+        for idx, key in keys:
+            old_task = task_list[idx]
+            task = old_task.replace(position=key)
+            task_list[idx] = task
+            self._task_keys[task.rid] = key
+            self.notify_change(events.TaskUpdated(card_rid, idx, task, old_task))
+        self.mark_changed((card_rid,))
 
     @unsave
     def update_preference(self, card_rid, field, new_value):
         # check if attribute exists first
-        getattr(self.preferences[card_rid], field)
-        setattr(self.preferences[card_rid], field, new_value)
+        old_value = getattr(self.preferences[card_rid], field)
+        # Resources are shared with snapshots, so they're replaced instead of modified.
+        self.preferences[card_rid] = self.preferences[card_rid].replace(**{field: new_value})
+        if old_value != new_value:
+            self.notify_change(events.PreferenceChanged(card_rid, (field,), self.preferences[card_rid]))
 
     @unsave
     def replace_preference(self, card_rid, preference_resource):
+        old_pref = self.preferences.get(card_rid)
         self.preferences[card_rid] = preference_resource
+        if old_pref is not None:
+            self.preference_rids.discard(old_pref.rid)
+        self.preference_rids.add(preference_resource.rid)
+        changed = events.changed_fields(old_pref, preference_resource)
+        if changed:
+            self.notify_change(events.PreferenceChanged(card_rid, changed, preference_resource))
 
     def save(self):
         if self.debug:
             return
-        with open(self.path, 'w') as f:
-            cards_resource = [card.to_json() for card in self.cards]
-            tasks_resource = []
-            for task_list in self._tasks.values():
-                tasks_resource.extend([task.to_json() for task in task_list])
-            preferences_resource = [pref.to_json() for pref in self.preferences.values()]
-            data = {
-                'cards': cards_resource, 'tasks': tasks_resource,
-                'preferences': preferences_resource, 'token': self.token
-            }
-            json.dump(data, f)
+        if self.journal:
+            fsync = self.journal.fsync_later()
+            if fsync is not None:
+                # Records are flushed to the OS already, fsync would block the GUI thread.
+                self.writer.call(fsync)
+            if self.journal.size() > self.journal_limit:
+                self.compact()
+        else:
+            self.writer.submit(self.path, partial(self.snapshot().serialize, changes=self._changes_json()),
+                               self.compression, self.compression_level)
         self.saved = True
         print("Storage state saved!")
 
-    def sync(self):
-        with open(self.path, 'r') as f:
-            file_data = json.load(f)
+    def snapshot(self):
+        """
+        Consistent read-only copy of the state, see StorageSnapshot.
+        Only cards changed since the last snapshot get a new CardVersion.
+        """
+        return StorageSnapshot(tuple(self.cards), dict(self.preferences), self.token, self.rids.to_json(),
+                               {card.rid: self._version(card.rid) for card in self.cards}, self.format)
 
-        self._fix_positions(self.cards)
-        for task_list in self._tasks.values():
-            self._fix_positions(task_list)
+    def _version(self, card_rid):
+        generation = self._generations.get(card_rid, 0)
+        version = self._versions.get(card_rid)
+        if version is None or version.generation != generation:
+            task_list = self._tasks.get(card_rid)
+            version = CardVersion(generation, task_list.snapshot() if task_list is not None else None,
+                                  self._fragments.get(card_rid))
+            self._versions[card_rid] = version
+        return version
 
-        cards_resource = [card.to_json() for card in self.cards]
-        tasks_resource = []
-        for task_list in self._tasks.values():
-            tasks_resource.extend([task.to_json() for task in task_list])
-        preferences_resource = [pref.to_json() for pref in self.preferences.values()]
-
-        data = {
-            'cards': cards_resource, 'tasks': tasks_resource,
-            'preferences': preferences_resource, 'token': self.token
-        }
-        jid = self.dispatcher.sync(file_data, data)
-        self.timer = QTimer()
-        self.timer.timeout.connect(lambda: self._check_for_sync_errors(jid))
-        self.timer.start(1000)
-
-    def _fix_positions(self, resource_list):
-        for idx, res in enumerate(resource_list):
-            res.position = idx
-
-    def _check_for_sync_errors(self, jid):
-        print('Checking for sync errors...')
-        num_items = self.output_queue.qsize()
-        for _ in range(num_items):
-            job_id, future = self.output_queue.get()
-            if job_id != jid:
-                self.output_queue.put((job_id, future))
+    def _touch(self, card_rid):
+        # Generations are unique across the whole storage, so equal generation means equal tasks.
+        self._generation += 1
+        self._generations[card_rid] = self._generation
+
+    def checkpoint(self):
+        """Remember current state as an undo step."""
+        if not self.undo_limit:
+            return
+        self._undo.append(self.snapshot())
+        if len(self._undo) > self.undo_limit:
+            del self._undo[0]
+        self._redo.clear()
+
+    @contextmanager
+    def undo_step(self):
+        """All mutations inside the block are undone together."""
+        checkpointed = False
+        if self._undo_depth == 0 and self.undo_limit:
+            self.checkpoint()
+            checkpointed = True
+        self._undo_depth += 1
+        try:
+            yield
+        except Exception:
+            if checkpointed:
+                self._undo.pop()
+            raise
+        finally:
+            self._undo_depth -= 1
+
+    def undo(self):
+        """Returns False if there's nothing to undo."""
+        if not self._undo:
+            return False
+        self._redo.append(self.snapshot())
+        self.restore(self._undo.pop())
+        return True
+
+    def redo(self):
+        if not self._redo:
+            return False
+        self._undo.append(self.snapshot())
+        self.restore(self._redo.pop())
+        return True
+
+    def clear_history(self):
+        self._undo.clear()
+        self._redo.clear()
+
+    def restore(self, snapshot):
+        """Bring cards, tasks and preferences back to the state of the snapshot."""
+        current = {card.rid for card in self.cards}
+        changed = [card_rid for card_rid in current | set(snapshot.versions)
+                   if card_rid not in snapshot.versions or card_rid not in current
+                   or snapshot.versions[card_rid].generation != self._generations.get(card_rid, 0)]
+        # Events are worked out while the current versions are still around and emitted once restored.
+        task_lists = {card_rid: (self._version(card_rid).resources(), snapshot.versions[card_rid].resources())
+                      for card_rid in changed
+                      if card_rid in current and card_rid in snapshot.versions and self._observed(card_rid)}
+        changes = events.diff_state(self.cards, self.preferences, snapshot.cards, snapshot.preferences,
+                                    task_lists) if self._change_observers else []
+        if self.changes is not None:
+            # Every task of a changed card is compared, but only changed cards are looked at.
+            self.changes.replace('cards', self.cards, snapshot.cards)
+            self.changes.replace('preferences', self.preferences.values(), snapshot.preferences.values())
+            old_tasks = [task for card_rid in changed if card_rid in current
+                         for task in self._version(card_rid).resources()]
+            new_tasks = [task for card_rid in changed if card_rid in snapshot.versions
+                         for task in snapshot.versions[card_rid].resources()]
+            self.changes.replace('tasks', old_tasks, new_tasks)
+        # Tasks move between cards, so all of the old rids go before any of the restored ones come in.
+        for card_rid in changed:
+            if card_rid in current:
+                for task_rid in self._version(card_rid).task_rids():
+                    del self._task_index[task_rid]
+                    self._task_keys.pop(task_rid, None)
+        for card_rid in changed:
+            version = snapshot.versions.get(card_rid)
+            self._tasks.pop(card_rid, None)
+            self._fragments.pop(card_rid, None)
+            self._versions.pop(card_rid, None)
+            self._generations.pop(card_rid, None)
+            if version is None:
+                continue
+            if version.tasks is not None:
+                self._tasks[card_rid] = version.tasks.snapshot()
             else:
-                try:
-                    if not future.done():
-                        self.output_queue.put((job_id, future))
-                        return
-                    res = future.result()
-                except Exception as err:
-                    print('Dispatcher error:', err)
-                    self.timer.stop()
-                    raise
-                print('Dispatcher result:', res)
-                self.timer.stop()
-                return
+                self._fragments[card_rid] = version.fragment(self.format)
+            for task_rid in version.task_rids():
+                self._task_index[task_rid] = card_rid
+            self._generations[card_rid] = version.generation
+            self._versions[card_rid] = version
+
+        self.cards = list(snapshot.cards)
+        self._card_index.clear()
+        for card in self.cards:
+            self._card_index[card.rid] = card
+        self.preferences = dict(snapshot.preferences)
+        self.preference_rids.clear()
+        self.preference_rids.update(pref.rid for pref in self.preferences.values())
+        self.saved = False
+        self.synced = False
+        self._evict()
+        if self.journal:
+            # Journal only knows how to redo mutations, so restored state goes straight into a snapshot.
+            self.compact()
+        for event in changes:
+            self.notify_change(event)
+        self.notify_mutation()
+
+    def compact(self, snapshot=None):
+        if self.debug:
+            return
+        journal_seq, segment = self.journal.rotate()
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        def compacted():
+            self.journal.discard(segment)
+            print("Storage journal compacted.")
+
+        self.writer.submit(self.path, partial(snapshot.serialize, journal_seq, self._changes_json()),
+                           self.compression, self.compression_level, after=compacted)
+
+    def _changes_json(self):
+        return self.changes.to_json() if self.changes is not None else None
+
+    def sync(self):
+        if self._sync_job is not None:
+            # Outbox is out, whatever changed meanwhile goes with the next sync.
+            self._sync_again = True
+            return
+        self._sync_again = False
+        if self.changes.complete:
+            # Fractional keys are only given to tasks that are moved or put between others.
+            self._use_integer_positions(set(task.card_rid for task in self.changes.resources('tasks')
+                                            if positions.key_integer(task.position) is None))
+        else:
+            self._use_integer_positions(list(self.card_rids))
+        if self.changes.complete:
+            # Only rids that changed since the last sync are looked at.
+            changes, fingerprint_updates = self.changes.resolve()
+        else:
+            changes, fingerprint_updates = self.baseline.diff(self.snapshot())
+        # Baseline is what the server will have once the outbox gets through,
+        # changes from now on are recorded against it.
+        self.baseline.apply(fingerprint_updates)
+        self.changes = ChangeSet(self.baseline)
+        self.outbox.merge(changes)
+        self._write_outbox()
+        self._write_baseline()
+        self.synced = True
+        if self._retry_timer is not None:
+            self._retry_timer.stop()
+        if not self.outbox:
+            self.sync_finished(None)
+            return
+        sent = self.outbox.changes()
+        self._sync_job = self.dispatcher.sync(sent)
+        self.dispatcher.on_done(self._sync_job, partial(self._check_for_sync_errors, self._sync_job, sent))
+
+    def _use_integer_positions(self, card_rids):
+        """
+        Server takes integer positions only (see api.resources.to_wire), so fractional keys
+        of the cards and of the tasks of card_rids are replaced by integer keys before a sync.
+        Returns True if some keys were replaced.
+        """
+        keys = positions.integer_keys([card.position for card in self.cards])
+        if keys:
+            self.set_card_positions(keys)
+        replaced = bool(keys)
+        for card_rid in card_rids:
+            keys = positions.integer_keys([task.position for task in self.tasks(card_rid)])
+            if keys:
+                self.set_task_positions(card_rid, keys)
+                replaced = True
+        return replaced
+
+    def flush_sync(self):
+        """
+        Syncs and returns once the server answered, events are processed meanwhile.
+        Returns False if some of the changes still aren't on the server.
+        """
+        self.sync()
+        while self._sync_job is not None:
+            # Sync of changes made meanwhile might follow, see _check_for_sync_errors().
+            self.extract_future(self._sync_job)
+        return not self._pending_sync()
+
+    def sync_finished(self, sent):
+        """Called with the changes that were sent once the server has them."""
+        if sent is not None:
+            self.outbox.confirm(sent)
+            self._write_outbox()
+        # Snapshot on disk gets the change set recorded against the new baseline,
+        # unsaved state gets it with the next save anyway.
+        if self.journal:
+            self.compact()
+        elif self.saved:
+            self.save()
+
+    def sync_failed(self, sent, error):
+        # Batches that went through are done with, the rest stays in the outbox and is sent again.
+        if isinstance(error, SyncFailed):
+            self.outbox.confirm(confirmed_changes(sent, error.report.completed))
+            rejected = self._reject(sent, error)
+            if rejected is not None:
+                self.outbox.confirm(rejected)
+        self._write_outbox()
+        self._retry_failed_sync(error)
+
+    def _reject(self, sent, error):
+        """
+        Returns changes of the batches the server refused, None if it refused none.
+        Sending them again won't help, so they're kept in the rejected file instead.
+        """
+        steps = [step for step, step_error in error.report.failed.items()
+                 if isinstance(step_error, BatchFailed) and step_error.rejected]
+        if not steps:
+            return None
+        errors = [str(error.report.failed[step]) for step in steps]
+        print('Sync rejected:', '; '.join(errors))
+        rejected = confirmed_changes(sent, steps)
+        if not self.debug:
+            with open(self.rejected_path, 'a') as f:
+                f.write(json.dumps({'errors': errors, 'changes': rejected}) + '\n')
+        return rejected
+
+    def _clear_rejected(self):
+        # Refused batches hold data of the user that logged out.
+        if os.path.exists(self.rejected_path):
+            os.remove(self.rejected_path)
+
+    def _retry_failed_sync(self, error):
+        self.synced = False
+        failed = error.report.failed.values() if isinstance(error, SyncFailed) else ()
+        if failed and all(isinstance(step_error, BatchFailed) and step_error.rejected for step_error in failed):
+            # Only refused batches failed, batches that waited for them go out right away.
+            self.sync()
+        else:
+            # Server can't be reached or has trouble of its own, it's tried again later.
+            self._schedule_retry()
+
+    def _schedule_retry(self):
+        self._sync_failures += 1
+        if self._retry_timer is None:
+            self._retry_timer = QTimer()
+            self._retry_timer.setSingleShot(True)
+            self._retry_timer.timeout.connect(self.sync)
+        self._retry_timer.start(int(retry_delay(self._sync_failures) * 1000))
+
+    def _check_for_sync_errors(self, jid, sent, future):
+        if jid != self._sync_job:
+            # Sync of a wiped state, there's nothing left to confirm or retry.
+            return
+        self._sync_job = None
+        try:
+            res = future.result()
+        except Exception as err:
+            # Raising here would take the app down, the outbox is retried instead.
+            print('Dispatcher error:', err)
+            self.sync_failed(sent, err)
+            return
+        print('Sync finished:', res.to_json())
+        self._sync_failures = 0
+        self.sync_finished(sent)
+        if self._sync_again:
+            self._sync_again = False
+            self.sync()
+
+    def _write_outbox(self):
+        if self.debug:
+            return
+        self.writer.submit(self.outbox_path, json.dumps(self.outbox.to_json()))
+
+    def load_outbox(self):
+        try:
+            self.outbox = Outbox.read(self.outbox_path)
+        except (OSError, ValueError):
+            self.outbox = Outbox()
+
+    def _stop_sync(self):
+        """Sync still out and the pending retry are ignored from now on, see wipe()."""
+        if self._retry_timer is not None:
+            self._retry_timer.stop()
+        self._sync_job = None
+        self._sync_again = False
+        self._sync_failures = 0
+
+    def _clear_state(self):
+        """Drops cards, tasks, preferences and the token of the logged out user from memory."""
+        old_state = self._observed_state()
+        self.cards = []
+        self._card_index.clear()
+        self._task_index.clear()
+        self._task_keys = {}
+        self._tasks.clear()
+        self._open_cards = {}
+        self._fragments = {}
+        self._generations = {}
+        self._versions = {}
+        self._rekeyed = []
+        self.preferences = {}
+        self.preference_rids = set()
+        self.rids = RidAllocator()
+        self.token = None
+        self.dispatcher.token = None
+        self._notify_replaced(old_state)
+        self.saved = True
+        self.synced = True
 
     def wipe(self):
+        # Callbacks of a sync still out would write the state and the token back to disk.
+        self._stop_sync()
+        self.clear_history()
+        self.writer.flush()
+        self._clear_state()
+        if self.journal:
+            self.journal.clear()
+        self.baseline = SyncBaseline(generation=self.baseline.generation + 1)
+        self.changes = ChangeSet(self.baseline)
+        self.outbox = Outbox()
+        self._write_outbox()
+        self._write_baseline()
+        self._clear_rejected()
         data = {'cards': [], 'tasks': [], 'preferences': [], 'token': None}
-        with open(self.path, 'w') as f:
-            json.dump(data, f)
+        self.writer.submit(self.path, json.dumps(data), self.compression, self.compression_level)
+        self._write_session(None)
@@ -1,6 +1,7 @@
 from PyQt5.QtCore import QObject
 from api.resources import TaskResource
 from storage import Storage
+from persistence.events import TASK_EVENTS
 
 
 class TasksModel(object):
@@ -8,7 +9,22 @@ class TasksModel(object):
     def __init__(self, storage, card_rid):
         self._st = storage
         self.crid = card_rid
-        self._last_rid = None
+        self._on_change_observers = []
+        self._st.on_change(self.notify_change, card_rid)
+
+    def on_change(self, observer):
+        # observer(event) gets every task event of the card, see persistence.events.
+        self._on_change_observers.append(observer)
+
+    def notify_change(self, event):
+        if not isinstance(event, TASK_EVENTS):
+            return
+        for observer in self._on_change_observers:
+            observer(event)
+
+    def close(self):
+        self._st.remove_observer(self.notify_change, self.crid)
+        self._on_change_observers.clear()
 
     def data(self, index=None):
         if index is None:
@@ -18,7 +34,7 @@ class TasksModel(object):
         return (task.rid, task.description, task.created)
 
     def add(self, text, created):
-        # Should I set position of the task here ? Seems unnecessary though.
+        # Storage sets position of the task.
         new_rid = self._get_new_rid()
         task = TaskResource(rid=new_rid, description=text,
                             card_rid=self.crid, created=created)
@@ -33,16 +49,16 @@ class TasksModel(object):
 
     def update(self, task_index, text, created_at=None):
         task = self._st.get_task(self.crid, task_index)
-        task.description = text
+        changes = {'description': text}
         if created_at:
-            task.created = created_at
-        self._st.update_task(self.crid, task_index, task)
+            changes['created'] = created_at
+        self._st.update_task(self.crid, task_index, task.replace(**changes))
 
     def find(self, task_rid):
-        for idx, task in enumerate(self._st.tasks(self.crid)):
-            if task.rid == task_rid:
-                return idx
-        return -1
+        location = self._st.locate_task(task_rid)
+        if location is None or location[0] != self.crid:
+            return -1
+        return location[1]
 
     def insert(self, index, text, created):
         new_rid = self._get_new_rid()
@@ -53,12 +69,7 @@ class TasksModel(object):
 
 
     def _get_new_rid(self):
-        new_rid = self._last_rid + 1 if self._last_rid else 0
-        while True:
-            if new_rid in self._st.task_rids:
-                new_rid += 1
-            else:
-                return new_rid
+        return self._st.new_rid('tasks')
 
     def __getitem__(self, idx):
         task = self._st.get_task(self.crid, idx)
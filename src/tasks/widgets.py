@@ -148,6 +148,21 @@ class TaskWidget(QWidget):
     def set_text(self, text):
         self.label.setText(text)
 
+    def set_icon(self, icon):
+        if icon is None:
+            if self.icon_btn:
+                self.layout.removeWidget(self.icon_btn)
+                self.icon_btn.deleteLater()
+                self.icon_btn = None
+            return
+        if self.icon_btn is None:
+            self.icon_btn = QToolButton()
+            self.icon_btn.setMaximumSize(20, 20)
+            self.icon_btn.setAutoRaise(True)
+            # Right after the label, in front of the stretch.
+            self.layout.insertWidget(self.layout.indexOf(self.label) + 1, self.icon_btn)
+        self.icon_btn.setIcon(icon)
+
     def mousePressEvent(self, event):
         super().mousePressEvent(event)
 
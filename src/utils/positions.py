@@ -0,0 +1,239 @@
+"""
+Fractional position keys.
+
+Position of a card or task is a string, and resources are ordered by comparing
+their positions as plain strings. There's always a key between any two keys,
+so putting a resource somewhere only changes the position of that one resource.
+
+Key is an integer part followed by an optional fraction, both in base 62.
+First character of the integer part tells how many digits follow it
+('a' one digit, 'b' two and so on, 'Z', 'Y'... for negative integers),
+so appending keeps keys short, and the fraction is only needed for inserts.
+
+Keys without a fraction stand for integers one to one, in the same order
+('a0' is 0, 'a1' is 1, 'Zz' is -1), that's how positions go to the server,
+which only takes integers. Fractional keys are replaced by integer keys
+before they're synced, see integer_keys().
+"""
+
+DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+INTEGER_ZERO = 'a0'
+SMALLEST_INTEGER = 'A' + DIGITS[0] * 26
+
+
+def _integer_length(head):
+    if 'a' <= head <= 'z':
+        return ord(head) - ord('a') + 2
+    if 'A' <= head <= 'Z':
+        return ord('Z') - ord(head) + 2
+    raise ValueError("Invalid position key head {!r}.".format(head))
+
+
+def _split(key):
+    length = _integer_length(key[0])
+    if length > len(key) or key == SMALLEST_INTEGER or key.endswith(DIGITS[0]) and len(key) > length:
+        raise ValueError("Invalid position key {!r}.".format(key))
+    return key[:length], key[length:]
+
+
+def _midpoint(a, b):
+    """Fraction between fractions a and b, b None stands for 1."""
+    if b is not None:
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+    digit_a = DIGITS.index(a[0]) if a else 0
+    digit_b = DIGITS.index(b[0]) if b is not None else len(DIGITS)
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b + 1) // 2]
+    if b is not None and len(b) > 1:
+        return b[0]
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def _increment(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        digit = DIGITS.index(digits[i]) + 1
+        if digit < len(DIGITS):
+            digits[i] = DIGITS[digit]
+            return head + ''.join(digits)
+        digits[i] = DIGITS[0]
+    if head == 'Z':
+        return INTEGER_ZERO
+    if head == 'z':
+        return None
+    head = chr(ord(head) + 1)
+    if head > 'a':
+        digits.append(DIGITS[0])
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+
+def _decrement(integer):
+    head, digits = integer[0], list(integer[1:])
+    for i in reversed(range(len(digits))):
+        digit = DIGITS.index(digits[i]) - 1
+        if digit >= 0:
+            digits[i] = DIGITS[digit]
+            return head + ''.join(digits)
+        digits[i] = DIGITS[-1]
+    if head == 'a':
+        return 'Z' + DIGITS[-1]
+    if head == 'A':
+        return None
+    head = chr(ord(head) - 1)
+    if head < 'Z':
+        digits.append(DIGITS[-1])
+    else:
+        digits.pop()
+    return head + ''.join(digits)
+
+
+def integer_key(value):
+    """Integer key that stands for the integer value."""
+    if value >= 0:
+        length, offset = 1, 0
+        while value - offset >= len(DIGITS) ** length:
+            offset += len(DIGITS) ** length
+            length += 1
+        head = chr(ord('a') + length - 1)
+    else:
+        length, offset = 1, -len(DIGITS)
+        while value < offset:
+            length += 1
+            offset -= len(DIGITS) ** length
+        head = chr(ord('Z') - length + 1)
+    digits = []
+    value -= offset
+    for _ in range(length):
+        value, digit = divmod(value, len(DIGITS))
+        digits.append(DIGITS[digit])
+    return head + ''.join(reversed(digits))
+
+
+def key_integer(key):
+    """Integer the key stands for, None if the key has a fraction."""
+    integer, fraction = _split(key)
+    if fraction:
+        return None
+    head, length = integer[0], len(integer) - 1
+    if head >= 'a':
+        offset = sum(len(DIGITS) ** n for n in range(1, length))
+    else:
+        offset = -sum(len(DIGITS) ** n for n in range(1, length + 1))
+    value = 0
+    for digit in integer[1:]:
+        value = value * len(DIGITS) + DIGITS.index(digit)
+    return offset + value
+
+
+def key_between(a, b):
+    """
+    Returns key that sorts after a and before b.
+    None stands for the start (a) or the end (b) of the list.
+    """
+    if a is not None and b is not None and a >= b:
+        raise ValueError("Position key {!r} isn't before {!r}.".format(a, b))
+    if a is None:
+        if b is None:
+            return INTEGER_ZERO
+        integer, fraction = _split(b)
+        if integer == SMALLEST_INTEGER:
+            return integer + _midpoint('', fraction)
+        if fraction:
+            return integer
+        key = _decrement(integer)
+        if key is None:
+            raise ValueError("Can't create position key before {!r}.".format(b))
+        return key
+    integer, fraction = _split(a)
+    if b is None:
+        key = _increment(integer)
+        return integer + _midpoint(fraction, None) if key is None else key
+    integer_b, fraction_b = _split(b)
+    if integer == integer_b:
+        return integer + _midpoint(fraction, fraction_b)
+    key = _increment(integer)
+    if key is not None and key < b:
+        return key
+    return integer + _midpoint(fraction, None)
+
+
+def keys(count, after=None):
+    """count ascending keys, all of them after the given key."""
+    output = []
+    for _ in range(count):
+        after = key_between(after, None)
+        output.append(after)
+    return output
+
+
+def is_ordered(positions):
+    """True if positions are keys in ascending order."""
+    last = None
+    for position in positions:
+        if not isinstance(position, str) or (last is not None and position <= last):
+            return False
+        last = position
+    return True
+
+
+def fits(position, before, after):
+    """True if position is a key that comes after before and before after, None is open ended."""
+    return (isinstance(position, str)
+            and (before is None or isinstance(before, str) and before < position)
+            and (after is None or isinstance(after, str) and position < after))
+
+
+def integer_keys(positions):
+    """
+    Integer keys in the same order for ascending keys. Fractions are dropped and keys
+    after them are moved forward only as far as they have to, other keys stay.
+    Returns [index, new key] pairs of the keys that change, empty if all are integers.
+    """
+    changes = []
+    last = None
+    for idx, key in enumerate(positions):
+        integer, fraction = _split(key)
+        value = key_integer(integer)
+        if last is not None and value <= last:
+            value = last + 1
+            changes.append([idx, integer_key(value)])
+        elif fraction:
+            changes.append([idx, integer])
+        last = value
+    return changes
+
+
+def sort_key(position):
+    # Integer positions (the api, files written before position keys) sort as the keys that stand for them.
+    if isinstance(position, str):
+        return 0, position
+    if position is None:
+        return 1, ''
+    return 0, integer_key(position)
+
+
+def rekey(resources):
+    """
+    Gives resources keys in their current order. Integer positions get the keys that
+    stand for them, unless positions aren't ascending then, in that case all of the
+    resources get fresh keys. Returns (resource, old position) of every resource that
+    stands somewhere else than the server has it, the list is empty if none does.
+    """
+    current = [integer_key(res.position) if isinstance(res.position, int) else res.position
+               for res in resources]
+    if is_ordered(current):
+        for res, key in zip(resources, current):
+            res.position = key
+        return []
+    changed = []
+    for res, position, key in zip(resources, current, keys(len(resources))):
+        if position != key:
+            changed.append((res, res.position))
+        res.position = key
+    return changed
@@ -0,0 +1,46 @@
+from api.resources import ResourceBase, CardResource, TaskResource, PreferenceResource
+
+
+RESOURCE_KINDS = {CardResource: 'cards', TaskResource: 'tasks', PreferenceResource: 'preferences'}
+# Card rids always started from 1, tasks and preferences from 0.
+FIRST_RIDS = {'cards': 1, 'tasks': 0, 'preferences': 0}
+
+
+class RidAllocator(object):
+    """
+    Hands out rids that were never used before, per resource kind.
+    Every rid that passes through storage is observed, so the allocator stays
+    ahead of rids loaded from disk, replayed from the journal or fetched from the api.
+    """
+
+    def __init__(self, next_rids=None):
+        self._next = dict(FIRST_RIDS)
+        if next_rids:
+            self.update(next_rids)
+
+    def update(self, next_rids):
+        for kind, next_rid in next_rids.items():
+            self._next[kind] = max(self._next.get(kind, 0), next_rid)
+
+    def observe(self, kind, rid):
+        if rid >= self._next[kind]:
+            self._next[kind] = rid + 1
+
+    def observe_all(self, values):
+        for value in values:
+            if isinstance(value, ResourceBase):
+                self.observe(RESOURCE_KINDS[type(value)], value.rid)
+
+    def allocate(self, kind):
+        rid = self._next[kind]
+        self._next[kind] = rid + 1
+        return rid
+
+    def reserve(self, kind, count):
+        """Reserve a block of rids at once, useful for bulk imports."""
+        start = self._next[kind]
+        self._next[kind] = start + count
+        return range(start, start + count)
+
+    def to_json(self):
+        return dict(self._next)
@@ -0,0 +1,278 @@
+from itertools import chain
+
+
+LOAD = 1000
+# Sequences up to this many items are a single list, below it list.insert
+# moving items beats looking chunks up (see benchmarks.sequence).
+FLAT_SIZE = 10000
+
+
+class TaskSequence(object):
+    """
+    List-like sequence with logarithmic access, insert and pop at any index.
+
+    Sequence of up to flat items is kept as one list and indexed directly.
+    Longer ones are kept in chunks of load / 2 to 2 * load items. Chunk that holds
+    an index is found with a Fenwick tree over chunk lengths, so insert and pop only
+    move items within one chunk and update O(log n) tree nodes. Tree is rebuilt only
+    when chunks are split or merged, that's once every load / 2 operations at most.
+    Sequence that shrinks to half of flat is turned back into one list.
+
+    snapshot() is O(1), the copy shares chunks with the original and whichever
+    of the two is mutated first copies the chunk list and then every chunk it
+    writes to, so neither ever sees the other's changes.
+    """
+
+    def __init__(self, iterable=(), load=LOAD, flat=FLAT_SIZE):
+        self._load = load
+        self._flat = flat
+        self._chunks = []
+        self._tree = []
+        self._len = 0
+        # Ids of chunks only this sequence refers to, None while the chunk list is shared.
+        self._owned = set()
+        self.extend(iterable)
+
+    def snapshot(self):
+        copy = TaskSequence.__new__(TaskSequence)
+        copy._load = self._load
+        copy._flat = self._flat
+        copy._chunks = self._chunks
+        copy._tree = self._tree
+        copy._len = self._len
+        copy._owned = self._owned = None
+        return copy
+
+    def _unshare(self):
+        if self._owned is None:
+            self._chunks = list(self._chunks)
+            self._tree = list(self._tree)
+            self._owned = set()
+
+    def _own(self, chunk_idx):
+        """Returns chunk at chunk_idx that's safe to write to."""
+        self._unshare()
+        chunk = self._chunks[chunk_idx]
+        if id(chunk) not in self._owned:
+            chunk = list(chunk)
+            self._chunks[chunk_idx] = chunk
+            self._owned.add(id(chunk))
+        return chunk
+
+    def _add_chunk(self, chunk):
+        self._chunks.append(chunk)
+        self._owned.add(id(chunk))
+
+    def _rebuild(self):
+        tree = [len(chunk) for chunk in self._chunks]
+        for i in range(len(tree)):
+            j = i | (i + 1)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _update(self, chunk_idx, delta):
+        tree = self._tree
+        while chunk_idx < len(tree):
+            tree[chunk_idx] += delta
+            chunk_idx |= chunk_idx + 1
+
+    def _locate(self, idx):
+        """Returns (chunk index, index within the chunk) of a valid non-negative idx."""
+        tree = self._tree
+        chunk_idx = 0
+        bit = 1 << (len(tree).bit_length() - 1) if tree else 0
+        while bit:
+            nxt = chunk_idx + bit
+            if nxt <= len(tree) and tree[nxt - 1] <= idx:
+                idx -= tree[nxt - 1]
+                chunk_idx = nxt
+            bit >>= 1
+        return chunk_idx, idx
+
+    def _prefix(self, chunk_idx):
+        """Number of items in chunks before chunk_idx."""
+        tree = self._tree
+        total = 0
+        chunk_idx -= 1
+        while chunk_idx >= 0:
+            total += tree[chunk_idx]
+            chunk_idx = (chunk_idx & (chunk_idx + 1)) - 1
+        return total
+
+    def _normalize(self, idx):
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError("Sequence index out of range.")
+        return idx
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return chain.from_iterable(self._chunks)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, list(self))
+
+    def __getitem__(self, idx):
+        chunks = self._chunks
+        if len(chunks) == 1:
+            # Same result for indexes and slices as the list itself.
+            return chunks[0][idx]
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self._len)
+            if step != 1:
+                return list(self)[idx]
+            output = []
+            if start >= stop:
+                return output
+            chunk_idx, offset = self._locate(start)
+            while len(output) < stop - start:
+                chunk = self._chunks[chunk_idx]
+                output.extend(chunk[offset:offset + stop - start - len(output)])
+                chunk_idx, offset = chunk_idx + 1, 0
+            return output
+        chunk_idx, offset = self._locate(self._normalize(idx))
+        return self._chunks[chunk_idx][offset]
+
+    def __setitem__(self, idx, value):
+        if len(self._chunks) == 1:
+            self._own(0)[self._normalize(idx)] = value
+            return
+        chunk_idx, offset = self._locate(self._normalize(idx))
+        self._own(chunk_idx)[offset] = value
+
+    def append(self, value):
+        if not self._chunks:
+            self._unshare()
+            self._add_chunk([value])
+            self._tree.append(1)
+            self._len = 1
+            return
+        self._own(len(self._chunks) - 1).append(value)
+        self._len += 1
+        self._update(len(self._chunks) - 1, 1)
+        self._split(len(self._chunks) - 1)
+
+    def extend(self, iterable):
+        values = list(iterable)
+        if not values:
+            return
+        self._unshare()
+        if self._chunks and (len(self._chunks) == 1 or len(self._chunks[-1]) < self._load):
+            values = self._chunks.pop() + values
+        if not self._chunks and len(values) <= self._flat:
+            self._add_chunk(values)
+        else:
+            for start in range(0, len(values), self._load):
+                self._add_chunk(values[start:start + self._load])
+        self._len = sum(len(chunk) for chunk in self._chunks)
+        self._rebuild()
+
+    def insert(self, idx, value):
+        chunks = self._chunks
+        if len(chunks) == 1 and len(chunks[0]) < self._flat:
+            self._own(0).insert(idx, value)
+            self._len += 1
+            self._tree[0] += 1
+            return
+        # Same as list.insert, out of range indexes insert at either end.
+        if idx < 0:
+            idx = max(0, self._len + idx)
+        if idx >= self._len:
+            self.append(value)
+            return
+        chunk_idx, offset = self._locate(idx)
+        self._own(chunk_idx).insert(offset, value)
+        self._len += 1
+        self._update(chunk_idx, 1)
+        self._split(chunk_idx)
+
+    def pop(self, idx=-1):
+        if len(self._chunks) == 1 and self._len > 1:
+            value = self._own(0).pop(idx)
+            self._len -= 1
+            self._tree[0] -= 1
+            return value
+        chunk_idx, offset = self._locate(self._normalize(idx))
+        chunk = self._own(chunk_idx)
+        value = chunk.pop(offset)
+        self._len -= 1
+        if not self._len:
+            self.clear()
+        elif len(self._chunks) == 1:
+            self._update(chunk_idx, -1)
+        elif self._len <= self._flat // 2:
+            self._flatten()
+        elif len(chunk) < self._load // 2:
+            self._merge(chunk_idx)
+        else:
+            self._update(chunk_idx, -1)
+        return value
+
+    def _split(self, chunk_idx):
+        chunk = self._chunks[chunk_idx]
+        if len(self._chunks) == 1:
+            if len(chunk) > self._flat:
+                self._chunks = [chunk[start:start + self._load] for start in range(0, len(chunk), self._load)]
+                self._owned = set(id(part) for part in self._chunks)
+                self._rebuild()
+        elif len(chunk) > 2 * self._load:
+            halves = [chunk[:self._load], chunk[self._load:]]
+            self._chunks[chunk_idx:chunk_idx + 1] = halves
+            self._owned.update(id(half) for half in halves)
+            self._rebuild()
+
+    def _merge(self, chunk_idx):
+        # Chunk that shrank joins its neighbour, so deletes don't leave lots of tiny chunks behind.
+        if chunk_idx + 1 == len(self._chunks):
+            chunk_idx -= 1
+        merged = self._chunks[chunk_idx] + self._chunks[chunk_idx + 1]
+        self._chunks[chunk_idx:chunk_idx + 2] = [merged]
+        self._owned.add(id(merged))
+        self._rebuild()
+        self._split(chunk_idx)
+
+    def _flatten(self):
+        chunk = list(self)
+        self._chunks = [chunk] if chunk else []
+        self._owned = {id(chunk)}
+        self._rebuild()
+
+    def bisect_left(self, value, key):
+        """
+        Same as bisect.bisect_left on a sequence ordered by key, O(log n).
+        Chunk is found by its last item, index within it by bisecting the chunk.
+        """
+        chunks = self._chunks
+        lo, hi = 0, len(chunks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(chunks[mid][-1]) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(chunks):
+            return self._len
+        chunk_idx, chunk = lo, chunks[lo]
+        lo, hi = 0, len(chunk)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(chunk[mid]) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self._prefix(chunk_idx) + lo
+
+    def sort(self, key=None):
+        values = sorted(self, key=key)
+        self.clear()
+        self.extend(values)
+
+    def clear(self):
+        self._chunks = []
+        self._tree = []
+        self._len = 0
+        self._owned = set()
@@ -33,6 +33,11 @@ class FlowLayout(QLayout):
     def addItem(self, item):
         self.itemList.append(item)
 
+    def insertWidget(self, index, widget):
+        # addWidget wraps the widget in an item and hands it to addItem, so it's moved from the end.
+        self.addWidget(widget)
+        self.itemList.insert(index, self.itemList.pop())
+
     def count(self):
         return len(self.itemList)
 
@@ -213,6 +218,10 @@ class Sidebar(QScrollArea):
         widget.clicked.connect(self.item_clicked)
         self.sidebar_layout.addWidget(widget)
 
+    def insert_widget(self, index, widget):
+        widget.clicked.connect(self.item_clicked)
+        self.sidebar_layout.insertWidget(index, widget)
+
     def remove_widget(self, id):
         # assumes that widgets have id attribute set
         index = 0